@@ -0,0 +1,247 @@
+#! /usr/bin/env python3
+'''Benchmark the frame-generation pipeline on a synthetic JPEG corpus.
+
+The corpus has mixed sizes and aspect ratios; most files carry an IPTC
+caption (APP13) and EXIF DateTimeDigitized/DateTimeOriginal. Each
+stage is run in a fresh process so its peak RSS is its own; the input
+a stage needs made first (prepare_STAGE) is made before that process
+starts, so neither its time nor its memory counts:
+
+  get_metadata        per file
+  burn_caption        per file (on an already framed image)
+  burn_dir            whole corpus (per-file latency from its metrics)
+  write_catalog       whole corpus
+  addCaptionToFiles   whole corpus (burn_captions module)
+
+Results are JSON: files/sec, latency percentiles (ms) and peak RSS (KB).
+
+EXAMPLES:
+  bench_digframe.py --files 200 --output bench.json
+  bench_digframe.py --corpus ~/Pictures/sample --stages get_metadata burn_dir
+'''
+
+import os
+import os.path
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+
+# Sizes are (width, height); the mix covers 4:3, 3:2, 16:9 and portrait.
+SIZES = [(4000, 3000), (6000, 4000), (3000, 4000), (1920, 1080),
+         (2048, 1536), (1600, 1200), (800, 600), (4000, 2250)]
+STAGES = ['get_metadata', 'burn_caption', 'burn_dir', 'write_catalog',
+          'addCaptionToFiles']
+
+
+def make_corpus(corpus_dir, nfiles, seed=0):
+    from PIL import Image, ImageDraw
+    from digframe import metadata
+    rnd = random.Random(seed)
+    for i in range(nfiles):
+        (w, h) = SIZES[i % len(SIZES)]
+        subdir = os.path.join(corpus_dir, 'album{:02d}'.format(i % 5))
+        os.makedirs(subdir, exist_ok=True)
+        im = Image.new('RGB', (w, h), tuple(rnd.randrange(256) for _ in 'rgb'))
+        draw = ImageDraw.Draw(im)
+        for _ in range(20): # some detail so the encoder has work to do
+            (x, y) = (rnd.randrange(w), rnd.randrange(h))
+            draw.ellipse([x, y, x + w//8, y + h//8],
+                         fill=tuple(rnd.randrange(256) for _ in 'rgb'))
+        exif = Image.Exif()
+        if i % 7 != 0:
+            date = '20{:02d}:{:02d}:{:02d} 12:{:02d}:00'.format(
+                rnd.randrange(0, 20), rnd.randrange(1, 13),
+                rnd.randrange(1, 29), rnd.randrange(60))
+            ifd = exif.get_ifd(0x8769)
+            ifd[0x9003] = date
+            ifd[0x9004] = date
+        buf = io.BytesIO()
+        im.save(buf, 'JPEG', quality=90, exif=exif.tobytes())
+        data = buf.getvalue()
+        if i % 3 != 0:
+            caption = 'Synthetic photo {} "with quotes", commas ###'.format(i)
+            data = data[:2] + metadata.iptc_segment(caption) + data[2:]
+        name = 'IMG_{:05d}{}.jpg'.format(i, ' (Modified)' if i % 11 == 0 else '')
+        with open(os.path.join(subdir, name), 'wb') as f:
+            f.write(data)
+
+def corpus_files(corpus_dir):
+    return sorted(os.path.join(root, f)
+                  for root, dirs, files in os.walk(corpus_dir)
+                  for f in files if f.lower().endswith(('.jpg', '.jpeg')))
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s)-1, int(round(q*(len(s)-1))))]
+    return dict(p50=1000*pick(0.50), p90=1000*pick(0.90),
+                p95=1000*pick(0.95), p99=1000*pick(0.99), max=1000*s[-1])
+
+def peak_rss_kb():
+    # ru_maxrss survives exec() on Linux, so a spawned stage would report
+    # the parent's peak. VmHWM belongs to the new address space.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    own = int(line.split()[1])
+    except IOError:
+        pass
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, kids)
+
+##############################################################################
+# Stages. Each returns (number_of_files, [per-file seconds, ...])
+# prepare_STAGE(files, workdir, opts), if there is one, sets up WORKDIR
+# for STAGE in the parent process, untimed.
+
+def stage_get_metadata(files, workdir, opts):
+    from digframe import jobs
+    lat = list()
+    for f in files:
+        t0 = time.perf_counter()
+        jobs.get_metadata(f)
+        lat.append(time.perf_counter() - t0)
+    return len(files), lat
+
+def framed_name(workdir, i):
+    return os.path.join(workdir, 'framed-{:05d}.jpg'.format(i))
+
+def prepare_burn_caption(files, workdir, opts):
+    from digframe import imaging
+    for i, f in enumerate(files):
+        imaging.render_frame(f, framed_name(workdir, i), opts.width,
+                             opts.height, ttf=opts.ttf)
+
+def stage_burn_caption(files, workdir, opts):
+    from digframe import gen_for_df, jobs
+    framed = [(framed_name(workdir, i), jobs.get_metadata(f))
+              for i, f in enumerate(files)]
+    lat = list()
+    for (out, md) in framed:
+        t0 = time.perf_counter()
+        gen_for_df.burn_caption(out, md['date'], ttf=opts.ttf,
+                                caption=md['caption'])
+        lat.append(time.perf_counter() - t0)
+    return len(files), lat
+
+def stage_burn_dir(files, workdir, opts):
+    from digframe import gen_for_df, catalog, metrics
+    outdir = os.path.join(workdir, 'frames')
+    os.makedirs(outdir)
+    run_metrics = metrics.RunMetrics()
+    with catalog.CatalogWriter(os.path.join(workdir, 'cat.csv')) as cw:
+        gen_for_df.burn_dir(opts.corpus, outdir, cw, True,
+                            target_width=opts.width,
+                            target_height=opts.height,
+                            jobs=opts.jobs, ttf=opts.ttf,
+                            run_metrics=run_metrics)
+    return len(files), [fm.total() for fm in run_metrics.files.values()]
+
+def stage_write_catalog(files, workdir, opts):
+    from digframe import gen_for_df, catalog, metrics
+    run_metrics = metrics.RunMetrics()
+    with catalog.CatalogWriter(os.path.join(workdir, 'cat.csv')) as cw:
+        gen_for_df.write_catalog(opts.corpus, cw, verbose=False,
+                                 run_metrics=run_metrics)
+    return len(files), [fm.total() for fm in run_metrics.files.values()]
+
+def stage_addCaptionToFiles(files, workdir, opts):
+    from digframe import burn_captions, metrics
+    outdir = os.path.join(workdir, 'captions')
+    os.makedirs(outdir)
+    run_metrics = metrics.RunMetrics()
+    burn_captions.addCaptionToFiles(files, outdir,
+                                    target_width=opts.width,
+                                    target_height=opts.height,
+                                    run_metrics=run_metrics,
+                                    ttf=opts.ttf)
+    return len(files), [fm.total() for fm in run_metrics.files.values()]
+
+def run_stage(name, files, workdir, opts, results):
+    devnull = open(os.devnull, 'w')
+    sys.stdout = devnull # the tools print a line per file
+    try:
+        t0 = time.perf_counter()
+        (nfiles, lat) = globals()['stage_'+name](files, workdir, opts)
+        elapsed = time.perf_counter() - t0
+        results.put(dict(stage=name, files=nfiles, seconds=elapsed,
+                         files_per_sec=nfiles/elapsed if elapsed else None,
+                         latency_ms=percentiles(lat),
+                         peak_rss_kb=peak_rss_kb()))
+    except Exception as ex:
+        results.put(dict(stage=name, error='{}: {}'.format(type(ex).__name__, ex)))
+    finally:
+        sys.stdout = sys.__stdout__
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark digframe stages; print JSON results.',
+        epilog='EXAMPLE: %(prog)s --files 200 --output bench.json')
+    parser.add_argument('--corpus',
+                        help='Use JPEGs under this directory instead of a synthetic corpus')
+    parser.add_argument('--files', type=int, default=40,
+                        help='Number of synthetic JPEGs to generate')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=768)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='JOBS for burn_dir')
+    parser.add_argument('--ttf', default=None,
+                        help='Caption font (default: imaging.DEFAULT_TTF)')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='Write JSON here')
+    opts = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if opts.ttf is None:
+        from digframe import imaging
+        opts.ttf = imaging.DEFAULT_TTF
+    tmpcorpus = None
+    if opts.corpus is None:
+        tmpcorpus = tempfile.mkdtemp(prefix='digframe-corpus-')
+        opts.corpus = tmpcorpus
+        make_corpus(tmpcorpus, opts.files)
+    files = corpus_files(opts.corpus)
+
+    report = dict(corpus=dict(files=len(files),
+                              bytes=sum(os.path.getsize(f) for f in files),
+                              synthetic=tmpcorpus is not None),
+                  width=opts.width, height=opts.height, jobs=opts.jobs,
+                  python=sys.version.split()[0], stages=list())
+    ctx = multiprocessing.get_context('spawn') # fresh RSS per stage
+    stage_opts = argparse.Namespace(**dict((k, v) for k, v in vars(opts).items()
+                                           if k != 'output'))
+    try:
+        for name in opts.stages:
+            workdir = tempfile.mkdtemp(prefix='digframe-bench-')
+            try:
+                prepare = globals().get('prepare_'+name)
+                if prepare is not None:
+                    prepare(files, workdir, stage_opts)
+                results = ctx.Queue()
+                proc = ctx.Process(target=run_stage,
+                                   args=(name, files, workdir, stage_opts,
+                                         results))
+                proc.start()
+                report['stages'].append(results.get())
+                proc.join()
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        if tmpcorpus is not None:
+            shutil.rmtree(tmpcorpus, ignore_errors=True)
+    json.dump(report, opts.output, indent=2)
+    opts.output.write('\n')
+
+if __name__ == '__main__':
+    main()
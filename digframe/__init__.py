@@ -0,0 +1,45 @@
+'''Turn photos into captioned frame images for a digital frame.
+
+The core that both command line tools (gen_for_df, burn_captions) run
+on can be used from the package directly, on files or in memory:
+
+  metadata  read_metadata(filename), parse_jpeg_header(fileobj)
+  caption   caption_text(date, caption), draw_caption(im, caption),
+            burn_caption_file(filename, caption)
+  transform frame_image(src, w, h), frame_images(src, sizes)
+  output    jpeg_encoding(...), header_segments(...), encode_jpeg(im),
+            render_frame_bytes(data, w, h), render_frames_bytes(data, sizes)
+
+Names are resolved on first use, so "import digframe" is cheap and
+PIL is only loaded when an image function is.
+'''
+
+import importlib
+
+_API = dict(read_metadata='metadata',
+            parse_jpeg_header='metadata',
+            header_segments='metadata',
+            caption_text='metadata',
+            draw_caption='imaging',
+            burn_caption_file='imaging',
+            frame_image='imaging',
+            frame_images='imaging',
+            jpeg_encoding='imaging',
+            encode_jpeg='imaging',
+            render_frame_bytes='imaging',
+            render_frames_bytes='imaging')
+
+__all__ = sorted(_API)
+
+
+def __getattr__(name):
+    module = _API.get(name)
+    if module is None:
+        raise AttributeError('module {!r} has no attribute {!r}'
+                             .format(__name__, name))
+    value = getattr(importlib.import_module('digframe.' + module), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
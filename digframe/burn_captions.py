@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # Add and/or burn caption JPEG image. 
@@ -16,50 +16,44 @@
 #   burn_captions.py --loglevel=INFO -b --outdir withCaptions ForDad2013-c/*.jpg
 #   burn_captions.py -b --loglevel=DEBUG --defaultCaption="test caption to burn in" ~/Desktop/picts/*.jpg
 
-import os, os.path, sys, string, argparse, logging, subprocess
-import Image, ImageDraw,  ImageFont, JpegImagePlugin, IptcImagePlugin
-import shutil
-import iptcinfo
+import os, os.path, sys, argparse, logging
 
+from digframe import imaging
+from digframe import metadata
+from digframe import pipeline
+from digframe import metrics
+from digframe import planning
+from digframe import supervise
+from digframe import jobs
 
-def burn_caption(outfile,
-                 target_width=800, target_height=600, 
-                 ttf='/usr/share/fonts/truetype/msttcorefonts/arialbd.ttf',
-                 default=None):
-    # name => tag
-    iptcLut = dict([(name,tag) for tag,name in iptcinfo.c_datasets.items()]) 
-    info = None
+
+def read_caption(jpgfile, default=None):
     try:
-        #!print 'DBG-1'
-        iptc = iptcinfo.IPTCInfo(outfile,
-                                 force=True,
-                                 reportScanError = False,
-                                 inp_charset = None,
-                                 )
-        info = iptc.getData()
-    except Exception:
-        pass
-
-    if not info:
-        logging.debug('No IPTC header in: %s',outfile)
-        caption = default
-    else:
-        caption = info.get(iptcLut['caption/abstract'],default)
+        caption = metadata.read_metadata(jpgfile).caption
+    except (OSError, ValueError) as ex:
+        logging.debug('Cannot read header of %s: %s', jpgfile, ex)
+        caption = None
+    if not caption:
+        logging.debug('No IPTC caption in: %s',jpgfile)
+        return default
+    return caption
+
+def source_header(jpgfile):
+    '''RETURNS: header segments to carry the caption and Exif dates of
+JPGFILE into an output written from it.'''
+    md = metadata.read_metadata(jpgfile)
+    return metadata.header_segments(md.caption, md.date_digitized,
+                                    md.date_original)
 
-    #! im = Image.open(outfile).resize((target_width,target_height),Image.ANTIALIAS)
-    im = Image.open(outfile)
+def burn_caption(outfile,
+                 target_width=800, target_height=600, 
+                 ttf=imaging.DEFAULT_TTF,
+                 default=None,
+                 encoding=None):
+    caption = read_caption(outfile, default=default)
     if (caption != None): 
         # Burn text at bottom/center of image 
-        draw = ImageDraw.Draw(im)
-        font = ImageFont.truetype(ttf,15)
-        (textW, textH) = draw.textsize(caption,font=font)
-
-        (width,height) = im.size
-        x = max(0,int(round((width-textW)/2)) )
-        y = height-textH
-        draw.rectangle([0,y-4,width,height],fill='gray')
-        draw.text((x,y),caption,font=font,fill='cornsilk')
-    im.save(outfile)
+        imaging.burn_caption_file(outfile, caption, ttf=ttf, encoding=encoding)
 
 
 def addCaptionToFiles(infiles, outdir,
@@ -67,45 +61,111 @@ def addCaptionToFiles(infiles, outdir,
                       # for digitial frame with 4:3 aspect ratio
                       target_width=800, target_height=600, 
                       tolerance=0.01,
+                      draft=True,
+                      prefetch=0, writers=2,
+                      run_metrics=None,
+                      max_bytes=None,
+                      encoding=None,
+                      copy_metadata=True,
+                      max_crop=0.0, plan=None, plan_out=None,
+                      ttf=imaging.DEFAULT_TTF,
                       ):
+    '''Frame and caption INFILES into OUTDIR. The framing of all of them
+(pad, or crop when that loses at most MAX_CROP of the area) is decided
+up front from the header sizes; see planning.py. PLAN (from
+planning.read_plan) overrides those decisions; with PLAN_OUT the plan
+is written there and no image is made. A file whose header cannot be
+read, or whose image work fails, is skipped and reported; the others
+are done. RETURNS: number of files written.'''
     goalAspect = float(target_width)/target_height
     fileCnt = 0
     totalFiles = len(infiles)
     bad_aspect_files = dict() # d[filename] => aspect
+    bad_metadata_files = list()
+    failed_files = dict() # d[filename] => reason
+    sources = list() # [(infile, outfile, md), ...]
+    tasks = list() # [(cnt, root, fname, md, [(0, outfile, crop)]), ...]
+    if run_metrics is None:
+        run_metrics = metrics.RunMetrics()
 
     for idx,infile in enumerate(infiles):
-        print '%04d/%04d File="%s"'%(idx,totalFiles,infile)
+        print('%04d/%04d File="%s"'%(idx,totalFiles,infile))
         base = os.path.basename(infile).replace(' ','_').replace('(Modified)','_modified_')
-        tmp1 = os.path.join('/tmp',base)
         outfile = os.path.join(outdir,base)
         if os.path.exists(outfile): continue
 
-        # Track infiles that were bad aspect. Report later so I have option
-        # to go back and hand crop them.
-        cmd='identify -format "%%w %%h" "%s"'%(infile,)
-        (width,height) = subprocess.check_output(cmd, shell=True).split()
-        thisAspect = float(width)/float(height)
-        if abs(thisAspect - goalAspect) > tolerance:
-            bad_aspect_files[infile] = thisAspect
-
-        # make outfile fit desired aspect
-        cmd='aspectpad -a %s -m l "%s" "%s"'%(float(target_width)/target_height,
-                                          infile, tmp1)
-        output = subprocess.check_output(cmd, shell=True)
-        #!print 'DBG: cmd="%s"'%(cmd,)
-        #!cmd=('convert "%s" -gravity center -extent %sx%s "%s"'
-        #!     %(tmp1, target_width, target_height, outfile))
-        cmd=('convert "%s" -resize %sx%s "%s"'
-             %(tmp1, target_width, target_height, outfile))
-        #print 'DBG: cmd="%s"'%(cmd,)
-        output = subprocess.check_output(cmd, shell=True)        
-        #!os.remove(tmp1)
-        
-        burn_caption(outfile)
+        try:
+            with run_metrics.file(infile).stage('metadata'):
+                md = jobs.get_metadata(infile)
+        except (OSError, ValueError) as ex:
+            print('ERROR: Could not read metadata from file "%s". SKIPPING\n%s'
+                  %(infile, ex))
+            bad_metadata_files.append(infile)
+            continue
+        sources.append((infile, outfile, md))
+
+    # Decide the framing of all files at once. Track infiles that were
+    # bad aspect. Report later so I have option to go back and hand crop them.
+    framing = planning.plan_records([os.path.abspath(f) for (f, o, md) in sources],
+                                    [md['width'] for (f, o, md) in sources],
+                                    [md['height'] for (f, o, md) in sources],
+                                    [(target_width, target_height)],
+                                    tolerance=tolerance, max_crop=max_crop)
+    if plan is not None:
+        framing = planning.apply_plan(framing, plan)
+    for ((infile, outfile, md), record) in zip(sources, framing):
+        if record['targets'][0]['bad_aspect']:
+            bad_aspect_files[infile] = record['aspect']
+        (root, fname) = os.path.split(infile)
+        tasks.append((len(tasks)+1, root, fname, md,
+                      [(0, outfile, planning.crop_box(record, 0))]))
+    if plan_out is not None:
+        planning.write_plan(plan_out, framing)
+        print('Wrote plan of %d files: %s'%(len(framing), plan_out))
+        tasks = list()
+
+    # Pad to desired aspect, resize and burn caption with a single
+    # decode and encode (replaces aspectpad + convert + burn_caption).
+    # The caption is the file's own (else DEFAULT), without the date.
+    job = supervise.Isolated(jobs.FrameJob(False,
+                                           [(target_width, target_height)],
+                                           draft, ttf=ttf, max_bytes=max_bytes,
+                                           encoding=encoding,
+                                           copy_metadata=copy_metadata,
+                                           default_caption=default))
+    if tasks:
+        os.makedirs(outdir, exist_ok=True)
+    if prefetch > 0:
+        # Overlap reading the next files and writing the previous ones
+        # with the image work.
+        results = pipeline.Pipeline(prefetch=prefetch,
+                                    writers=writers).map(job, tasks)
+    else:
+        results = map(job, tasks)
+    for ((infile, outfile, md), result) in zip(sources, results):
+        if isinstance(result, supervise.Failure):
+            # Outputs are written whole or not at all (jobs.write_file).
+            failed_files[infile] = '%s: %s'%result
+            print('FAILED (%s), no output: %s\n%s'
+                  %(result.reason, infile, result.detail))
+            continue
+        (fm, thumbnails) = result
+        run_metrics.add(fm)
     # All done.  Report
-    print 'Bad aspect in (%d) files'%(len(bad_aspect_files),)
+    print('Bad aspect in (%d) files'%(len(bad_aspect_files),))
     for f,a in bad_aspect_files.items():
-        print '  %.3f\t%.3f\t%s'%(abs(a-goalAspect),a,f) 
+        print('  %.3f\t%.3f\t%s'%(abs(a-goalAspect),a,f))
+    if len(bad_metadata_files) > 0:
+        print('Bad metadata in (%d) files (they were skipped)'
+              %(len(bad_metadata_files),))
+        print('\n'.join(bad_metadata_files))
+    if len(failed_files) > 0:
+        print('Failed on (%d) files (no output written)'%(len(failed_files),))
+        for f,r in failed_files.items():
+            print('  %s\t%s'%(f,r))
+    run_metrics.finish()
+    run_metrics.summary()
+    return len(tasks) - len(failed_files)
         
         
                 
@@ -119,33 +179,25 @@ def addCaption(jpgfile, outfile,
                target_width=800, target_height=600, 
                rejectBadAspect=True,
                #! only800x600=True, 
-               default=None
+               default=None,
+               draft=True,
+               encoding=None
                ):
-    print 'Image File="%s"'%(jpgfile,)
-    iptcLut = dict([(name,tag) for tag,name in iptcinfo.c_datasets.items()]) # name => tag
+    from PIL import Image # Only this (legacy) path needs PIL directly.
+
+    print('Image File="%s"'%(jpgfile,))
     orig = Image.open(jpgfile)
+    if draft and (target_width > 0):
+        # Let libjpeg decode at reduced (DCT) scale, still >= target size.
+        orig.draft('RGB', (target_width, target_height))
     #captionKey = (2,120) # called "description" in gThumb
-    #info = IptcImagePlugin.getiptcinfo(orig)
-    #!headlineKey = 105
-    #!captionKey = 120
-    info = None
-    try:
-        iptc = iptcinfo.IPTCInfo(jpgfile,
-                                 force=True,
-                                 reportScanError = False,
-                                 )
-        info = iptc.getData()
-    except Exception:
-        pass
-    im = orig.copy()
+    options = imaging.save_options(encoding, source=orig,
+                                   header=source_header(jpgfile))
+    # Decode in place; a copy would hold a second full-size image.
+    im = orig
     im.load()
-    #orig.close()
 
-    if not info:
-        logging.debug('No IPTC header in: %s',jpgfile)
-        caption = default
-    else:
-        caption = info.get(iptcLut['caption/abstract'],default)
+    caption = read_caption(jpgfile, default=default)
 
     if caption == None: 
         logging.debug('No caption for: %s',jpgfile)
@@ -172,7 +224,7 @@ def addCaption(jpgfile, outfile,
         
     if  (target_width > 0) and (width != target_width):
         print ('Resize image "%s"' % (jpgfile,))
-        im2 = im.resize((target_width,target_height),Image.ANTIALIAS)
+        im2 = im.resize((target_width,target_height),Image.LANCZOS)
         im = im2
 
 
@@ -182,25 +234,15 @@ def addCaption(jpgfile, outfile,
         # reduce image therby reducing caption size (possibly making
         # it too small to see clearly)
 
-        draw = ImageDraw.Draw(im)
-        font = ImageFont.truetype('/usr/share/fonts/truetype/msttcorefonts/arial.ttf',15)
-        font = ImageFont.truetype('/usr/share/fonts/truetype/msttcorefonts/arialbd.ttf',15)
-        (textW, textH) = draw.textsize(caption,font=font)
+        imaging.draw_caption(im, caption)
+        print('Burned caption: %s'%(caption,))
 
-        (width,height) = im.size
-        x = max(0,int(round((width-textW)/2)) )
-        y = height-textH
-        draw.rectangle([0,y-4,width,height],fill='gray')
-        draw.text((x,y),caption,font=font,fill='cornsilk')
-        print 'Burned caption: %s'%(caption,)
-
-    im.save(outfile)
+    im.save(outfile, 'JPEG', **options)
     return True
 
 def main():
-    #print 'EXECUTING: %s\n\n' % (string.join(sys.argv))
+    #print('EXECUTING: %s\n\n' % (' '.join(sys.argv)))
     parser = argparse.ArgumentParser(
-        version='1.0.2',
         description='''Add or burn caption into JPEG header/image. 
 This handles captions created by Picasa.''',
         epilog='''EXAMPLES: 
@@ -208,6 +250,7 @@ This handles captions created by Picasa.''',
   %(prog)s --twidth=800 --theight=600 --outdir /media/FC30-3DA9/wilderness.800 /home/data/pictures-exported/hiking-starred/wilderness/*
                '''
         )
+    parser.add_argument('--version', action='version', version='1.0.2')
     parser.add_argument('infiles',  help='Input files (jpg)', nargs='+')
 
     parser.add_argument('--outdir',  help='Directory in which to write input files with burned in captions',
@@ -226,14 +269,68 @@ This handles captions created by Picasa.''',
                         help='Do not copy image unless its aspect ratio is TWIDTH:THEIGHT)'
                         )
 
+    parser.add_argument('--maxCrop', type=float, default=0.0,
+                        help='Crop instead of padding a bad aspect image when that loses at most this share of its area'
+                        )
+    parser.add_argument('--planOnly', metavar='PLAN_FILE',
+                        help='Write the framing decisions to this file and the bad aspect report; make no images'
+                        )
+    parser.add_argument('--plan', metavar='PLAN_FILE',
+                        help='Frame the files listed in this (reviewed or edited) --planOnly file as it says'
+                        )
+
+    parser.add_argument('--noDraft', action='store_true',
+                        help='Decode JPEGs at full size before resizing (slower, pixel-exact)'
+                        )
+    parser.add_argument('--ttf', default=imaging.DEFAULT_TTF,
+                        help='TrueType font for captions. Default: %(default)s'
+                        )
+
+    parser.add_argument('--quality', type=int, default=75,
+                        help='JPEG quality of the output (1-95)'
+                        )
+    parser.add_argument('--subsampling', choices=imaging.SUBSAMPLINGS,
+                        help='Chroma subsampling of the output ("keep": as the source)'
+                        )
+    parser.add_argument('--progressive', action='store_true',
+                        help='Write progressive JPEGs'
+                        )
+    parser.add_argument('--optimize', action='store_true',
+                        help='Optimize the Huffman tables (smaller, slower)'
+                        )
+    parser.add_argument('--keepQtables', action='store_true',
+                        help='Reuse the quantization tables of the source (QUALITY is then not used)'
+                        )
+    parser.add_argument('--noCopyMetadata', action='store_true',
+                        help='Do not copy the IPTC caption and Exif dates into the output'
+                        )
+
+    parser.add_argument('--maxWorkerMem', type=int, default=None,
+                        help='Decode sources at a reduced scale so the work on each fits in this many MB'
+                        )
+
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Read up to this many files ahead of image work (0: no pipelining)'
+                        )
+    parser.add_argument('--writers', type=int, default=2,
+                        help='Concurrent output writers when PREFETCH > 0'
+                        )
+
+    parser.add_argument('--metricsJson',
+                        help='Write per-file, per-stage timings to this JSON file'
+                        )
+    parser.add_argument('--profile',
+                        help='Write cProfile stats of the run to this file'
+                        )
+
     parser.add_argument('--loglevel',      help='Kind of diagnostic output',
                         choices = ['CRTICAL','ERROR','WARNING','INFO','DEBUG'],
                         default='WARNING',
                         )
     args = parser.parse_args()
 
-    #!print 'My args=',args
-    #!print 'infile=',args.infile
+    #!print('My args=',args)
+    #!print('infile=',args.infile)
 
     log_level = getattr(logging, args.loglevel.upper(), None)
     if not isinstance(log_level, int):
@@ -247,7 +344,7 @@ This handles captions created by Picasa.''',
     #!fileCnt = 0
     #!totalFiles = len(args.infiles)
     #!for idx,infile in enumerate(args.infiles):
-    #!    print '\nImage File="%s" (%d/%d)'%(infile,idx,totalFiles)
+    #!    print('\nImage File="%s" (%d/%d)'%(infile,idx,totalFiles))
     #!    base = os.path.basename(infile)
     #!    outfile = os.path.join(args.outdir,base)
     #!    created =  addCaption(infile, outfile, 
@@ -260,13 +357,35 @@ This handles captions created by Picasa.''',
     #!    if created:
     #!        fileCnt += 1
 
-    addCaptionToFiles(args.infiles, args.outdir, 
-                      default=args.defaultCaption,
-                      target_width=args.twidth,
-                      target_height=args.theight
-                      )
+    run_metrics = metrics.RunMetrics()
+    with metrics.profiled(args.profile):
+        written = addCaptionToFiles(args.infiles, args.outdir, 
+                          default=args.defaultCaption,
+                          target_width=args.twidth,
+                          target_height=args.theight,
+                          draft=not args.noDraft,
+                          prefetch=args.prefetch,
+                          writers=args.writers,
+                          run_metrics=run_metrics,
+                          max_bytes=(None if args.maxWorkerMem is None
+                                     else args.maxWorkerMem*1024*1024),
+                          encoding=imaging.jpeg_encoding(
+                              quality=args.quality,
+                              subsampling=args.subsampling,
+                              progressive=args.progressive,
+                              optimize=args.optimize,
+                              keep_qtables=args.keepQtables),
+                          copy_metadata=not args.noCopyMetadata,
+                          max_crop=args.maxCrop,
+                          plan=(None if args.plan is None
+                                else planning.read_plan(args.plan)),
+                          plan_out=args.planOnly,
+                          ttf=args.ttf
+                          )
+    if args.metricsJson:
+        run_metrics.write_json(args.metricsJson)
 
-    print '\nWrote %d files into: %s'%(len(args.infiles), args.outdir)
+    print('\nWrote %d files into: %s'%(written, args.outdir))
 
 if __name__ == '__main__':
     main()
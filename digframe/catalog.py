@@ -0,0 +1,191 @@
+'''Catalog of (date, caption, file, directory, output) for a photo collection.
+
+OUTPUT is the basename of the frame image made from the file. Duplicate
+sources (see dedup) name the output they share.
+
+Rows are streamed to disk as they are produced (buffered, flushed at
+checkpoints) so a crashed run loses at most one checkpoint of rows.
+With append=True an existing catalog is extended, and files it already
+records are reported by has() so callers can skip them entirely.
+
+Formats:
+  csv     RFC 4180 quoting via the csv module (default)
+  jsonl   One JSON object per line
+  parquet Columnar; needs pyarrow (the "parquet" extra). Each
+          checkpoint is one row group.
+          Parquet has no append, so the file is only replaced on close().
+'''
+
+import io
+import os
+import os.path
+import csv
+import json
+
+FIELDS = ['Date', 'Caption', 'File', 'FullPath', 'Output']
+FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+def catalog_row(md, fname, root, output=None):
+    return dict(Date=str(md.get('date')),
+                Caption=md.get('caption',''),
+                File=fname,
+                FullPath=root,
+                Output=output or '')
+
+class CatalogWriter():
+    def __init__(self, filename, format='csv', append=False, checkpoint=500):
+        if format not in FORMATS:
+            raise ValueError('Unknown catalog format "{}". Use one of: {}'
+                             .format(format, ', '.join(FORMATS)))
+        if format == 'parquet':
+            _pyarrow() # Fail now, not once the rows are done.
+        self.name = filename
+        self.format = format
+        self.checkpoint_every = checkpoint
+        self.pending = 0
+        self.recorded = set() # {(FullPath, File), ...}
+        self.fields = FIELDS
+        exists = os.path.exists(filename) and os.path.getsize(filename) > 0
+        # Size of the catalog before any row of this run (see row_bytes).
+        self.start_bytes = len(_csv_line(FIELDS)) if format == 'csv' else 0
+        if append and exists:
+            self.start_bytes = os.path.getsize(filename)
+            self.recorded = set((r['FullPath'], r['File'])
+                                for r in read_catalog(filename, format))
+            if format == 'csv':
+                # Keep the columns of a catalog written by an older version.
+                self.fields = _csv_header(filename) or FIELDS
+        else:
+            append = False
+
+        if format == 'parquet':
+            self.file = None
+            self.columns = dict((f, list()) for f in FIELDS)
+            self.pqwriter = None
+            self.previous = read_catalog(filename, format) if append else []
+            return
+        self.file = open(filename, 'a' if append else 'w', newline='',
+                         encoding='utf-8')
+        if format == 'csv':
+            self.csv = csv.writer(self.file)
+            if not append:
+                self.csv.writerow(FIELDS)
+
+    def has(self, root, fname):
+        return (root, fname) in self.recorded
+
+    def row_bytes(self, md, fname, root, output=None):
+        '''RETURNS: bytes write() would add to the file (the csv size for
+parquet, which only compresses it).'''
+        if self.has(root, fname):
+            return 0
+        row = catalog_row(md, fname, root, output=output)
+        if self.format == 'jsonl':
+            return len((json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8'))
+        return len(_csv_line([row.get(f, '') for f in self.fields]))
+
+    def write(self, md, fname, root, output=None):
+        '''Add a row unless the file is already recorded.
+RETURNS: True iff a row was added.'''
+        if self.has(root, fname):
+            return False
+        self.recorded.add((root, fname))
+        row = catalog_row(md, fname, root, output=output)
+        if self.format == 'csv':
+            self.csv.writerow([row.get(f, '') for f in self.fields])
+        elif self.format == 'jsonl':
+            self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        else:
+            for f in FIELDS:
+                self.columns[f].append(row[f])
+        self.pending += 1
+        if self.pending >= self.checkpoint_every:
+            self.checkpoint()
+        return True
+
+    def checkpoint(self):
+        '''Make every row written so far durable.'''
+        if self.format == 'parquet':
+            self._write_row_group()
+        else:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.checkpoint()
+        if self.file is not None:
+            self.file.close()
+        elif self.pqwriter is not None:
+            self.pqwriter.close()
+            os.replace(self.tmpname, self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _write_row_group(self):
+        pa, pq = _pyarrow()
+        if self.pqwriter is None:
+            schema = pa.schema([(f, pa.string()) for f in FIELDS])
+            # Parquet files cannot be appended to; rewrite prior rows first.
+            tmp = self.name + '.tmp'
+            self.pqwriter = pq.ParquetWriter(tmp, schema)
+            self.tmpname = tmp
+            if self.previous:
+                self.pqwriter.write_table(pa.Table.from_pylist(self.previous,
+                                                               schema=schema))
+            self.previous = []
+        if len(self.columns[FIELDS[0]]) > 0:
+            self.pqwriter.write_table(pa.table(self.columns))
+            self.columns = dict((f, list()) for f in FIELDS)
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet catalogs need the "pyarrow" package')
+    return pyarrow, pyarrow.parquet
+
+def _csv_line(values):
+    '''RETURNS: VALUES as a csv line, UTF-8 encoded.'''
+    out = io.StringIO()
+    csv.writer(out).writerow(values)
+    return out.getvalue().encode('utf-8')
+
+def _fields(header):
+    '''RETURNS: field names of a csv catalog with HEADER (its first row).
+The first catalogs wrote "Date, Caption, ..." (with spaces); a header of
+other names is taken as the first of FIELDS, by position.'''
+    fields = [name.strip() for name in header]
+    if set(fields) <= set(FIELDS):
+        return fields
+    return FIELDS[:len(fields)]
+
+def _csv_header(filename):
+    with open(filename, newline='', encoding='utf-8') as f:
+        header = next(csv.reader(f), None)
+    return _fields(header) if header else None
+
+def read_catalog(filename, format='csv'):
+    '''RETURNS: list of row dicts (keys are FIELDS; Output may be missing
+from catalogs written before it existed).'''
+    if format == 'parquet':
+        pa, pq = _pyarrow()
+        return pq.read_table(filename).to_pylist()
+    with open(filename, newline='', encoding='utf-8') as f:
+        if format == 'jsonl':
+            return [json.loads(line) for line in f if line.strip()]
+        reader = csv.reader(f)
+        header = next(reader, None)
+        fields = _fields(header) if header else FIELDS
+        rows = [r for r in reader if len(r) >= len(fields)]
+        if header and header != [name.strip() for name in header]:
+            # "a, b" in the first catalogs; later ones keep such spaces.
+            rows = [[v[1:] if v.startswith(' ') else v for v in r] for r in rows]
+        return [dict(zip(fields, r)) for r in rows]
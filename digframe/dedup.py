@@ -0,0 +1,145 @@
+'''Find duplicate source photos before they are processed.
+
+Exact duplicates have the same compressed image data. Only the data
+from the first SOS marker on is hashed, so copies whose Exif or IPTC
+segments were edited still match. Callers put whatever else matters to
+the output (the caption, say) in the group key. Large files are
+sampled: the length plus SAMPLE bytes from the start, middle and end
+of the scan data. xxhash is used when installed, else BLAKE2.
+
+Near duplicates (optional) are found with a 64 bit difference hash
+(dHash) of a tiny (1/8 scale) decode. Hashes within a Hamming distance
+count as the same photo. They are looked up in a NearIndex, so a hash
+is only compared with the few that could be that close.
+'''
+
+import struct
+import hashlib
+from collections import defaultdict
+
+from PIL import Image
+
+from digframe import imaging
+from digframe import metadata
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+SAMPLE = 64*1024
+MODES = ['exact', 'near']
+
+
+def _hasher():
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+def content_hash(filename):
+    '''RETURNS: hex digest of the (sampled) JPEG scan data of FILENAME.'''
+    with open(filename, 'rb') as f:
+        start = metadata.scan_offset(f)
+        f.seek(0, 2)
+        end = f.tell()
+        h = _hasher()
+        h.update(struct.pack('>Q', end - start))
+        if end - start <= 3*SAMPLE:
+            f.seek(start)
+            h.update(f.read())
+        else:
+            for offset in (start, start + (end-start-SAMPLE)//2, end-SAMPLE):
+                f.seek(offset)
+                h.update(f.read(SAMPLE))
+    return h.hexdigest()
+
+def dhash(filename, hash_size=8):
+    '''RETURNS: difference hash of FILENAME as an int of HASH_SIZE**2 bits.'''
+    im = Image.open(filename)
+    imaging.draft_to(im, (hash_size+1, hash_size))
+    im = im.convert('L').resize((hash_size+1, hash_size), Image.BILINEAR)
+    px = list(im.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            i = row*(hash_size+1) + col
+            bits = (bits << 1) | (px[i] > px[i+1])
+    return bits
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+if hasattr(int, 'bit_count'): # Python 3.10+
+    def hamming(a, b):
+        return (a ^ b).bit_count()
+
+class NearIndex():
+    '''Hashes of BITS bits, found again within DISTANCE bits by
+multi-index hashing: the bits are split into DISTANCE+1 bands, and two
+hashes that close are equal in at least one band. Only hashes that
+share a band with the one looked up are compared.'''
+    def __init__(self, distance, bits=64):
+        self.distance = distance
+        count = min(distance + 1, bits)
+        bounds = [bits*b//count for b in range(count + 1)]
+        self.bands = [(lo, (1 << (hi - lo)) - 1)
+                      for (lo, hi) in zip(bounds, bounds[1:])]
+        self.tables = [defaultdict(list) for band in self.bands]
+        self.hashes = list() # [(hash, value), ...] in the order added
+
+    def add(self, h, value):
+        n = len(self.hashes)
+        self.hashes.append((h, value))
+        for ((shift, mask), table) in zip(self.bands, self.tables):
+            table[(h >> shift) & mask].append(n)
+
+    def find(self, h):
+        '''RETURNS: value of the first added hash within DISTANCE bits of
+H, or None.'''
+        best = None
+        for ((shift, mask), table) in zip(self.bands, self.tables):
+            for n in table.get((h >> shift) & mask, ()):
+                if best is not None and n >= best:
+                    break # Lists are in the order added.
+                if hamming(h, self.hashes[n][0]) <= self.distance:
+                    best = n
+                    break
+        return None if best is None else self.hashes[best][1]
+
+def find_duplicates(files, mode='exact', near_distance=6):
+    '''FILES: list of (filename, key) in order of preference. Only files
+with equal KEY can be duplicates of each other.
+MODE: "exact" (same scan data) or "near" (exact, then dHash within
+NEAR_DISTANCE bits).
+RETURNS: dict[index] => index of the earlier file it duplicates.'''
+    if mode not in MODES:
+        raise ValueError('Unknown dedup mode "{}". Use one of: {}'
+                         .format(mode, ', '.join(MODES)))
+    dupes = dict()
+    first = dict() # d[(key, content_hash)] => index
+    for i, (filename, key) in enumerate(files):
+        try:
+            h = (key, content_hash(filename))
+        except OSError:
+            continue
+        if h in first:
+            dupes[i] = first[h]
+        else:
+            first[h] = i
+    if mode == 'near':
+        kept = dict() # d[key] => NearIndex of (dhash, index)
+        for i, (filename, key) in enumerate(files):
+            if i in dupes:
+                continue
+            try:
+                d = dhash(filename)
+            except (OSError, ValueError):
+                continue
+            if key not in kept:
+                kept[key] = NearIndex(near_distance)
+            j = kept[key].find(d)
+            if j is not None:
+                dupes[i] = j
+            else:
+                kept[key].add(d, i)
+    return dupes
@@ -2,6 +2,7 @@
 '''Use metadata from JPEG files to modify filename and image content
 to make images more suitable for Digital Frame or screensaver.
 Resulting filenames will sort alphabetically so they are in ascending datetime (of digitizing) order.
+With --sequence they are numbered in that order instead (see ordering.py).
 Resulting images will contain:
 - Year digitized
 - Caption (if one exists, can be added with Picasa)
@@ -16,9 +17,9 @@ EXAMPLES:
   # digitial frame NIX x15a 
   gen_for_df.py ~/Desktop/river-15 ~/Desktop/river.1024
 
-TODO:
-  - Truncate and report long captions. Total max chars=148.
-    But write full captions to catalog.
+Captions are wrapped and, if still too long, cut to fit the frame
+(see layout.py). The report lists the cut ones; the catalog has them
+in full.
 
 
 '''
@@ -28,171 +29,1055 @@ import string
 import argparse
 import logging
 import os
-from glob import glob
+import json
+import time
+import copy
 
-import datetime as dt
-import subprocess
-from  PIL import Image, ImageDraw,  ImageFont
+import concurrent.futures
 
+from digframe import imaging
+from digframe import metadata
+from digframe import mdcache
+from digframe import manifest
+from digframe import catalog
+from digframe import pipeline
+from digframe import metrics
+from digframe import scanner
+from digframe import dedup
+from digframe import planning
+from digframe import ordering
+from digframe import layout
+from digframe import thumbs
+from digframe import watch
+from digframe import shards
+from digframe import supervise
+from digframe import jobs
 
-def get_metadata(filename):
-    cmd=(R'identify -format "dict('
-         'width=%w, height=%h, '
-         'caption=###%[IPTC:2:120]###, '
-         'date=\\"%[EXIF:DateTimeDigitized]\\" )" "{}"')
-    #!print('DBG-1: filename={}, cmd={}'.format(filename, cmd))
-    out = bytes.decode(subprocess.check_output(cmd.format(filename), shell=True))
+# Seconds between manifest saves during a run, so a killed run loses at
+# most this much of its record of what it built.
+CHECKPOINT_SECONDS = 30
+# Sources (the newest) encoded at the lowest quality to find how small a
+# frame can get, when the cap on each is derived from --byte_budget.
+PROBE_SOURCES = 3
 
 
-
-    dictstr = out.replace("'","\\'").replace("###","'")
-    #!print('DBG-2: out={}, dictstr={}'.format(out, dictstr))
-    md = eval(dictstr)
-    #!print('DBG-3: md={}'.format(md))
-    
-    # parse: 2007:11:21 11:27:06
-    try:
-        md['date'] = dt.datetime.strptime(md['date'],'%Y:%m:%d %H:%M:%S')
-    except:
-        md['date'] = dt.datetime(1900,1,1)
-    return md
-
 def burn_caption(outfile, digitizedDate,
-                 ttf='/usr/share/fonts/truetype/msttcorefonts/arialbd.ttf',
+                 ttf=imaging.DEFAULT_TTF,
                  caption='',
-                 maxCapLen=148):
+                 maxCapLen=None,
+                 encoding=None):
     #!print('EXECUTE burn_caption({}, {}, caption={}'
     #!      .format(outfile, digitizedDate,caption))
 
-    im = Image.open(outfile)
-    if digitizedDate and digitizedDate.year != 1900:
-        if (caption == '' ):
-            # use digitized date/time for caption
-            caption = digitizedDate.strftime('%a %m/%d/%Y %M:%H:%S')
-        else:
-            # prepend digitized year to caption
-            caption = '{}: {}'.format(digitizedDate.strftime('%m/%d/%y'), caption)
-        
+    captxt = metadata.caption_text(digitizedDate, caption, maxCapLen=maxCapLen)
     # Burn text at bottom/center of image 
-    draw = ImageDraw.Draw(im)
-    font = ImageFont.truetype(ttf,15)
-    captxt = caption if len(caption) <= maxCapLen else caption[:maxCapLen-3]+'...'
-    (textW, textH) = draw.textsize(captxt,font=font)
-
-    (width,height) = im.size
-    x = max(0,int(round((width-textW)/2)) )
-    y = height-textH
-    draw.rectangle([0,y-4,width,height],fill='gray')
-    draw.text((x,y),captxt,font=font,fill='cornsilk')
-    im.save(outfile)
-
-def write_catalog_rec(md, fname, root, catalog_file):
-    print('{},"{}","{}","{}"'.format(md.get('date'),
-                                     md.get('caption',''),
-                                     fname,
-                                     root),
-          file=catalog_file)
-
-def write_catalog(indir, catalog_file, verbose=True):
+    imaging.burn_caption_file(outfile, captxt, ttf=ttf, encoding=encoding)
+
+def write_catalog_rec(md, fname, root, catalog_writer, output=None):
+    return catalog_writer.write(md, fname, root, output=output)
+
+def write_catalog(indir, catalog_writer, verbose=True, cache=None,
+                  scan_options=None, run_metrics=None):
+    '''Write a catalog record for every JPG under INDIR. Files CATALOG_WRITER
+already records (when appending) are skipped without reading them.
+SCAN_OPTIONS are keyword arguments for scanner.scan.
+RUN_METRICS (a metrics.RunMetrics) collects per-file stage timings.'''
+    if run_metrics is None:
+        run_metrics = metrics.RunMetrics()
+    if not os.path.isdir(indir):
+        raise ValueError('Input directory "{}" does not exist'.format(indir))
     file_cnt=1
-    cname = catalog_file.name
-    print('Date, Caption, File, FullPath', file=catalog_file)
-    for root, dirs, files in os.walk(indir):
-        for fname in files:
-            if fname.lower().endswith('jpg'):
-                file_cnt += 1
-                infile = os.path.join(root,fname)
-                try:
-                    md = get_metadata(infile)
-                except Exception as ex:
-                    print('WARNING: Could not read metadata from file "{}".\n{}'
-                          .format(fname, ex))
-                    continue
-                except subprocess.CalledProcessError as cpe:
-                    print('WARNING: Could not read metadata from file "{}". \n'
-                          '  {} => {}\n  {}'
-                          .format(fname, cmd, cpe.returncode, cpe.output))
-                    continue
-
-                if verbose:
-                    print('[{}] Write record for {} to {}'
-                          .format(file_cnt,fname,cname))
-                write_catalog_rec(md, fname, root, catalog_file)
-                
-def burn_dir(indir, outdir, catalog_file, date_in_caption,
-                      # for digitial frame with 4:3 aspect ratio
-                      target_width=800, target_height=600, 
-                      tolerance=0.01):
-    goalAspect = float(target_width)/target_height
-    bad_aspect_files = dict() # d[filename] => aspect
-    bad_metadata_files = set()
-    file_cnt=0
-
-    print('Date, Caption, File, FullPath', file=catalog_file)
-    for root, dirs, files in os.walk(indir):
-        for fname in files:
-            if fname.lower().endswith('jpg'):
-                file_cnt += 1
-                xformbase = fname.replace(' ','_').replace('(Modified)','_modified_')
-                pathname = os.path.join(outdir,'*T*-{}'.format(xformbase))
-                if len(glob(pathname)) > 0:
-                    print('[{}] Not replacing existing file: {}'
-                          .format(file_cnt-1, os.path.join(outdir, xformbase)))
-                    continue
-                try:
-                    md = get_metadata(os.path.join(root,fname))
-                except Exception as ex:
-                    print('ERROR: Could not read metadata from file "{}". SKIPPING\n{}'
-                          .format(fname, ex))
-                    bad_metadata_files.add(fname)
-                    continue
-
-                stamp = md['date'].strftime('%Y%m%dT%H%M%S')
-                newbase='{}-{}'.format(stamp, xformbase)
-                newfile=os.path.join(outdir, newbase)
-                #!if os.path.exists(newfile):
-                #!    print('[{}] Not replacing existing file: {}'
-                #!          .format(file_cnt-1, newfile))
-                #!    continue
-
-                infile = os.path.join(root,fname)
-
-                write_catalog_rec(md, fname, root, catalog_file)
-
-                thisAspect = float(md['width'])/md['height']
-                if abs(thisAspect - goalAspect) > tolerance:
-                    bad_aspect_files[infile] = thisAspect
-
-                #######
-                # make outfile fit desired aspect
-                tmp1 = os.path.join('/tmp', newbase)                    
-                cmd=('aspectpad -a {} -m l "{}" "{}"'
-                     .format(float(target_width)/target_height, infile, tmp1))
-                subprocess.check_output(cmd, shell=True)
-                cmd=('convert "{}" -resize {}x{} "{}"'
-                     .format(tmp1, target_width, target_height, newfile))
-                subprocess.check_output(cmd, shell=True)
-
-                digdate = md['date'] if date_in_caption else False
-                burn_caption(newfile,  digdate, caption=md['caption'])
-                print('[{}] Wrote file: {}'.format(file_cnt-1, newfile))
+    cname = catalog_writer.name
+    seen = list()
+    scan_errors = list()
+    for entry in scanner.scan(indir, errors=scan_errors, **(scan_options or {})):
+        (infile, root, fname) = (entry.path, entry.root, entry.name)
+        file_cnt += 1
+        seen.append(infile)
+        if catalog_writer.has(root, fname):
+            continue
+        fm = run_metrics.file(infile)
+        try:
+            with fm.stage('metadata'):
+                md = jobs.get_metadata(infile, cache=cache,
+                                  stat=(entry.size, entry.mtime_ns))
+        except Exception as ex:
+            print('WARNING: Could not read metadata from file "{}".\n{}'
+                  .format(fname, ex))
+            continue
 
+        if verbose:
+            print('[{}] Write record for {} to {}'
+                  .format(file_cnt,fname,cname))
+        with fm.stage('catalog'):
+            write_catalog_rec(md, fname, root, catalog_writer)
+    if cache is not None and not scan_errors:
+        cache.prune(indir, seen)
                 
+def xform_basename(fname):
+    return fname.replace(' ','_').replace('(Modified)','_modified_')
+
+def frame_basename(md, xformbase):
+    stamp = md['date'].strftime('%Y%m%dT%H%M%S')
+    return '{}-{}'.format(stamp, xformbase)
+
+def xformbase_of(newbase):
+    '''Inverse of frame_basename. RETURNS: None if not one of our outputs.'''
+    if len(newbase) > 16 and newbase[8] == 'T' and newbase[15] == '-':
+        return newbase[16:]
+    return None
+
+class BurnOptions():
+    '''Settings of burn_dir (and of burn_queue and watch_dir, which pass
+them on).
+TARGETS is a list of (width, height, outdir); when given it replaces
+TARGET_WIDTH, TARGET_HEIGHT and the OUTDIR of burn_dir. Each source is
+decoded once for all targets. Metadata and the catalog are shared.
+TOLERANCE: aspect difference reported as bad (see planning.py).
+JOBS worker processes make the images; PREFETCH > 0 selects the staged
+pipeline with WRITERS output writers (see task_executor).
+CACHE is an optional mdcache.MetadataCache consulted before the files.
+TTF is the TrueType font of the captions.
+SCAN_OPTIONS are keyword arguments for scanner.scan.
+MAX_WORKER_BYTES bounds the (estimated) memory one worker uses for one
+image; big sources are decoded at a reduced scale to fit, and no more
+than JOBS workers' worth is in flight at once.
+DEDUP_MODE ("exact" or "near", see dedup.find_duplicates) builds one output
+for each set of duplicate sources with the same caption (NEAR_DISTANCE
+bits apart at most); the catalog lists every source with the output it
+shares.
+ENCODING (see imaging.jpeg_encoding) sets the output JPEG options.
+COPY_METADATA writes the source caption and Exif dates into each frame.
+SHARD (index, count) limits the run to the files of that shard (see
+shards.py). WORKER_ID names this process's manifest in the output
+directories when several processes share them.
+Before any pixel work, the framing (pad or crop, and geometry) of all
+sources is decided at once from their header sizes (see planning.py).
+MAX_CROP: crop instead of pad when that loses at most this share of the
+picture area. PLAN (from planning.read_plan) overrides those decisions
+for the files it lists. PLAN_OUT: write the plan to this file and stop
+without building anything.
+THUMB_WIDTH: keep a thumbnail index (see thumbs.py) of this width in
+each output directory, filled from the frames as they are made (0 or
+None: no index).
+IMAGE_BYTES: encode each output to at most this many bytes, at the
+highest quality (up to ENCODING's) that fits; see
+imaging.encode_jpeg_to_size. An output that does not fit even at the
+lowest quality is left out.
+BYTE_BUDGET: the outputs in each output directory take at most this
+many bytes. The newest sources (by digitized date) that fit with
+IMAGE_BYTES each get an output; the rest are left out (and their
+earlier outputs removed), except that the room left once the outputs
+are written (smaller than IMAGE_BYTES, or left out over it) goes to the
+newest of them that fit. Without IMAGE_BYTES each gets an equal share
+of BYTE_BUDGET (less the manifest, thumbnail index and catalog), and as
+many are kept as can each get a share no smaller than the newest ones
+take at the lowest quality; ValueError if not even one can. Outputs
+already under the share are kept as they are.
+A file whose image work fails gets a catalog row but no output, and the
+run goes on. FILE_TIMEOUT (seconds) and FILE_MEMORY (bytes) limit the
+image work of each file; it then runs in watched worker processes (see
+supervise.py), even with one job.
+RETRY_LIST (a supervise.RetryList) gets the files that failed; files it
+holds are skipped (as quarantined) unless they changed.
+SEQUENCE names the outputs by their place in date order instead of by
+date stamp (see ordering.py); PER_DIR (implies SEQUENCE) puts them in
+numbered subdirectories of that many. This orders the whole set, so it
+needs the whole of INDIR (not ENTRIES or SHARD).'''
+    def __init__(self, targets=None,
+                 # for digitial frame with 4:3 aspect ratio
+                 target_width=800, target_height=600,
+                 tolerance=0.01, jobs=1, draft=True, cache=None,
+                 prefetch=0, writers=2, ttf=imaging.DEFAULT_TTF,
+                 scan_options=None, max_worker_bytes=None,
+                 dedup_mode=None, near_distance=6,
+                 encoding=None, copy_metadata=True,
+                 shard=None, worker_id=None,
+                 max_crop=0.0, plan=None, plan_out=None,
+                 thumb_width=96, image_bytes=None, byte_budget=None,
+                 file_timeout=None, file_memory=None, retry_list=None,
+                 sequence=False, per_dir=None):
+        self.targets = targets
+        self.target_width = target_width
+        self.target_height = target_height
+        self.tolerance = tolerance
+        self.jobs = jobs
+        self.draft = draft
+        self.cache = cache
+        self.prefetch = prefetch
+        self.writers = writers
+        self.ttf = ttf
+        self.scan_options = scan_options
+        self.max_worker_bytes = max_worker_bytes
+        self.dedup_mode = dedup_mode
+        self.near_distance = near_distance
+        self.encoding = encoding
+        self.copy_metadata = copy_metadata
+        self.shard = shard
+        self.worker_id = worker_id
+        self.max_crop = max_crop
+        self.plan = plan
+        self.plan_out = plan_out
+        self.thumb_width = thumb_width
+        self.image_bytes = image_bytes
+        self.byte_budget = byte_budget
+        self.file_timeout = file_timeout
+        self.file_memory = file_memory
+        self.retry_list = retry_list
+        self.sequence = sequence
+        self.per_dir = per_dir
+
+    def replace(self, **changes):
+        '''RETURNS: a copy with CHANGES (keyword arguments as for
+__init__) applied.'''
+        return BurnOptions(**dict(vars(self), **changes))
+
+def burn_options(options=None, **settings):
+    '''RETURNS: OPTIONS (a BurnOptions; None: the defaults) with SETTINGS
+(BurnOptions keyword arguments) applied.'''
+    return (options or BurnOptions()).replace(**settings)
+
+def burn_dir(indir, outdir, catalog_writer, date_in_caption, options=None,
+             run_metrics=None, entries=None, removed=None, outputs=None,
+             **settings):
+    '''Make a frame image of every JPEG under INDIR in OUTDIR, and a
+catalog row for each with CATALOG_WRITER. OPTIONS (a BurnOptions, with
+SETTINGS applied, see burn_options) says how.
+RUN_METRICS (a metrics.RunMetrics) collects per-file stage timings;
+a timing summary is printed at the end either way.
+ENTRIES (scanner.ScanEntry, e.g. from watch.changes) limits the run to
+those files instead of scanning INDIR; outputs of the REMOVED source
+paths are then deleted.
+OUTPUTS: a dict the caller keeps across calls on the same output
+directories (e.g. one per leased chunk); the manifests and thumbnail
+indexes are then loaded on the first call only.
+RETURNS: report dict(targets=[dict(width, height, tolerance,
+bad_aspect={file: aspect})], bad_metadata=[file], duplicates=count,
+left_out=[file], truncated_captions={file: caption},
+failed={file: reason}, quarantined=[file]).'''
+    options = burn_options(options, **settings)
+    if not os.path.isdir(indir):
+        raise ValueError('Input directory "{}" does not exist'.format(indir))
+    if run_metrics is None:
+        run_metrics = metrics.RunMetrics()
+    targets = options.targets
+    if targets is None:
+        targets = [(options.target_width, options.target_height, outdir)]
+    run = _DirRun(indir, catalog_writer, date_in_caption, targets, options,
+                  run_metrics, {} if outputs is None else outputs)
+    run.read_sources(entries)
+    run.plan_framing()
+    run.select_for_budget()
+    if options.plan_out is not None:
+        report = run.write_plan()
+        print_report(report, written=False)
+        return report
+    run.remove_stale_outputs(removed)
+    run.find_duplicates()
+    run.name_outputs()
+    run.plan_tasks()
+    try:
+        run.build()
+    finally:
+        run.save()
+
     # All done.  Report
-    if len(bad_aspect_files) > 0:
-        print('Bad aspect in {} files. All written anyhow. '
-              'Goal aspect={} tolerance={}'
-              .format(len(bad_aspect_files), goalAspect, tolerance))
-        print('Diff\tAct\tFilename')
-        for f,a in bad_aspect_files.items():
-            print('  {0:.3f}\t{1:.3f}\t{2}'.format(abs(a-goalAspect),a,f))
+    report = run.report()
+    print_report(report)
+    if (options.byte_budget and run.sources
+        and not any(build.recorded_outputs() for build in run.builds)):
+        print('WARNING: No frame fits in the byte budget of {} bytes'
+              .format(options.byte_budget))
+    run_metrics.finish()
+    if run.whole_tree or run_metrics.files:
+        run_metrics.summary()
+    return report
+
+class _DirRun():
+    '''One burn_dir call. Its steps are the methods, in the order burn_dir
+calls them; each leaves what the next ones need in attributes. Sources
+are numbered by their place in SOURCES (PI below).'''
+    def __init__(self, indir, catalog_writer, date_in_caption, targets,
+                 options, run_metrics, outputs):
+        self.indir = indir
+        self.catalog_writer = catalog_writer
+        self.targets = targets
+        self.sizes = [(w, h) for (w, h, d) in targets]
+        self.options = options
+        self.run_metrics = run_metrics
+        # Manifests and indexes load (and list OUTDIR) once per OUTPUTS.
+        if 'builds' not in outputs:
+            outputs['builds'] = [manifest.Manifest(
+                d, name=manifest.manifest_name(options.worker_id))
+                                 for (w, h, d) in targets]
+            outputs['indexes'] = [None]*len(targets)
+            if options.thumb_width:
+                outputs['indexes'] = [thumbs.ThumbIndex(
+                    d, thumbs.thumb_size(w, h, options.thumb_width),
+                    name=thumbs.index_name(options.worker_id))
+                                      for (w, h, d) in targets]
+        (self.builds, self.indexes) = (outputs['builds'], outputs['indexes'])
+        # Outputs from before there was a manifest. d[xformbase] => newbase
+        self.legacies = [build.untracked_outputs(xformbase_of)
+                         for build in self.builds]
+        self.job = jobs.FrameJob(date_in_caption, self.sizes, options.draft,
+                           ttf=options.ttf, max_bytes=options.max_worker_bytes,
+                           encoding=options.encoding,
+                           copy_metadata=options.copy_metadata,
+                           thumb_sizes=(None if not options.thumb_width
+                                        else [index.size
+                                              for index in self.indexes]))
+        # Options added to the signature only when not the default, so
+        # outputs of older runs stay up to date.
+        self.sig_options = dict(draft=options.draft)
+        if (options.encoding is not None
+            and options.encoding != imaging.DEFAULT_ENCODING):
+            self.sig_options['encoding'] = options.encoding
+        if not options.copy_metadata:
+            self.sig_options['copy_metadata'] = False
+        self.bad_aspect_files = [dict() for t in targets] # d[filename] => aspect
+        self.bad_metadata_files = list()
+        self.left_out_files = list()
+        self.truncated_captions = dict() # d[filename] => caption
+        self.failed_files = dict() # d[filename] => reason
+        self.quarantined_files = list()
+        self.left_out = set() # PIs of sources that get no output
+        self.dupes = dict() # d[PI] => PI of the source whose output it shares
+        self.over_cap = set() # PIs of sources with no output under IMAGE_BYTES
+        self.derived_cap = False
+
+    def read_sources(self, entries):
+        '''Read the metadata of ENTRIES (None: all of INDIR) into SOURCES,
+a list of (file_cnt, entry, md). SEEN gets the path of every file.'''
+        options = self.options
+        self.sources = list()
+        self.seen = list()
+        self.scan_errors = list()
+        # Metadata is read as the scanner streams entries, while it is
+        # still listing the rest of the tree. It is read here (not in
+        # workers) so CACHE has a single user.
+        self.whole_tree = entries is None
+        if self.whole_tree:
+            entries = scanner.scan(self.indir, errors=self.scan_errors,
+                                   **(options.scan_options or {}))
+        file_cnt = 0
+        for entry in entries:
+            (infile, root, fname) = (entry.path, entry.root, entry.name)
+            if options.shard is not None and not shards.in_shard(
+                    os.path.relpath(infile, self.indir), options.shard):
+                continue
+            file_cnt += 1
+            source = os.path.abspath(infile)
+            self.seen.append(source)
+            if (options.retry_list is not None
+                and options.retry_list.holds(source, entry.size,
+                                             entry.mtime_ns)):
+                print('Skipping quarantined file (failed before): {}'
+                      .format(infile))
+                self.quarantined_files.append(infile)
+                continue
+            try:
+                with self.run_metrics.file(infile).stage('metadata'):
+                    md = jobs.get_metadata(infile, cache=options.cache,
+                                      stat=(entry.size, entry.mtime_ns))
+            except Exception as ex:
+                print('ERROR: Could not read metadata from file "{}". SKIPPING\n{}'
+                      .format(fname, ex))
+                self.bad_metadata_files.append(infile)
+                continue
+            self.sources.append((file_cnt, entry, md))
+
+        if self.scan_errors and (options.byte_budget or options.sequence
+                                 or options.per_dir):
+            raise ValueError('Could not list all of {} (first error: {}); a '
+                             'byte budget or sequence names need the whole set'
+                             .format(self.indir, self.scan_errors[0]))
+
+    def select_for_budget(self):
+        '''With a byte budget, put the sources that do not fit in
+LEFT_OUT, and set the cap on each image.'''
+        options = self.options
+        (sources, image_bytes) = (self.sources, options.image_bytes)
+        self.derived_cap = bool(options.byte_budget and not image_bytes)
+        if options.byte_budget:
+            # The manifest, thumbnail index and catalog take their share
+            # of the budget too.
+            overheads = [budget_overhead(sources, w, h, build, index,
+                                         self.catalog_writer, self.job,
+                                         self.sig_options)
+                         for ((w, h, d), build, index)
+                         in zip(self.targets, self.builds, self.indexes)]
+            newest = sorted(range(len(sources)), key=lambda i: sources[i][1].path)
+            newest.sort(key=lambda i: sources[i][2]['date'], reverse=True)
+            (self.overheads, self.newest) = (overheads, newest)
+            if not image_bytes:
+                (count, image_bytes) = self.derive_cap(newest, overheads)
+            else:
+                # Only the newest sources that fit at IMAGE_BYTES each
+                # are built.
+                used = [fixed + sum(rows) for (fixed, rows, kept) in overheads]
+                count = 0
+                for i in newest:
+                    used = [u + image_bytes + kept[i]
+                            for (u, (fixed, rows, kept)) in zip(used, overheads)]
+                    if max(used) > options.byte_budget:
+                        break
+                    count += 1
+            self.left_out = set(newest[count:])
+        # A cap derived from the budget changes with every photo added; it
+        # is left out of the signature and only outputs over it are rebuilt.
+        if self.derived_cap:
+            self.sig_options['fit_budget'] = True
+        elif image_bytes:
+            self.sig_options['image_bytes'] = image_bytes
+        self.image_bytes = image_bytes
+        self.job.image_bytes = image_bytes
+
+    def derive_cap(self, newest, overheads):
+        '''RETURNS: (count, image_bytes): the first COUNT of NEWEST (source
+numbers, newest first) are built, each capped at IMAGE_BYTES, their
+share of the budget less OVERHEADS (from budget_overhead). COUNT is as
+many as can each get what a frame takes at the lowest quality (see
+lowest_bytes). Raises ValueError when not even one can.'''
+        budget = self.options.byte_budget
+        floor = self.lowest_bytes(newest[:PROBE_SOURCES])
+        (count, image_bytes) = (0, 1)
+        room = [budget - fixed - sum(rows) for (fixed, rows, kept) in overheads]
+        for (n, i) in enumerate(newest, 1):
+            room = [r - kept[i] for (r, (fixed, rows, kept)) in zip(room, overheads)]
+            share = min(room) // n
+            if share < max(1, floor):
+                break
+            (count, image_bytes) = (n, share)
+        if newest and not count:
+            overhead = max(fixed + sum(rows) + kept[newest[0]]
+                           for (fixed, rows, kept) in overheads)
+            raise ValueError(
+                'A byte budget of {} bytes cannot hold a single frame: the '
+                'manifest, thumbnail index and catalog take {} bytes and a '
+                'frame about {} bytes at the lowest JPEG quality'
+                .format(budget, overhead, floor))
+        return (count, image_bytes)
+
+    def lowest_bytes(self, pis):
+        '''RETURNS: the size of the largest frame of the sources PIS
+encoded at the lowest quality (0 if none could be made). Nothing is
+written.'''
+        job = copy.copy(self.job)
+        job.encoding = imaging.lowest_encoding(self.job.encoding)
+        (job.image_bytes, job.thumb_sizes) = (None, None)
+        job = supervise.Isolated(job)
+        largest = 0
+        for pi in pis:
+            (cnt, entry, md) = self.sources[pi]
+            task = (cnt, entry.root, entry.name, md,
+                    [(ti, None, planning.crop_box(self.framing[pi], ti))
+                     for ti in range(len(self.targets))])
+            staged = job.transform(task, job.read(task))
+            if not isinstance(staged, supervise.Failure):
+                (fm, datas) = staged
+                largest = max([largest] + [len(data) for data in datas])
+        return largest
+
+    def plan_framing(self):
+        '''Decide the framing of the whole batch from the header sizes.'''
+        sources = self.sources
+        self.framing = planning.plan_records(
+            [os.path.abspath(entry.path) for (cnt, entry, md) in sources],
+            [md['width'] for (cnt, entry, md) in sources],
+            [md['height'] for (cnt, entry, md) in sources],
+            self.sizes, tolerance=self.options.tolerance,
+            max_crop=self.options.max_crop)
+        if self.options.plan is not None:
+            self.framing = planning.apply_plan(self.framing, self.options.plan)
+
+    def write_plan(self):
+        '''Write the framing to PLAN_OUT instead of building anything.
+RETURNS: the report.'''
+        planning.write_plan(self.options.plan_out, self.framing)
+        print('Wrote plan of {} files: {}'
+              .format(len(self.framing), self.options.plan_out))
+        for (cnt, entry, md), record in zip(self.sources, self.framing):
+            for ti, target in enumerate(record['targets']):
+                if target['bad_aspect']:
+                    self.bad_aspect_files[ti][entry.path] = record['aspect']
+        return dict(targets=self.target_reports(),
+                    bad_metadata=self.bad_metadata_files, duplicates=0,
+                    left_out=sorted(self.sources[i][1].path
+                                    for i in self.left_out))
+
+    def remove_stale_outputs(self, removed):
+        '''Delete the outputs of deleted sources (and of the REMOVED source
+paths), out of the way of the others.'''
+        if self.whole_tree and self.scan_errors:
+            # Files of the part of INDIR that could not be listed would
+            # look deleted.
+            print('WARNING: Could not list all of {} ({} errors, first: {}). '
+                  'Not removing outputs of missing sources.'
+                  .format(self.indir, len(self.scan_errors),
+                          self.scan_errors[0]))
+        elif self.whole_tree:
+            if self.options.cache is not None and self.options.shard is None:
+                self.options.cache.prune(self.indir, self.seen)
+            for build in self.builds:
+                for output in build.remove_missing(self.seen):
+                    print('Removed output of deleted source: {}'
+                          .format(os.path.join(build.outdir, output)))
+        for source in (removed or []):
+            for build in self.builds:
+                output = build.forget(os.path.abspath(source))
+                if output is not None:
+                    print('Removed output of deleted source: {}'
+                          .format(os.path.join(build.outdir, output)))
+
+    def find_duplicates(self):
+        '''Sources that duplicate an earlier one (in walk order) share its
+output (see DUPES).'''
+        if self.options.dedup_mode is not None:
+            self.dupes = dedup.find_duplicates(
+                [(entry.path, self.job.caption(md))
+                 for (cnt, entry, md) in self.sources],
+                mode=self.options.dedup_mode,
+                near_distance=self.options.near_distance)
+        # A duplicate costs nothing when its original is built, and has
+        # nothing to share when it is not.
+        for (pi, original) in self.dupes.items():
+            if original in self.left_out:
+                self.left_out.add(pi)
+            else:
+                self.left_out.discard(pi)
+
+    def name_outputs(self):
+        '''Decide the output name of each source (NAMES), and rename the
+outputs that only changed name (moved in the sequence, or between
+sequence and date stamp names) instead of building them again.'''
+        sources = self.sources
+        dupes = self.dupes
+        self.names = [frame_basename(md, xform_basename(entry.name))
+                      for (cnt, entry, md) in sources]
+        if self.options.sequence or self.options.per_dir:
+            shown = [i for i in range(len(sources)) if not self.skipped(i)]
+            shown.sort(key=lambda i: ordering.sort_key(sources[i][2],
+                                                       sources[i][1].mtime_ns,
+                                                       sources[i][1].path))
+            for i, name in zip(shown, ordering.sequence_names(
+                    [xform_basename(sources[i][1].name) for i in shown],
+                    per_dir=self.options.per_dir)):
+                self.names[i] = name
+            # Outputs of left-out sources go once the refill is done.
+            for build in self.builds:
+                for i in sorted(set(dupes) | self.over_cap):
+                    build.forget(os.path.abspath(sources[i][1].path))
+        wanted = dict((os.path.abspath(entry.path), self.names[i])
+                      for i, (cnt, entry, md) in enumerate(sources)
+                      if not self.skipped(i))
+        for (build, index) in zip(self.builds, self.indexes):
+            moved = build.move_outputs(wanted)
+            for (old, new) in moved:
+                if index is not None:
+                    index.rename(old, new)
+            if moved:
+                print('Renamed {} outputs in {}'.format(len(moved), build.outdir))
+
+    def plan_tasks(self):
+        '''Decide, for each source and target, whether the output is up to
+date. TASKS: [(file_cnt, root, fname, md, [(ti, newfile, sig, box), ...]),
+...] for every source, NEWFILE None when up to date. WORK: the tasks
+(of jobs.FrameJob) that need building.'''
+        self.tasks = list()
+        for pi, ((file_cnt, entry, md), record) in enumerate(zip(self.sources,
+                                                                 self.framing)):
+            (root, fname) = (entry.root, entry.name)
+            source = os.path.abspath(entry.path)
+            xformbase = xform_basename(fname)
+            newbase = self.names[pi]
+            todo = list()
+            for ti, (w, h, tdir) in enumerate(self.targets):
+                build = self.builds[ti]
+                box = planning.crop_box(record, ti)
+                # Cropping is in the signature only when used, so padded
+                # outputs of older runs stay up to date.
+                crop = dict() if box is None else dict(crop=list(box))
+                sig = manifest.signature(entry.size, entry.mtime_ns,
+                                         self.job.caption(md), w, h,
+                                         **dict(self.sig_options, **crop))
+                current = build.current_output(source, sig)
+                if (current is None and build.previous_output(source) is None
+                    and self.legacies[ti].get(xformbase) == newbase
+                    and imaging.decodes(os.path.join(build.outdir, newbase))):
+                    # Written by a run from before there was a manifest
+                    # (and not cut short).
+                    build.record(source, sig, newbase)
+                    current = newbase
+                if (current and self.derived_cap and os.path.getsize(
+                        os.path.join(build.outdir, current)) > self.image_bytes):
+                    current = None
+                newfile = None if current else os.path.join(tdir, newbase)
+                if newfile and not self.skipped(pi):
+                    os.makedirs(os.path.dirname(newfile) or '.', exist_ok=True)
+                todo.append((ti, newfile, sig, box))
+            self.tasks.append((file_cnt, root, fname, md, todo))
+
+        # Only (source, target) pairs that need building go to the workers.
+        self.work = list()
+        for pi, (cnt, root, fname, md, todo) in enumerate(self.tasks):
+            needed = [(ti, newfile, box) for (ti, newfile, sig, box) in todo
+                      if newfile]
+            if needed and not self.skipped(pi):
+                self.work.append((cnt, root, fname, md, needed))
+
+    def skipped(self, pi):
+        '''True iff source PI gets no output of its own (left out, over
+the cap, or a duplicate).'''
+        return pi in self.left_out or pi in self.dupes or pi in self.over_cap
+
+    def build(self):
+        '''Run WORK and take each source's result, in walk order (regardless
+of JOBS) so the catalog and reports are deterministic. With a byte
+budget, left-out sources then go into the room left (see refill).
+Catalog rows are written last, when it is known which sources got an
+output.'''
+        options = self.options
+        self.rows = dict() # d[PI] => PI whose output its row names, or None
+        with task_executor(options.jobs, prefetch=options.prefetch,
+                           writers=options.writers,
+                           max_worker_bytes=options.max_worker_bytes,
+                           timeout=options.file_timeout,
+                           memory=options.file_memory) as executor:
+            results = executor.map(supervise.Isolated(self.job), self.work)
+            saved = time.monotonic()
+            for pi, (cnt, root, fname, md, todo) in enumerate(self.tasks):
+                if time.monotonic() - saved >= CHECKPOINT_SECONDS:
+                    self.checkpoint()
+                    saved = time.monotonic()
+                if pi in self.left_out:
+                    continue # taken after the refill
+                elif pi in self.dupes:
+                    self.take_duplicate(pi)
+                else:
+                    built = any(newfile for (ti, newfile, sig, box) in todo)
+                    self.take(pi, next(results) if built else None)
+            if options.byte_budget:
+                self.refill(executor)
+        for pi in sorted(self.left_out):
+            self.take_left_out(pi)
+        if options.byte_budget and (options.sequence or options.per_dir):
+            self.name_outputs() # the refill changed who is in the sequence
+        for pi, (cnt, root, fname, md, todo) in enumerate(self.tasks):
+            if pi in self.rows:
+                output = self.rows[pi]
+                write_catalog_rec(md, fname, root, self.catalog_writer,
+                                  output=(None if output is None
+                                          else self.names[output]))
+
+    def refill(self, executor):
+        '''Build left-out sources, newest first, while they fit in what the
+outputs as written leave of the budget: outputs under the cap, and
+those left out over it, leave more room than was set aside for them.'''
+        candidates = [pi for pi in self.newest
+                      if pi in self.left_out and pi not in self.dupes]
+        while candidates:
+            room = self.budget_room()
+            batch = list()
+            for pi in candidates:
+                room = [r - need for (r, need) in zip(room, self.reserve(pi))]
+                if min(room) < 0:
+                    break
+                batch.append(pi)
+            if not batch:
+                return
+            candidates = candidates[len(batch):]
+            work = list()
+            for pi in batch:
+                self.left_out.discard(pi)
+                (cnt, root, fname, md, todo) = self.tasks[pi]
+                needed = [(ti, newfile, box) for (ti, newfile, sig, box) in todo
+                          if newfile]
+                for (ti, newfile, box) in needed:
+                    os.makedirs(os.path.dirname(newfile) or '.', exist_ok=True)
+                if needed:
+                    work.append((cnt, root, fname, md, needed))
+            results = executor.map(supervise.Isolated(self.job), work)
+            for pi in batch:
+                todo = self.tasks[pi][4]
+                built = any(newfile for (ti, newfile, sig, box) in todo)
+                self.take(pi, next(results) if built else None)
+                for dupe in sorted(d for (d, o) in self.dupes.items() if o == pi):
+                    self.left_out.discard(dupe)
+                    self.take_duplicate(dupe)
+
+    def budget_room(self):
+        '''RETURNS: per target, the bytes of the byte budget not taken by
+the outputs as written (of sources not left out) and the manifest,
+thumbnail index and catalog.'''
+        room = list()
+        for (build, (fixed, rows, kept)) in zip(self.builds, self.overheads):
+            (used, outputs) = (fixed + sum(rows), set())
+            for pi, (cnt, entry, md) in enumerate(self.sources):
+                output = build.previous_output(os.path.abspath(entry.path))
+                if output is not None and pi not in self.left_out:
+                    used += kept[pi]
+                    outputs.add(os.path.join(build.outdir, output))
+            used += sum(os.path.getsize(f) for f in outputs if os.path.exists(f))
+            room.append(self.options.byte_budget - used)
+        return room
+
+    def reserve(self, pi):
+        '''RETURNS: per target, the bytes source PI would take of the
+byte budget: its output as it is when up to date, else IMAGE_BYTES, and
+its share of the manifest and thumbnail index.'''
+        (cnt, root, fname, md, todo) = self.tasks[pi]
+        source = os.path.abspath(os.path.join(root, fname))
+        need = list()
+        for ((ti, newfile, sig, box), (fixed, rows, kept)) in zip(todo,
+                                                                  self.overheads):
+            build = self.builds[ti]
+            size = self.image_bytes
+            if newfile is None:
+                size = os.path.getsize(os.path.join(build.outdir,
+                                                    build.previous_output(source)))
+            need.append(kept[pi] + size)
+        return need
+
+    def take(self, pi, result):
+        if isinstance(result, supervise.Failure):
+            self.take_failure(pi, result)
+        else:
+            self.take_result(pi, result)
+
+    def take_left_out(self, pi):
+        (cnt, root, fname, md, todo) = self.tasks[pi]
+        infile = os.path.join(root, fname)
+        self.rows[pi] = None
+        for build in self.builds:
+            build.forget(os.path.abspath(infile))
+        self.left_out_files.append(infile)
+        print('[{}] Left out to fit the byte budget: {}'.format(cnt-1, infile))
+
+    def take_duplicate(self, pi):
+        (cnt, root, fname, md, todo) = self.tasks[pi]
+        source = os.path.abspath(os.path.join(root, fname))
+        (ocnt, oroot, ofname, omd, oout) = self.tasks[self.dupes[pi]]
+        if os.path.join(oroot, ofname) in self.failed_files:
+            self.rows[pi] = None
+            print('[{}] Duplicate of failed {}, no output'
+                  .format(cnt-1, os.path.join(oroot, ofname)))
+            return
+        if self.dupes[pi] in self.over_cap:
+            self.rows[pi] = None
+            for build in self.builds:
+                build.forget(source)
+            print('[{}] Duplicate of {} (left out), no output'
+                  .format(cnt-1, os.path.join(oroot, ofname)))
+            return
+        shared = self.names[self.dupes[pi]]
+        self.rows[pi] = self.dupes[pi]
+        for build in self.builds:
+            if build.previous_output(source) != shared:
+                build.forget(source)
+        print('[{}] Duplicate of {}, shares: {}'
+              .format(cnt-1, os.path.join(oroot, ofname), shared))
+
+    def take_failure(self, pi, result):
+        (cnt, root, fname, md, todo) = self.tasks[pi]
+        infile = os.path.join(root, fname)
+        source = os.path.abspath(infile)
+        self.rows[pi] = None
+        for (ti, newfile, sig, box) in todo:
+            # No partial output is left behind.
+            if newfile is None:
+                continue
+            if self.builds[ti].previous_output(source) == self.names[pi]:
+                self.builds[ti].forget(source)
+            elif os.path.exists(newfile):
+                os.remove(newfile)
+        self.failed_files[infile] = '{}: {}'.format(*result)
+        if self.options.retry_list is not None:
+            self.options.retry_list.failed(source, result)
+        print('[{}] FAILED ({}), no output: {}\n{}'
+              .format(cnt-1, result.reason, infile, result.detail))
+
+    def take_result(self, pi, result):
+        '''Record the outputs of source PI: RESULT (from jobs.FrameJob) for
+those just built, the up-to-date ones as they are.'''
+        (cnt, root, fname, md, todo) = self.tasks[pi]
+        infile = os.path.join(root, fname)
+        source = os.path.abspath(infile)
+        if self.options.retry_list is not None:
+            self.options.retry_list.discard(source)
+        self.rows[pi] = pi
+
+        for ti, target in enumerate(self.framing[pi]['targets']):
+            if target['bad_aspect']:
+                self.bad_aspect_files[ti][infile] = self.framing[pi]['aspect']
+        caption = self.job.caption(md)
+        if any(layout.layout_caption(caption, self.options.ttf,
+                                     layout.CAPTION_SIZE, w).truncated
+               for (w, h) in self.sizes):
+            self.truncated_captions[infile] = caption
+
+        thumbnails = dict()
+        if result is not None:
+            (fm, made) = result
+            self.run_metrics.add(fm)
+            built = [ti for (ti, newfile, sig, box) in todo if newfile]
+            thumbnails = dict(zip(built, made or []))
+        for (ti, newfile, sig, box) in todo:
+            build = self.builds[ti]
+            index = self.indexes[ti]
+            if newfile is None:
+                current = build.previous_output(source)
+                if (index is not None and current not in index
+                    and source in build.entries):
+                    # Built before there was an index.
+                    index.put(current, thumbs.thumbnail_of_file(
+                        os.path.join(build.outdir, current), index.size))
+                print('[{}] Not replacing up-to-date file: {}'
+                      .format(cnt-1, os.path.join(build.outdir, current)))
+                continue
+            old = build.previous_output(source)
+            newbase = self.names[pi]
+            if self.image_bytes and os.path.getsize(newfile) > self.image_bytes:
+                os.remove(newfile)
+                build.forget(source)
+                if infile not in self.left_out_files:
+                    self.left_out_files.append(infile)
+                print('[{}] Left out, over {} bytes even at the '
+                      'lowest quality: {}'
+                      .format(cnt-1, self.image_bytes, newfile))
+                continue
+            if old is not None and old != newbase:
+                build.remove_output(old)
+            build.record(source, sig, newbase)
+            if index is not None:
+                index.put(newbase, thumbnails[ti])
+            print('[{}] Wrote file: {}'.format(cnt-1, newfile))
+        if all(build.previous_output(source) is None for build in self.builds):
+            self.over_cap.add(pi)
+            self.rows[pi] = None
+
+    def checkpoint(self):
+        '''Write the manifests and retry list as they are so far.'''
+        for build in self.builds:
+            build.save()
+        if self.options.retry_list is not None:
+            self.options.retry_list.save()
+
+    def save(self):
+        '''Write the manifests, indexes and retry list.'''
+        self.checkpoint()
+        for (build, index) in zip(self.builds, self.indexes):
+            if index is not None:
+                index.prune(build.recorded_outputs())
+                index.save()
+
+    def target_reports(self):
+        return [dict(width=w, height=h, tolerance=self.options.tolerance,
+                     bad_aspect=self.bad_aspect_files[ti])
+                for ti, (w, h) in enumerate(self.sizes)]
+
+    def report(self):
+        '''RETURNS: the report of burn_dir.'''
+        return dict(targets=self.target_reports(),
+                    bad_metadata=self.bad_metadata_files,
+                    duplicates=len(self.dupes),
+                    left_out=self.left_out_files,
+                    truncated_captions=self.truncated_captions,
+                    failed=self.failed_files,
+                    quarantined=self.quarantined_files)
+
+def budget_overhead(sources, width, height, build, index, catalog_writer,
+                    job, sig_options):
+    '''RETURNS: (fixed, rows, kept): bytes that the manifest BUILD, the
+thumbnail INDEX (or None) and (if it is in the same directory) the
+catalog take in the output directory of WIDTH x HEIGHT frames. ROWS
+(catalog) and KEPT (the rest) are per source, KEPT for a source that
+gets an output. Names and signatures are estimated on the long side.'''
+    catalog_here = (catalog_writer is not None
+                    and os.path.abspath(os.path.dirname(catalog_writer.name))
+                    == os.path.abspath(build.outdir))
+    fixed = len('{}')
+    if index is not None:
+        fixed += index.fixed_bytes()
+    if catalog_here:
+        fixed += catalog_writer.start_bytes
+    (rows, kept) = (list(), list())
+    for (cnt, entry, md) in sources:
+        name = frame_basename(md, xform_basename(entry.name))
+        sig = manifest.signature(entry.size, entry.mtime_ns, job.caption(md),
+                                 width, height,
+                                 **dict(sig_options, crop=[99999]*4,
+                                        image_bytes=10**12))
+        kept.append(build.entry_bytes(os.path.abspath(entry.path), sig, name)
+                    + (0 if index is None else index.entry_bytes(name)))
+        rows.append(0 if not catalog_here else
+                    catalog_writer.row_bytes(md, entry.name, entry.root,
+                                             output=name))
+    return (fixed, rows, kept)
+
+def print_report(report, written=True):
+    '''Print the bad aspect, bad metadata and duplicate counts of REPORT
+(as returned by burn_dir). WRITTEN: images were made (not just planned).'''
+    for target in report['targets']:
+        goalAspect = float(target['width'])/target['height']
+        bad_aspect_files = target['bad_aspect']
+        if len(bad_aspect_files) > 0:
+            print('Bad aspect in {} files. {} '
+                  'Goal aspect={} ({}x{}) tolerance={}'
+                  .format(len(bad_aspect_files),
+                          'All written anyhow.' if written else
+                          'Nothing written (plan only).', goalAspect,
+                          target['width'], target['height'],
+                          target['tolerance']))
+            print('Diff\tAct\tFilename')
+            for f,a in bad_aspect_files.items():
+                print('  {0:.3f}\t{1:.3f}\t{2}'.format(abs(a-goalAspect),a,f))
                 
+    bad_metadata_files = report['bad_metadata']
     if len(bad_metadata_files) > 0:
         print('Bad metadata in {} files (they were skipped)'.format(len(bad_metadata_files)))
         print('\n'.join(bad_metadata_files))
+    if report['duplicates'] > 0:
+        print('Duplicates: {} files share the output of another file'
+              .format(report['duplicates']))
+    truncated = report.get('truncated_captions', {})
+    if len(truncated) > 0:
+        print('Caption cut to fit the frame in {} files'.format(len(truncated)))
+        for f,c in truncated.items():
+            print('  {}\t{}'.format(f, c))
+    left_out = report.get('left_out', [])
+    if len(left_out) > 0:
+        print('Left out {} files to fit the byte budget'.format(len(left_out)))
+        print('\n'.join(left_out))
+    failed = report.get('failed', {})
+    if len(failed) > 0:
+        print('Failed on {} files (no output written)'.format(len(failed)))
+        for f,r in failed.items():
+            print('  {}\t{}'.format(f, r))
+    quarantined = report.get('quarantined', [])
+    if len(quarantined) > 0:
+        print('Skipped {} quarantined files (failed before; use --retry)'
+              .format(len(quarantined)))
+        print('\n'.join(quarantined))
+
+def burn_queue(indir, outdir, catalog_writer, date_in_caption, queue,
+               chunk=50, options=None, run_metrics=None, **settings):
+    '''Add every file under INDIR to QUEUE (a shards.LeaseQueue shared
+with other workers) unless already there, then run burn_dir on leased
+CHUNKs of it until nothing is left. OPTIONS and SETTINGS are as for
+burn_dir. RETURNS: the combined report.'''
+    options = burn_options(options, **settings)
+    scan_options = options.scan_options or {}
+    queue.add(os.path.relpath(e.path, indir)
+              for e in scanner.scan(indir, **scan_options))
+    reports = list()
+    outputs = dict()
+    while True:
+        paths = queue.take(chunk)
+        if not paths:
+            break
+        entries = list()
+        for path in paths:
+            entry = scanner.entry(indir, os.path.join(indir, path),
+                                  **scan_options)
+            if entry is not None:
+                entries.append(entry)
+        reports.append(burn_dir(indir, outdir, catalog_writer, date_in_caption,
+                                options, run_metrics=run_metrics,
+                                entries=entries, outputs=outputs))
+        catalog_writer.checkpoint()
+        queue.done(paths)
+    print('Queue {}: {}'.format(queue.dbfile, queue.counts()))
+    return shards.merge_reports(reports)
+
+def retry_entries(indir, retry_list, scan_options=None):
+    '''RETURNS: scanner.ScanEntry of each file in RETRY_LIST (a
+supervise.RetryList) that is still there under INDIR. The others are
+dropped from the list.'''
+    entries = list()
+    for path in retry_list.paths():
+        entry = scanner.entry(indir, os.path.join(
+            indir, os.path.relpath(path, os.path.abspath(indir))),
+                              **(scan_options or {}))
+        if entry is None:
+            retry_list.discard(path)
+        else:
+            entries.append(entry)
+    return entries
+
+def watch_dir(indir, outdir, catalog_writer, date_in_caption,
+              settle=2.0, poll=None, options=None, **settings):
+    '''Run burn_dir over INDIR, then again on just the files that are
+added, changed or removed, as that happens, until interrupted.
+Catalog rows are made durable after each batch. SETTLE and POLL are as
+for watch.changes; OPTIONS and SETTINGS are as for burn_dir.'''
+    options = burn_options(options, **settings)
+    outputs = dict()
+    try:
+        for (entries, removed) in watch.changes(
+                indir, settle=settle, poll=poll,
+                scan_options=options.scan_options):
+            burn_dir(indir, outdir, catalog_writer, date_in_caption, options,
+                     entries=entries, removed=removed, outputs=outputs)
+            catalog_writer.checkpoint()
+            if entries is None:
+                print('Watching {} for changes (Ctrl-C to stop)'.format(indir))
+    except KeyboardInterrupt:
+        print('Stopped watching {}'.format(indir))
+
+def write_contact_sheets(outdir, filename, columns=10, rows=10):
+    '''Render contact sheets of OUTDIR (from its thumbnail index) to
+FILENAME with -001, -002, ... before the extension.'''
+    (stem, ext) = os.path.splitext(filename)
+    count = 0
+    for count, sheet in enumerate(thumbs.contact_sheets(outdir, columns=columns,
+                                                        rows=rows), 1):
+        sheet.save('{}-{:03d}{}'.format(stem, count, ext or '.jpg'), quality=85)
+    print('Wrote {} contact sheets: {}-NNN{}'.format(count, stem, ext or '.jpg'))
+
+class _SerialExecutor():
+    '''Stand-in for a process pool when running with a single job.'''
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+def task_executor(jobs, prefetch=0, writers=2, max_worker_bytes=None,
+                  timeout=None, memory=None):
+    '''RETURNS: context manager whose map(job, tasks) yields in task order.
+PREFETCH > 0 selects the staged (read-ahead/write-behind) pipeline.
+With MAX_WORKER_BYTES, at most JOBS times that (by job.memory estimates)
+is in flight. TIMEOUT or MEMORY (per task) select watched worker
+processes (supervise.SupervisedExecutor) instead of either.'''
+    jobs = max(1, jobs or 1)
+    max_bytes = None if max_worker_bytes is None else jobs*max_worker_bytes
+    if timeout or memory:
+        return supervise.SupervisedExecutor(jobs, timeout=timeout,
+                                            memory=memory, max_bytes=max_bytes)
+    if prefetch > 0:
+        return pipeline.Pipeline(prefetch=prefetch, writers=writers, jobs=jobs,
+                                 max_bytes=max_bytes)
+    if jobs <= 1:
+        return _SerialExecutor()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    if max_bytes is None:
+        return executor
+    return pipeline.MemoryBoundedExecutor(executor, max_bytes)
 
 ##############################################################################
 
+def byte_count(text):
+    '''RETURNS: bytes in TEXT: a number, optionally followed by K, M or G
+(binary multiples).'''
+    units = dict(K=1024, M=1024**2, G=1024**3)
+    scale = units.get(text[-1:].upper(), 1)
+    try:
+        return int(float(text[:-1] if scale > 1 else text)*scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not a byte count: "{}"'.format(text))
+
 def main():
     #print('EXECUTING: {}\n\n'.format(' '.join(sys.argv)))
     parser = argparse.ArgumentParser(
@@ -200,13 +1085,22 @@ def main():
         description='My shiny new python program',
         epilog='EXAMPLE: %(prog)s a b"'  )
     parser.add_argument('indir',
-                        help='Use JPG descendants of this for input files.', )
-    parser.add_argument('outdir',
-                        help='Write modified files here.',  )
+                        help='Use JPEG (.jpg, .jpeg) descendants of this for input files.', )
+    parser.add_argument('outdir', nargs='+',
+                        help=('Write modified files here. One per '
+                              '--width/--height target, in the same order.'),  )
     parser.add_argument('-c', '--catalog_file', 
-                        help='Output Catalog as CSV (else to STDOUT)',
+                        help=('Output Catalog '
+                              '(default: OUTDIR/digitalframe-catalog.FORMAT)'),
                         #default=os.path.join(args.indir,'digitalframe-catalog.csv'),
-                        type=argparse.FileType('w+'), )
+                        )
+    parser.add_argument('--catalog_format',
+                        choices=catalog.FORMATS, default='csv',
+                        help='Format of the catalog file.', )
+    parser.add_argument('-a', '--append_catalog',
+                        action='store_true',
+                        help=('Add to an existing catalog, skipping files it '
+                              'already records.'), )
     #!parser.add_argument('-d', '--date_in_caption',
     #!                    action='store_true',
     #!                    help='Include the date in the caption', )
@@ -218,13 +1112,206 @@ def main():
                         help='Only write the catalog. Do not creates images.', )
 
     parser.add_argument('--height',
-                        type=int, default=768,
-                        help='Target output HEIGHT of images. NIX x15a is 1024x768.'
+                        type=int, action='append',
+                        help=('Target output HEIGHT of images. NIX x15a is 1024x768. '
+                              'Repeat for several targets. Default: 768'),
                         )
     parser.add_argument('--width',
-                        type=int, default=1024,
-                        help='Target output WIDTH of images. NIX x15a is 1024x768.'
+                        type=int, action='append',
+                        help=('Target output WIDTH of images. NIX x15a is 1024x768. '
+                              'Repeat for several targets. Default: 1024'),
                         )
+    parser.add_argument('--ttf',
+                        default=imaging.DEFAULT_TTF,
+                        help='TrueType font for captions. Default: %(default)s', )
+    parser.add_argument('--no_draft',
+                        action='store_true',
+                        help=('Decode JPEGs at full size instead of letting '
+                              'libjpeg scale them down toward the target size. '
+                              'Slower, but pixel-exact.'), )
+    parser.add_argument('--quality',
+                        type=int, default=75,
+                        help='JPEG quality of the output (1-95). Default: %(default)s', )
+    parser.add_argument('--subsampling',
+                        choices=imaging.SUBSAMPLINGS,
+                        help=('Chroma subsampling of the output ("keep": as '
+                              'the source). Default: encoder default (4:2:0).'), )
+    parser.add_argument('--progressive',
+                        action='store_true',
+                        help='Write progressive JPEGs.', )
+    parser.add_argument('--optimize',
+                        action='store_true',
+                        help='Optimize the Huffman tables (smaller, slower).', )
+    parser.add_argument('--keep_qtables',
+                        action='store_true',
+                        help=('Reuse the quantization tables of the source '
+                              '(--quality is then not used).'), )
+    parser.add_argument('--no_copy_metadata',
+                        action='store_true',
+                        help=('Do not copy the IPTC caption and Exif dates '
+                              'into the output.'), )
+    parser.add_argument('--jobs',
+                        type=int, default=1,
+                        help='Number of worker processes used to create images.'
+                        )
+    parser.add_argument('--prefetch',
+                        type=int, default=0,
+                        help=('Overlap I/O with image work: read up to this '
+                              'many files ahead (0: no pipelining).'), )
+    parser.add_argument('--writers',
+                        type=int, default=2,
+                        help='Concurrent output writers when --prefetch > 0.', )
+    parser.add_argument('--dedup',
+                        choices=dedup.MODES,
+                        help=('Make one output per set of duplicate sources '
+                              '(with the same caption): "exact" compares the '
+                              'compressed image data, "near" also a '
+                              'perceptual hash. The catalog Output column '
+                              'names the shared file.'), )
+    parser.add_argument('--near_distance',
+                        type=int, default=6,
+                        help=('Max differing bits (of 64) for --dedup near. '
+                              'Default: %(default)s'), )
+    parser.add_argument('--max_crop',
+                        type=float, default=0.0,
+                        help=('Crop (centered) instead of letterboxing a '
+                              'source of the wrong aspect when that loses at '
+                              'most this share of its area, e.g. 0.1. '
+                              'Default: %(default)s (never crop)'), )
+    parser.add_argument('--plan_only',
+                        metavar='PLAN_FILE',
+                        help=('Decide the framing of every source from the '
+                              'header sizes, write it to this file (JSON '
+                              'lines) with the bad aspect report, and stop '
+                              'before any image work.'), )
+    parser.add_argument('--plan',
+                        metavar='PLAN_FILE',
+                        help=('Frame the sources listed in this (reviewed '
+                              'or edited) --plan_only file as it says.'), )
+    parser.add_argument('--image_bytes',
+                        type=byte_count,
+                        help=('Encode each frame to at most this size (e.g. '
+                              '150K), lowering the JPEG quality as needed.'), )
+    parser.add_argument('--byte_budget',
+                        type=byte_count,
+                        help=('Total size the frames in each OUTDIR may take '
+                              '(e.g. 2G for the frame\'s card). The newest '
+                              'photos that fit are used; see --image_bytes.'), )
+    parser.add_argument('--sequence',
+                        action='store_true',
+                        help=('Name the frames 00001-..., 00002-..., in date '
+                              'order (digitized, else original, else file '
+                              'time), so undated photos play in order too '
+                              'and the frame need not sort its listing.'), )
+    parser.add_argument('--per_dir',
+                        type=int,
+                        help=('With --sequence: put the frames in numbered '
+                              'subdirectories of this many (e.g. 500), '
+                              'for frames slow to list large folders. '
+                              'Implies --sequence.'), )
+    parser.add_argument('--thumb_width',
+                        type=int, default=96,
+                        help=('Width of the thumbnails kept in an index in each '
+                              'OUTDIR (0: no index). Default: %(default)s'), )
+    parser.add_argument('--contact_sheet',
+                        metavar='FILE',
+                        help=('After the run, render contact sheets of the '
+                              'first OUTDIR from its thumbnail index to '
+                              'FILE-001.jpg, FILE-002.jpg, ...'), )
+    parser.add_argument('--sheet_size',
+                        default='10x10',
+                        help=('Thumbnails per contact sheet, COLUMNSxROWS. '
+                              'Default: %(default)s'), )
+    parser.add_argument('--max_worker_mem',
+                        type=int,
+                        help=('Memory ceiling (MB) per worker. Sources too big '
+                              'for it are decoded at a reduced scale (even '
+                              'with --no_draft) and the scheduler keeps at '
+                              'most JOBS ceilings of work in flight.'), )
+    parser.add_argument('--file_timeout',
+                        type=float,
+                        help=('Seconds of image work allowed per file; a file '
+                              'taking longer is killed and recorded as '
+                              'failed. Work then runs in watched worker '
+                              'processes.'), )
+    parser.add_argument('--file_memory',
+                        type=int,
+                        help=('Address space (MB) allowed per worker process '
+                              '(Unix); a file needing more is recorded as '
+                              'failed. Work then runs in watched worker '
+                              'processes.'), )
+    parser.add_argument('--retry_file',
+                        help=('Record files that fail in this file (JSON '
+                              'lines). Later runs skip them until they '
+                              'change; see --retry.'), )
+    parser.add_argument('--retry',
+                        action='store_true',
+                        help=('Only process the files of --retry_file '
+                              '(e.g. with a larger --file_timeout); the ones '
+                              'that work are taken off it. The catalog is '
+                              'appended to.'), )
+    parser.add_argument('--metrics_json',
+                        help='Write per-file, per-stage timings to this JSON file.', )
+    parser.add_argument('--profile',
+                        help=('Write cProfile stats of the run to this file '
+                              '(main process only; use --jobs 1 for image work).'), )
+    parser.add_argument('--scan_threads',
+                        type=int, default=8,
+                        help='Threads listing directories under INDIR.', )
+    parser.add_argument('--include',
+                        action='append',
+                        help=('Only use files whose path (relative to INDIR) '
+                              'matches this glob. Repeatable.'), )
+    parser.add_argument('--exclude',
+                        action='append',
+                        help=('Skip files and directories whose path (relative '
+                              'to INDIR) matches this glob. Repeatable.'), )
+    parser.add_argument('--check_magic',
+                        action='store_true',
+                        help='Only use files that start with the JPEG signature.', )
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help=('After processing INDIR, keep running and '
+                              'process JPEGs as they are added or changed '
+                              '(inotify, else polling). Catalog rows are '
+                              'appended as files are done.'), )
+    parser.add_argument('--settle',
+                        type=float, default=2.0,
+                        help=('With --watch: seconds a file must be unchanged '
+                              'before it is used. Default: %(default)s'), )
+    parser.add_argument('--poll',
+                        type=float,
+                        help=('With --watch: re-scan INDIR every POLL seconds '
+                              'instead of using inotify.'), )
+    parser.add_argument('--shard',
+                        help=('Only process shard I/N (0 <= I < N) of the '
+                              'files under INDIR, e.g. 2/8. Run the other '
+                              'shards elsewhere, then --merge.'), )
+    parser.add_argument('--queue',
+                        help=('SQLite work queue file on storage shared with '
+                              'the other workers; take files from it until '
+                              'none are left. Then --merge.'), )
+    parser.add_argument('--queue_chunk',
+                        type=int, default=50,
+                        help='Files leased from --queue at a time. Default: %(default)s', )
+    parser.add_argument('--lease',
+                        type=float, default=600,
+                        help=('Seconds before an unfinished --queue chunk is '
+                              'given to another worker. Default: %(default)s'), )
+    parser.add_argument('--merge',
+                        action='store_true',
+                        help=('Only combine the per-shard/per-worker catalogs '
+                              'and reports in the first OUTDIR.'), )
+    parser.add_argument('--metadata_cache',
+                        default=mdcache.DEFAULT_CACHE,
+                        help=('SQLite file caching JPEG metadata between runs. '
+                              'Default: %(default)s'), )
+    parser.add_argument('--no_metadata_cache',
+                        action='store_true',
+                        help='Always read metadata from the JPEG files.', )
+    parser.add_argument('--rebuild_metadata_cache',
+                        action='store_true',
+                        help='Discard all cached metadata before starting.', )
                         
     parser.add_argument('--loglevel',      help='Kind of diagnostic output',
                         choices = ['CRTICAL','ERROR','WARNING','INFO','DEBUG'],
@@ -240,17 +1327,199 @@ def main():
                         datefmt='%m-%d %H:%M'
                         )
     logging.debug('Debug output is enabled!!!')
+    widths = args.width or [1024]
+    heights = args.height or [768]
+    if not (len(widths) == len(heights) == len(args.outdir)):
+        parser.error('Need the same number of --width, --height and OUTDIR '
+                     '(got {}, {} and {})'
+                     .format(len(widths), len(heights), len(args.outdir)))
+    targets = list(zip(widths, heights, args.outdir))
+    try:
+        sheet_size = tuple(int(n) for n in args.sheet_size.split('x'))
+        (sheet_columns, sheet_rows) = sheet_size
+    except ValueError:
+        parser.error('--sheet_size must look like 10x10 (got "{}")'
+                     .format(args.sheet_size))
+    if args.merge:
+        (merged, report) = shards.merge(args.outdir[0], format=args.catalog_format)
+        print_report(report)
+        print('Catalog written to: {}'.format(merged))
+        if args.contact_sheet:
+            write_contact_sheets(args.outdir[0], args.contact_sheet,
+                                 sheet_columns, sheet_rows)
+        return
+    if not os.path.isdir(args.indir):
+        parser.error('INDIR "{}" is not a directory'.format(args.indir))
+    shard = None
+    worker_id = None
+    if args.shard is not None and args.queue is not None:
+        parser.error('Use either --shard or --queue')
+    if args.shard is not None:
+        try:
+            shard = shards.parse_shard(args.shard)
+        except ValueError as ex:
+            parser.error(str(ex))
+        worker_id = shards.shard_name(shard)
+    elif args.queue is not None:
+        worker_id = shards.worker_name()
+    if worker_id is not None and args.watch:
+        parser.error('--watch cannot be used with --shard or --queue')
+    if worker_id is not None and args.catalog_file is None:
+        args.catalog_file = shards.catalog_path(args.outdir[0], worker_id,
+                                                args.catalog_format)
+    if args.watch and (args.just_catalog or args.catalog_format == 'parquet'):
+        parser.error('--watch needs image output and a csv or jsonl catalog')
+    if args.byte_budget and (worker_id is not None or args.watch):
+        parser.error('--byte_budget needs the whole of INDIR in one run '
+                     '(not --shard, --queue or --watch)')
+    if (args.sequence or args.per_dir) and (worker_id is not None
+                                            or args.watch or args.retry):
+        parser.error('--sequence and --per_dir need the whole of INDIR in '
+                     'one run (not --shard, --queue, --watch or --retry)')
+    if args.retry_file is not None and worker_id is not None:
+        parser.error('--retry_file cannot be used with --shard or --queue')
+    if args.retry and (args.retry_file is None or args.watch
+                       or args.byte_budget):
+        parser.error('--retry needs --retry_file (and not --watch or '
+                     '--byte_budget)')
+    if (args.file_timeout or args.file_memory) and args.prefetch > 0:
+        parser.error('--file_timeout and --file_memory cannot be used '
+                     'with --prefetch')
+    if args.plan_only is not None and (args.watch or args.queue is not None
+                                       or args.just_catalog):
+        parser.error('--plan_only cannot be used with --watch, --queue '
+                     'or --just_catalog')
+    plan = None
+    if args.plan is not None:
+        try:
+            plan = planning.read_plan(args.plan)
+        except (OSError, ValueError) as ex:
+            parser.error('Cannot read --plan: {}'.format(ex))
+    cache = None
+    if not args.no_metadata_cache:
+        cache = mdcache.MetadataCache(args.metadata_cache,
+                                      rebuild=args.rebuild_metadata_cache)
+    scan_options = dict(threads=args.scan_threads,
+                        include=args.include, exclude=args.exclude,
+                        magic=scanner.JPEG_MAGIC if args.check_magic else None)
+    if args.plan_only is not None:
+        # Nothing is built, so no catalog is written either.
+        try:
+            burn_dir(args.indir, args.outdir[0], None,
+                     not(args.no_date_in_caption),
+                     BurnOptions(targets=targets, cache=cache,
+                                 scan_options=scan_options, shard=shard,
+                                 max_crop=args.max_crop, plan=plan,
+                                 plan_out=args.plan_only))
+        finally:
+            if cache is not None:
+                cache.close()
+        return
+    # The catalog is shared by all targets; it goes with the first one.
     if args.catalog_file == None:
-        cfname = os.path.join(args.outdir,'digitalframe-catalog.csv')
-        print('Writing catalog to: {}'.format(cfname))
-        args.catalog_file = open(cfname, 'w+')
-    if args.just_catalog:
-        write_catalog(args.indir, args.catalog_file)
-    else:
-        burn_dir(args.indir, args.outdir,
-                 args.catalog_file, not(args.no_date_in_caption),
-                 target_width=args.width,
-                 target_height=args.height   )
-    print('Catalog written to: {}'.format(args.catalog_file.name))
+        args.catalog_file = os.path.join(args.outdir[0],'digitalframe-catalog.{}'
+                                         .format(args.catalog_format))
+        print('Writing catalog to: {}'.format(args.catalog_file))
+    try:
+        catalog_writer = catalog.CatalogWriter(args.catalog_file,
+                                               format=args.catalog_format,
+                                               append=args.append_catalog or args.retry)
+    except ImportError as ex:
+        parser.error(str(ex))
+    encoding = imaging.jpeg_encoding(quality=args.quality,
+                                     subsampling=args.subsampling,
+                                     progressive=args.progressive,
+                                     optimize=args.optimize,
+                                     keep_qtables=args.keep_qtables)
+    max_worker_bytes = None
+    if args.max_worker_mem is not None:
+        max_worker_bytes = args.max_worker_mem*1024*1024
+    retry_list = None
+    if args.retry_file is not None:
+        retry_list = supervise.RetryList(args.retry_file, retrying=args.retry)
+    run_metrics = metrics.RunMetrics()
+    try:
+        with metrics.profiled(args.profile):
+            if args.just_catalog:
+                write_catalog(args.indir, catalog_writer, cache=cache,
+                              scan_options=scan_options)
+            else:
+                options = BurnOptions(
+                    targets=targets,
+                    jobs=args.jobs,
+                    draft=not(args.no_draft),
+                    cache=cache,
+                    prefetch=args.prefetch,
+                    writers=args.writers,
+                    ttf=args.ttf,
+                    scan_options=scan_options,
+                    max_worker_bytes=max_worker_bytes,
+                    dedup_mode=args.dedup,
+                    near_distance=args.near_distance,
+                    encoding=encoding,
+                    copy_metadata=not(args.no_copy_metadata),
+                    shard=shard,
+                    worker_id=worker_id,
+                    max_crop=args.max_crop,
+                    plan=plan,
+                    thumb_width=args.thumb_width,
+                    image_bytes=args.image_bytes,
+                    byte_budget=args.byte_budget,
+                    file_timeout=args.file_timeout,
+                    file_memory=(None if not args.file_memory
+                                 else args.file_memory*1024*1024),
+                    retry_list=retry_list,
+                    sequence=args.sequence,
+                    per_dir=args.per_dir)
+                report = None
+                if args.queue is not None:
+                    queue = shards.LeaseQueue(args.queue, owner=worker_id,
+                                              lease=args.lease)
+                    try:
+                        report = burn_queue(args.indir, args.outdir[0],
+                                            catalog_writer,
+                                            not(args.no_date_in_caption),
+                                            queue, chunk=args.queue_chunk,
+                                            options=options,
+                                            run_metrics=run_metrics)
+                    finally:
+                        queue.close()
+                elif args.retry:
+                    entries = retry_entries(args.indir, retry_list,
+                                            scan_options=scan_options)
+                    print('Retrying {} files of {}'
+                          .format(len(entries), args.retry_file))
+                    report = burn_dir(args.indir, args.outdir[0],
+                                      catalog_writer, not(args.no_date_in_caption),
+                                      options, run_metrics=run_metrics,
+                                      entries=entries)
+                elif args.watch:
+                    # Each batch gets its own timing summary.
+                    watch_dir(args.indir, args.outdir[0],
+                              catalog_writer, not(args.no_date_in_caption),
+                              settle=args.settle, poll=args.poll,
+                              options=options)
+                else:
+                    try:
+                        report = burn_dir(args.indir, args.outdir[0],
+                                          catalog_writer,
+                                          not(args.no_date_in_caption),
+                                          options, run_metrics=run_metrics)
+                    except ValueError as ex:
+                        parser.exit(1, '{}: error: {}\n'.format(parser.prog, ex))
+                if worker_id is not None:
+                    with open(shards.report_path(args.outdir[0], worker_id), 'w') as f:
+                        json.dump(report, f, indent=1, sort_keys=True)
+    finally:
+        catalog_writer.close()
+        if cache is not None:
+            cache.close()
+    print('Catalog written to: {}'.format(catalog_writer.name))
+    if args.contact_sheet and not args.just_catalog:
+        write_contact_sheets(args.outdir[0], args.contact_sheet,
+                             sheet_columns, sheet_rows)
+    if args.metrics_json:
+        run_metrics.write_json(args.metrics_json)
+        print('Metrics written to: {}'.format(args.metrics_json))
 if __name__ == '__main__':
     main()
@@ -0,0 +1,362 @@
+'''In-process image operations used to turn a photo into a frame image.
+
+The photo is decoded once, fit (letterboxed) into the target frame,
+captioned and encoded once. This gives the same output geometry as
+the old chain of:
+  aspectpad -a ASPECT -m l infile tmp
+  convert tmp -resize WxH outfile
+  burn_caption(outfile)
+without the temp file, the extra lossy saves or the subprocesses.
+
+The one encode takes the output settings (see jpeg_encoding) and the
+header segments to carry over (see metadata.header_segments), so no
+later pass is needed to compress or re-tag the frames.
+'''
+
+import io
+
+from PIL import Image, JpegImagePlugin
+
+from digframe import layout
+from digframe import metadata
+from digframe import thumbs
+from digframe.metrics import stage
+
+DEFAULT_TTF = '/usr/share/fonts/truetype/msttcorefonts/arialbd.ttf'
+
+# Pillow keeps an RGB pixel in 4 bytes.
+BYTES_PER_PIXEL = 4
+# Scale factors libjpeg can decode at directly (see draft_to).
+DCT_SCALES = (1, 2, 4, 8)
+
+
+SUBSAMPLINGS = ['4:4:4', '4:2:2', '4:2:0', 'keep']
+# Range of quality encode_jpeg_to_size searches.
+MIN_QUALITY = 20
+MAX_QUALITY = 95
+
+
+def jpeg_encoding(quality=75, subsampling=None, progressive=False,
+                  optimize=False, keep_qtables=False):
+    '''RETURNS: dict of output encoder settings for encode_jpeg.
+SUBSAMPLING is one of SUBSAMPLINGS ("keep": as the source) or None for
+the encoder default. KEEP_QTABLES reuses the quantization tables of the
+source, in which case QUALITY is not used.'''
+    encoding = dict(quality=quality, progressive=progressive,
+                    optimize=optimize)
+    if subsampling is not None:
+        encoding['subsampling'] = subsampling
+    if keep_qtables:
+        encoding['keep_qtables'] = True
+    return encoding
+
+# What PIL does with no options; outputs made with it match older runs.
+DEFAULT_ENCODING = jpeg_encoding()
+
+def lowest_encoding(encoding=None):
+    '''RETURNS: ENCODING (from jpeg_encoding, None: the default) at
+MIN_QUALITY, the smallest that encode_jpeg_to_size goes to.'''
+    encoding = dict(encoding or DEFAULT_ENCODING, quality=MIN_QUALITY)
+    encoding.pop('keep_qtables', None)
+    return encoding
+
+def needs_source(encoding):
+    '''True iff ENCODING takes settings from the source JPEG.'''
+    return bool(encoding) and (encoding.get('keep_qtables', False)
+                               or encoding.get('subsampling') == 'keep')
+
+def save_options(encoding=None, source=None, header=None):
+    '''RETURNS: keyword arguments for Image.save(..., 'JPEG').
+ENCODING: from jpeg_encoding (None: PIL defaults).
+SOURCE: opened (need not be loaded) source image; required when
+  needs_source(ENCODING).
+HEADER: from metadata.header_segments, or None.'''
+    options = dict(encoding or {})
+    keep_qtables = options.pop('keep_qtables', False)
+    if source is not None and getattr(source, 'format', None) == 'JPEG':
+        if keep_qtables:
+            # PIL scales given tables by the quality; without one they
+            # are used as they are.
+            options['qtables'] = source.quantization
+            options.pop('quality', None)
+        if options.get('subsampling') == 'keep':
+            options['subsampling'] = JpegImagePlugin.get_sampling(source)
+    if options.get('subsampling') == 'keep':
+        del options['subsampling'] # no JPEG source to keep it from
+    options.update(header or {})
+    return options
+
+def decodes(filename):
+    '''True iff the image FILENAME decodes to the end, e.g. it was not
+cut short by an interrupted write. JPEGs are decoded at the smallest
+DCT scale, which still reads all of the data.'''
+    try:
+        with Image.open(filename) as im:
+            im.draft('RGB', (1, 1))
+            im.load()
+    except (OSError, SyntaxError, ValueError):
+        return False
+    return True
+
+def fit_geometry(width, height, target_width, target_height):
+    '''RETURNS: (content_width, content_height, x_offset, y_offset) of an
+image of WIDTH x HEIGHT padded to the target aspect and resized to
+TARGET_WIDTH x TARGET_HEIGHT.'''
+    scale = min(float(target_width)/width, float(target_height)/height)
+    cw = min(target_width, max(1, int(round(width*scale))))
+    ch = min(target_height, max(1, int(round(height*scale))))
+    return (cw, ch, (target_width-cw)//2, (target_height-ch)//2)
+
+def crop_request(width, height, box, target_width, target_height):
+    '''RETURNS: size a WIDTH x HEIGHT image must be decoded at for its
+BOX (left, top, right, bottom) to cover TARGET_WIDTH x TARGET_HEIGHT.'''
+    (left, top, right, bottom) = box
+    return (-(-target_width*width//(right - left)),
+            -(-target_height*height//(bottom - top)))
+
+def draft_to(im, size):
+    '''Have libjpeg decode IM at the smallest DCT scale (1/2, 1/4, 1/8)
+that is still no smaller than SIZE. The final resample then starts from
+a much smaller image. Must be called before the pixels are loaded.
+No-op for non-JPEG.'''
+    if im.format == 'JPEG':
+        im.draft('RGB', size)
+    return im
+
+def jpeg_scale(width, height, size):
+    '''RETURNS: the DCT scale that draft_to(SIZE) picks for a
+WIDTH x HEIGHT JPEG (mirrors JpegImageFile.draft).'''
+    ratio = min(width // max(1, size[0]), height // max(1, size[1]))
+    return max(s for s in DCT_SCALES if s <= max(1, ratio))
+
+def scaled_size(width, height, scale):
+    '''RETURNS: size of a WIDTH x HEIGHT JPEG decoded at SCALE.'''
+    return ((width + scale - 1)//scale, (height + scale - 1)//scale)
+
+def memory_scale(width, height, max_bytes):
+    '''RETURNS: smallest DCT scale at which a WIDTH x HEIGHT JPEG decodes
+into MAX_BYTES or less (the largest scale when none does).'''
+    for scale in DCT_SCALES:
+        (w, h) = scaled_size(width, height, scale)
+        if w*h*BYTES_PER_PIXEL <= max_bytes:
+            return scale
+    return DCT_SCALES[-1]
+
+def decode_request(width, height, sizes, draft=True, max_bytes=None,
+                   crops=None):
+    '''RETURNS: size to pass to draft_to when framing a WIDTH x HEIGHT
+JPEG to each of SIZES, or None to decode at full size.
+DRAFT asks for the largest picture area (or, for a size with a crop box
+in CROPS, enough to fill the frame from the box). MAX_BYTES caps the
+decoded image, scaling it down further (even without DRAFT) if need be.'''
+    request = None
+    if draft:
+        crops = crops or [None]*len(sizes)
+        areas = [fit_geometry(width, height, w, h) if box is None
+                 else crop_request(width, height, box, w, h)
+                 for ((w, h), box) in zip(sizes, crops)]
+        request = (max(a[0] for a in areas), max(a[1] for a in areas))
+    if max_bytes:
+        scale = memory_scale(width, height, max_bytes)
+        if scale > 1:
+            cap = (max(1, width//scale), max(1, height//scale))
+            request = cap if request is None else (min(request[0], cap[0]),
+                                                   min(request[1], cap[1]))
+    return request
+
+def frame_memory(width, height, sizes, draft=True, max_bytes=None,
+                 crops=None):
+    '''RETURNS: estimated peak bytes of frame_images for a WIDTH x HEIGHT
+JPEG: the decoded image plus a picture area and a frame per size.'''
+    request = decode_request(width, height, sizes, draft=draft,
+                             max_bytes=max_bytes, crops=crops)
+    scale = 1 if request is None else jpeg_scale(width, height, request)
+    (w, h) = scaled_size(width, height, scale)
+    return w*h*BYTES_PER_PIXEL + frames_memory(sizes)
+
+def frames_memory(sizes):
+    '''RETURNS: bytes of a picture area and a frame for each of SIZES.'''
+    return sum(2*tw*th for (tw, th) in sizes)*BYTES_PER_PIXEL
+
+def letterbox(content, target_width, target_height, background='black'):
+    '''Center CONTENT on a TARGET_WIDTH x TARGET_HEIGHT frame.'''
+    if content.size == (target_width, target_height):
+        return content
+    frame = Image.new('RGB', (target_width, target_height), background)
+    frame.paste(content, ((target_width-content.size[0])//2,
+                          (target_height-content.size[1])//2))
+    return frame
+
+def draw_caption(im, caption, ttf=DEFAULT_TTF, size=layout.CAPTION_SIZE):
+    '''Burn CAPTION at bottom/center of IM (in place), wrapped and cut
+to its width (see layout.py).'''
+    (width,height) = im.size
+    bar = layout.caption_bitmap(caption, ttf, size, width)
+    im.paste(bar, (0, height-bar.size[1]))
+    return im
+
+def burn_caption_file(filename, caption, ttf=DEFAULT_TTF, encoding=None):
+    '''Burn CAPTION into the JPEG FILENAME (in place). The file's own
+IPTC caption and Exif dates are written back.'''
+    hdr = metadata.read_metadata(filename)
+    im = Image.open(filename)
+    options = save_options(encoding, source=im,
+                           header=metadata.header_segments(
+                               hdr.caption, hdr.date_digitized,
+                               hdr.date_original))
+    draw_caption(im, caption, ttf=ttf)
+    im.save(filename, 'JPEG', **options)
+
+def frame_image(src, target_width, target_height,
+                caption=None, ttf=DEFAULT_TTF, draft=True, metrics=None,
+                max_bytes=None):
+    '''RETURNS: framed and captioned image of SRC (a path or file object).
+No caption is drawn when CAPTION is None.
+DRAFT=False decodes at full size for pixel-exact output.
+MAX_BYTES bounds the decoded image (see decode_request).
+METRICS (a metrics.FileMetrics) gets decode/resize/caption times.'''
+    return frame_images(src, [(target_width, target_height)],
+                        caption=caption, ttf=ttf, draft=draft,
+                        metrics=metrics, max_bytes=max_bytes)[0]
+
+def frame_images(src, sizes, caption=None, ttf=DEFAULT_TTF, draft=True,
+                 metrics=None, max_bytes=None, crops=None):
+    '''Like frame_image, but for several (width, height) SIZES from a
+single decode. Resizes cascade from the largest picture area down, each
+starting from the previous (smaller than source) result when it is big
+enough. CROPS (parallel to SIZES) gives a source box (left, top, right,
+bottom, in pixels of the full-size source) that fills the frame instead
+of padding the whole picture, or None (see planning).
+RETURNS: list of images in the order of SIZES.'''
+    crops = crops or [None]*len(sizes)
+    with stage(metrics, 'decode'):
+        im = Image.open(src)
+        (source_width, source_height) = im.size
+        request = decode_request(im.size[0], im.size[1], sizes,
+                                 draft=draft, max_bytes=max_bytes, crops=crops)
+        if request is not None:
+            draft_to(im, request)
+        im.load()
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+    (width, height) = im.size
+    geometry = [fit_geometry(width, height, w, h) for (w, h) in sizes]
+    order = sorted(range(len(sizes)),
+                   key=lambda i: -geometry[i][0]*geometry[i][1])
+    frames = [None]*len(sizes)
+    previous = im
+    for i in order:
+        (w, h) = sizes[i]
+        (cw, ch, x, y) = geometry[i]
+        if crops[i] is not None:
+            # Box of the (possibly draft scaled) decode; no cascade.
+            (sx, sy) = (width/source_width, height/source_height)
+            (left, top, right, bottom) = crops[i]
+            with stage(metrics, 'resize'):
+                frame = im.resize((w, h), Image.LANCZOS,
+                                  box=(left*sx, top*sy, right*sx, bottom*sy))
+            if caption is not None:
+                with stage(metrics, 'caption'):
+                    draw_caption(frame, caption, ttf=ttf)
+            frames[i] = frame
+            continue
+        with stage(metrics, 'resize'):
+            base = previous
+            if base.size[0] < cw or base.size[1] < ch:
+                base = im
+            content = base if base.size == (cw, ch) else base.resize(
+                (cw, ch), Image.LANCZOS)
+            frame = letterbox(content, w, h)
+        if caption is not None:
+            with stage(metrics, 'caption'):
+                if frame is content or frame is im:
+                    frame = frame.copy() # CONTENT is reused by the cascade
+                draw_caption(frame, caption, ttf=ttf)
+        frames[i] = frame
+        previous = content
+    return frames
+
+def encode_jpeg(im, metrics=None, options=None):
+    '''RETURNS: IM as JPEG bytes. OPTIONS as from save_options.'''
+    with stage(metrics, 'encode'):
+        buf = io.BytesIO()
+        im.save(buf, 'JPEG', **(options or {}))
+        return buf.getvalue()
+
+def encode_jpeg_to_size(im, max_bytes, metrics=None, options=None):
+    '''RETURNS: IM as JPEG bytes of at most MAX_BYTES (header included)
+at the highest quality, up to that of OPTIONS, that fits. Found by a
+binary search on in-memory encodes, so about 7 encodes at worst and 1
+when OPTIONS already fit. When they do not, quantization tables of
+OPTIONS are dropped (quality picks the tables; below MAX_QUALITY when
+OPTIONS had tables rather than a quality). When not even MIN_QUALITY
+fits, that (too large) encode is returned.'''
+    options = dict(options or {})
+    data = encode_jpeg(im, metrics=metrics, options=options)
+    if len(data) <= max_bytes:
+        return data
+    options.pop('qtables', None)
+    (low, high) = (MIN_QUALITY, options.pop('quality', MAX_QUALITY + 1) - 1)
+    best = None
+    while low <= high:
+        quality = (low + high)//2
+        data = encode_jpeg(im, metrics=metrics,
+                           options=dict(options, quality=quality))
+        if len(data) <= max_bytes:
+            best = data
+            low = quality + 1
+        else:
+            high = quality - 1
+    return data if best is None else best
+
+def _source_options(src, encoding, header):
+    source = Image.open(src) if needs_source(encoding) else None
+    return save_options(encoding, source=source, header=header)
+
+def render_frame(infile, outfile, target_width, target_height,
+                 caption=None, ttf=DEFAULT_TTF, draft=True, metrics=None,
+                 max_bytes=None, encoding=None, header=None):
+    '''Single decode/encode replacement for aspectpad + convert + burn.
+ENCODING and HEADER are as for save_options.'''
+    im = frame_image(infile, target_width, target_height,
+                     caption=caption, ttf=ttf, draft=draft, metrics=metrics,
+                     max_bytes=max_bytes)
+    with stage(metrics, 'encode'):
+        im.save(outfile, 'JPEG', **_source_options(infile, encoding, header))
+    return im.size
+
+def render_frame_bytes(data, target_width, target_height,
+                       caption=None, ttf=DEFAULT_TTF, draft=True, metrics=None,
+                       max_bytes=None, encoding=None, header=None, crop=None):
+    '''In-memory render_frame: JPEG bytes in, JPEG bytes out.
+CROP is a source box to fill the frame with (see frame_images).'''
+    return render_frames_bytes(data, [(target_width, target_height)],
+                               caption=caption, ttf=ttf, draft=draft,
+                               metrics=metrics, max_bytes=max_bytes,
+                               encoding=encoding, header=header,
+                               crops=[crop])[0]
+
+def render_frames_bytes(data, sizes, caption=None, ttf=DEFAULT_TTF,
+                        draft=True, metrics=None, max_bytes=None,
+                        encoding=None, header=None, crops=None,
+                        thumb_sizes=None, target_bytes=None):
+    '''In-memory frame_images: JPEG bytes in, list of JPEG bytes out.
+TARGET_BYTES caps each output; see encode_jpeg_to_size.
+With THUMB_SIZES (parallel to SIZES), RETURNS a list of (JPEG bytes,
+raw RGB thumbnail bytes) instead; thumbnails are made from the frames
+(see thumbs.py).'''
+    frames = frame_images(io.BytesIO(data), sizes, caption=caption, ttf=ttf,
+                          draft=draft, metrics=metrics, max_bytes=max_bytes,
+                          crops=crops)
+    options = _source_options(io.BytesIO(data), encoding, header)
+    if target_bytes:
+        datas = [encode_jpeg_to_size(im, target_bytes, metrics=metrics,
+                                     options=options) for im in frames]
+    else:
+        datas = [encode_jpeg(im, metrics=metrics, options=options)
+                 for im in frames]
+    if thumb_sizes is None:
+        return datas
+    with stage(metrics, 'thumbnail'):
+        return [(d, thumbs.thumbnail(im, size))
+                for (d, im, size) in zip(datas, frames, thumb_sizes)]
@@ -0,0 +1,161 @@
+'''The frame job both command line tools run: one source in, its frame
+images out, with the caption burned in and the caption and dates
+copied into the header.
+
+FrameJob does the whole job when called, or the same work in the
+read/transform/write stages of pipeline.Pipeline; supervise.Isolated
+and supervise.SupervisedExecutor run it as they are. Outputs are
+written by way of a temporary file (see write_file), so a killed run
+never leaves one half written.
+'''
+
+import os
+import os.path
+import datetime as dt
+
+from digframe import imaging
+from digframe import metadata
+from digframe import metrics
+
+
+def get_metadata(filename, cache=None, stat=None):
+    '''RETURNS: dict(width, height, caption, date, date_original).
+DATE is EXIF DateTimeDigitized (or 1900-01-01 when there is none).
+CACHE is an optional mdcache.MetadataCache consulted before the file.
+STAT is (size, mtime_ns) of FILENAME if already known.'''
+    if cache is None:
+        hdr = metadata.read_metadata(filename)
+    else:
+        hdr = cache.read_metadata(filename, stat=stat)
+    md = hdr._asdict()
+    md['date'] = md.pop('date_digitized') or dt.datetime(1900,1,1)
+    return md
+
+def output_header(md):
+    '''RETURNS: header segments (see metadata.header_segments) that carry
+the caption and dates of a source with metadata MD into its frame.'''
+    digitized = md['date'] if md['date'].year != 1900 else None
+    return metadata.header_segments(md['caption'], digitized,
+                                    md['date_original'])
+
+def write_file(filename, data):
+    '''Write DATA to FILENAME by way of a temporary file in the same
+directory, so that FILENAME is never left half written (e.g. by a
+killed run): it is either as before or complete.'''
+    (dirname, basename) = os.path.split(filename)
+    tmp = os.path.join(dirname, '.{}.{}.tmp'.format(basename, os.getpid()))
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class FrameJob():
+    '''Create the frame images of one source per task. Calling the job
+does the whole thing; read/transform/write are the same work split into
+stages for pipeline.Pipeline. TASK is (cnt, root, fname, md, todo)
+where MD is from get_metadata and TODO lists (index into SIZES, output
+filename, crop box or None).
+The caption is that of MD (DEFAULT_CAPTION when it has none; None: no
+caption at all), after the digitized date when DATE_IN_CAPTION.
+MAX_BYTES (if given) is the memory allowed for one task.
+ENCODING (see imaging.jpeg_encoding) is that of the outputs; with
+COPY_METADATA they carry the caption and dates (see output_header).
+The job RETURNS (FileMetrics, thumbnails) where THUMBNAILS has the
+raw RGB thumbnail (see thumbs.py) of each of TODO when THUMB_SIZES
+(parallel to SIZES) is given, else None.
+IMAGE_BYTES caps each output (see imaging.encode_jpeg_to_size).'''
+    def __init__(self, date_in_caption, sizes, draft,
+                 ttf=imaging.DEFAULT_TTF, max_bytes=None,
+                 encoding=None, copy_metadata=True, thumb_sizes=None,
+                 image_bytes=None, default_caption=''):
+        self.date_in_caption = date_in_caption
+        self.sizes = sizes
+        self.thumb_sizes = thumb_sizes
+        self.image_bytes = image_bytes
+        self.draft = draft
+        self.ttf = ttf
+        self.max_bytes = max_bytes
+        self.encoding = encoding
+        self.copy_metadata = copy_metadata
+        self.default_caption = default_caption
+
+    def caption(self, md):
+        caption = md['caption'] or self.default_caption
+        if caption is None:
+            return None
+        digdate = md['date'] if self.date_in_caption else False
+        return metadata.caption_text(digdate, caption, maxCapLen=None)
+
+    def __call__(self, task):
+        return self.write(task, self.transform(task, self.read(task)))
+
+    def task_sizes(self, task):
+        return [self.sizes[ti] for (ti, f, box) in task[4]]
+
+    def task_crops(self, task):
+        return [box for (ti, f, box) in task[4]]
+
+    def decode_bytes(self, task):
+        '''RETURNS: the part of MAX_BYTES left for the decoded source
+once the frames of TASK are allowed for (None when unbounded).'''
+        if self.max_bytes is None:
+            return None
+        return max(1, self.max_bytes - imaging.frames_memory(self.task_sizes(task)))
+
+    def memory(self, task):
+        '''RETURNS: estimated peak bytes of TASK (source file included).'''
+        (cnt, root, fname, md, todo) = task
+        return (imaging.frame_memory(md['width'], md['height'],
+                                     self.task_sizes(task), draft=self.draft,
+                                     max_bytes=self.decode_bytes(task),
+                                     crops=self.task_crops(task))
+                + os.path.getsize(os.path.join(root, fname)))
+
+    # Each stage passes along (FileMetrics, data); write returns the
+    # FileMetrics so timings come back from worker processes (and the
+    # thumbnails, which go into the index in the main process).
+
+    def read(self, task):
+        (cnt, root, fname, md, todo) = task
+        fm = metrics.FileMetrics(os.path.join(root,fname))
+        with fm.stage('read'):
+            with open(fm.path, 'rb') as f:
+                data = f.read()
+        fm.bytes_read += len(data)
+        return (fm, data)
+
+    def transform(self, task, staged):
+        (cnt, root, fname, md, todo) = task
+        (fm, data) = staged
+        return (fm, imaging.render_frames_bytes(data, self.task_sizes(task),
+                                                caption=self.caption(md),
+                                                ttf=self.ttf, draft=self.draft,
+                                                metrics=fm,
+                                                max_bytes=self.decode_bytes(task),
+                                                encoding=self.encoding,
+                                                header=(output_header(md)
+                                                        if self.copy_metadata
+                                                        else None),
+                                                crops=self.task_crops(task),
+                                                target_bytes=self.image_bytes,
+                                                thumb_sizes=(
+                                                    None if self.thumb_sizes is None
+                                                    else [self.thumb_sizes[ti]
+                                                          for (ti, f, box) in task[4]])))
+
+    def write(self, task, staged):
+        (cnt, root, fname, md, todo) = task
+        (fm, datas) = staged
+        thumbnails = None
+        if self.thumb_sizes is not None:
+            thumbnails = [t for (d, t) in datas]
+            datas = [d for (d, t) in datas]
+        with fm.stage('write'):
+            for ((ti, newfile, box), data) in zip(todo, datas):
+                write_file(newfile, data)
+                fm.bytes_written += len(data)
+        return (fm, thumbnails)
@@ -0,0 +1,103 @@
+'''Lay out captions on the pixel width of a frame.
+
+A caption that does not fit on one line is wrapped at spaces (a word
+wider than the frame is broken), on pixel measurements of the actual
+font. What does not fit in MAX_LINES lines is cut and ends in an
+ellipsis. The layout and the rendered caption bar are cached per
+(caption, font, size, width): albums repeat the same caption (or date
+prefix and caption) over many photos, and each is laid out once.
+'''
+
+import functools
+from collections import namedtuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+CAPTION_SIZE = 15 # points
+MAX_LINES = 2
+LINE_GAP = 2 # pixels between lines
+PADDING = 4 # pixels above the text
+ELLIPSIS = '...'
+
+Layout = namedtuple('Layout', ['lines', 'truncated'])
+
+
+# Fonts and text measurements are cached per process; in a batch they
+# are the same for nearly every image.
+
+@functools.lru_cache(maxsize=None)
+def load_font(ttf, size):
+    return ImageFont.truetype(ttf, size)
+
+@functools.lru_cache(maxsize=4096)
+def text_size(text, ttf, size):
+    return _measure(load_font(ttf, size), text)
+
+def _measure(font, text):
+    # FreeTypeFont.getsize is gone from newer Pillow releases.
+    if hasattr(font, 'getbbox'):
+        (left, top, right, bottom) = font.getbbox(text)
+        return (right, bottom)
+    return font.getsize(text)
+
+def _longest(text, fits):
+    '''RETURNS: largest N (at least 1) such that FITS(TEXT[:N]).'''
+    (low, high) = (1, len(text))
+    while low < high:
+        mid = (low + high + 1)//2
+        if fits(text[:mid]):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+@functools.lru_cache(maxsize=4096)
+def layout_caption(caption, ttf, size, width, max_lines=MAX_LINES):
+    '''RETURNS: Layout(lines, truncated) of CAPTION in at most MAX_LINES
+lines no wider than WIDTH pixels. TRUNCATED is True iff text was cut
+(the last line then ends in ELLIPSIS).'''
+    font = load_font(ttf, size)
+    fits = lambda text: _measure(font, text)[0] <= width
+    if fits(caption):
+        return Layout((caption,), False)
+    lines = list()
+    line = ''
+    for word in caption.split():
+        candidate = word if not line else line + ' ' + word
+        if fits(candidate):
+            line = candidate
+            continue
+        if line:
+            lines.append(line)
+        while not fits(word):
+            cut = _longest(word, fits)
+            lines.append(word[:cut])
+            word = word[cut:]
+        line = word
+    if line:
+        lines.append(line)
+    if len(lines) <= max_lines:
+        return Layout(tuple(lines), False)
+    rest = ' '.join(lines[max_lines-1:])
+    cut = _longest(rest, lambda text: fits(text.rstrip() + ELLIPSIS))
+    last = rest[:cut].rstrip() + ELLIPSIS
+    return Layout(tuple(lines[:max_lines-1]) + (last,), True)
+
+@functools.lru_cache(maxsize=64)
+def caption_bitmap(caption, ttf, size, width, max_lines=MAX_LINES,
+                   fill='gray', color='cornsilk'):
+    '''RETURNS: caption bar (RGB image WIDTH wide) with CAPTION laid out
+(see layout_caption) and drawn centered, line by line. The image is
+shared by all callers; paste it, do not change it.'''
+    font = load_font(ttf, size)
+    lines = layout_caption(caption, ttf, size, width, max_lines).lines
+    sizes = [text_size(line, ttf, size) for line in lines]
+    height = PADDING + sum(h for (w, h) in sizes) + LINE_GAP*(len(lines) - 1)
+    bar = Image.new('RGB', (width, height), fill)
+    draw = ImageDraw.Draw(bar)
+    y = PADDING
+    for line, (w, h) in zip(lines, sizes):
+        x = max(0, int(round((width - w)/2)))
+        draw.text((x, y), line, font=font, fill=color)
+        y += h + LINE_GAP
+    return bar
@@ -0,0 +1,181 @@
+'''Build manifest kept in an output directory.
+
+Maps each source image to the signature it was built from and the
+output file it produced:
+  {source: {'sig': {...}, 'output': basename}}
+The manifest is loaded once per run so deciding what to rebuild is a
+dict lookup per source rather than a directory scan.
+
+An output basename may be in a subdirectory of the output directory
+("0001/00001-name.jpg", see ordering.py); one level is listed.
+
+Several processes (shards, see shards.py) can share an output directory.
+Each writes its own manifest file (see manifest_name) and reads the
+others, so a source built by any of them is up to date for all.
+'''
+
+import os
+import os.path
+import json
+import glob
+import hashlib
+
+MANIFEST_NAME = '.digframe-manifest.json'
+
+
+def manifest_name(worker=None):
+    '''RETURNS: manifest file name for WORKER (None: the only worker).'''
+    if worker is None:
+        return MANIFEST_NAME
+    return '.digframe-manifest.{}.json'.format(worker)
+
+
+def caption_hash(caption):
+    return hashlib.sha1(caption.encode('utf-8')).hexdigest()
+
+def signature(size, mtime_ns, caption, target_width, target_height, **options):
+    '''Everything that, if changed, requires the output to be rebuilt.'''
+    return dict(size=size, mtime_ns=mtime_ns,
+                caption=caption_hash(caption),
+                target='{}x{}'.format(target_width, target_height),
+                options=options)
+
+class Manifest():
+    def __init__(self, outdir, name=MANIFEST_NAME):
+        self.outdir = outdir
+        self.filename = os.path.join(outdir, name)
+        self.entries = dict() # Ours; the only ones changed or saved.
+        self.others = dict()  # From the manifests of other workers.
+        for filename in sorted(glob.glob(os.path.join(
+                glob.escape(outdir), '.digframe-manifest*.json'))):
+            with open(filename) as f:
+                entries = json.load(f)
+            if filename == self.filename:
+                self.entries = entries
+            else:
+                self.others.update(entries)
+        # One listing of OUTDIR (and its subdirectories) for the whole run.
+        self.outputs = set()
+        if os.path.isdir(outdir):
+            for entry in os.scandir(outdir):
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    self.outputs.update('{}/{}'.format(entry.name, name)
+                                        for name in os.listdir(entry.path))
+                else:
+                    self.outputs.add(entry.name)
+
+    def current_output(self, source, sig):
+        '''RETURNS: output basename if SOURCE was built with SIG and the
+output still exists, else None.'''
+        entry = self.entry(source)
+        if (entry is not None and entry['sig'] == sig
+            and entry['output'] in self.outputs):
+            return entry['output']
+        return None
+
+    def entry(self, source):
+        return self.entries.get(source, self.others.get(source))
+
+    def previous_output(self, source):
+        entry = self.entry(source)
+        return None if entry is None else entry['output']
+
+    def record(self, source, sig, output):
+        self.entries[source] = dict(sig=sig, output=output)
+        self.outputs.add(output)
+
+    def recorded_outputs(self):
+        '''RETURNS: set of the output basenames of our entries.'''
+        return set(e['output'] for e in self.entries.values())
+
+    def untracked_outputs(self, parse_name):
+        '''RETURNS: dict[key] => output basename for files in outdir that
+no manifest entry accounts for. PARSE_NAME maps an output basename to
+its key (or None to ignore the file). Used to adopt outputs written
+before there was a manifest.'''
+        tracked = set(e['output'] for e in self.entries.values())
+        tracked.update(e['output'] for e in self.others.values())
+        untracked = dict()
+        for name in self.outputs - tracked:
+            key = parse_name(name)
+            if key is not None:
+                untracked[key] = name
+        return untracked
+
+    def remove_missing(self, seen):
+        '''Delete outputs (and our entries) of sources not in SEEN that no
+longer exist. A source that is still there but was not SEEN (left out
+by --include, --exclude or --check_magic) keeps its output.
+RETURNS: list of removed output basenames.'''
+        removed = list()
+        for source in sorted(set(self.entries) - set(seen)):
+            if os.path.exists(source):
+                continue
+            output = self.entries.pop(source)['output']
+            self.remove_output(output)
+            removed.append(output)
+        return removed
+
+    def forget(self, source):
+        '''Drop the entry of SOURCE (e.g. now a duplicate of another).
+Its output is deleted unless another entry also uses it.
+RETURNS: the forgotten output basename (or None).'''
+        entry = self.entries.pop(source, None)
+        if entry is None:
+            return None
+        output = entry['output']
+        if all(e['output'] != output for e in self.entries.values()):
+            self.remove_output(output)
+        return output
+
+    def move_outputs(self, wanted):
+        '''Rename our outputs to WANTED (dict[source] => output basename),
+so outputs that only change name are not built again. Entries of other
+sources whose output is in the way are dropped.
+RETURNS: list of (old, new) output basenames.'''
+        moves = [(source, e['output']) for (source, e) in self.entries.items()
+                 if source in wanted and e['output'] != wanted[source]
+                 and e['output'] in self.outputs]
+        if not moves:
+            return []
+        taken = set(wanted.values())
+        for source in [s for (s, e) in self.entries.items()
+                       if s not in wanted and e['output'] in taken]:
+            del self.entries[source]
+        # Through temporary names, since outputs may swap names.
+        staged = list()
+        for n, (source, output) in enumerate(moves):
+            tmp = '.digframe-move-{}'.format(n)
+            os.replace(os.path.join(self.outdir, output),
+                       os.path.join(self.outdir, tmp))
+            self.remove_output(output)
+            staged.append((source, tmp))
+        for (source, tmp) in staged:
+            path = os.path.join(self.outdir, wanted[source])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(os.path.join(self.outdir, tmp), path)
+            self.entries[source]['output'] = wanted[source]
+            self.outputs.add(wanted[source])
+        return [(output, wanted[source]) for (source, output) in moves]
+
+    def remove_output(self, output):
+        path = os.path.join(self.outdir, output)
+        if os.path.exists(path):
+            os.remove(path)
+        self.outputs.discard(output)
+        if '/' in output:
+            try:
+                os.rmdir(os.path.dirname(path)) # Only if now empty
+            except OSError:
+                pass
+
+    def entry_bytes(self, source, sig, output):
+        '''RETURNS: bytes an entry takes in the saved manifest.'''
+        return len(json.dumps({source: dict(sig=sig, output=output)},
+                              sort_keys=True)) # {, } and ", " even out
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(tmp, self.filename)
@@ -0,0 +1,108 @@
+'''On-disk (SQLite) cache of JPEG header metadata.
+
+Entries are keyed by absolute path and are only used when the file
+size and mtime_ns still match. A changed file is re-read and its entry
+replaced; entries for files that are gone are removed by prune().
+'''
+
+import os
+import os.path
+import sqlite3
+import datetime as dt
+
+from digframe import metadata
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'digframe',
+                             'metadata.sqlite')
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    width INTEGER,
+    height INTEGER,
+    caption TEXT,
+    date_digitized TEXT,
+    date_original TEXT)'''
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class MetadataCache():
+    def __init__(self, dbfile=DEFAULT_CACHE, rebuild=False, commit_every=500):
+        dbdir = os.path.dirname(dbfile)
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        self.dbfile = dbfile
+        self.commit_every = commit_every
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(dbfile)
+        if rebuild:
+            self.db.execute('DROP TABLE IF EXISTS metadata')
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def read_metadata(self, filename, stat=None):
+        '''Cached equivalent of metadata.read_metadata(FILENAME).
+STAT is (size, mtime_ns) if the caller already has it.'''
+        path = os.path.abspath(filename)
+        if stat is None:
+            st = os.stat(path)
+            stat = (st.st_size, st.st_mtime_ns)
+        (size, mtime_ns) = stat
+        row = self.db.execute(
+            'SELECT width, height, caption, date_digitized, date_original '
+            'FROM metadata WHERE path=? AND size=? AND mtime_ns=?',
+            (path, size, mtime_ns)).fetchone()
+        if row is not None:
+            self.hits += 1
+            (width, height, caption, digitized, original) = row
+            return metadata.Metadata(width, height, caption,
+                                     _todate(digitized), _todate(original))
+        self.misses += 1
+        md = metadata.read_metadata(path)
+        self.db.execute(
+            'INSERT OR REPLACE INTO metadata VALUES (?,?,?,?,?,?,?,?)',
+            (path, size, mtime_ns, md.width, md.height, md.caption,
+             _fromdate(md.date_digitized), _fromdate(md.date_original)))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+        return md
+
+    def prune(self, topdir, seen):
+        '''Remove entries under TOPDIR whose path is not in SEEN and no
+longer exists (a file left out by the scan filters stays cached).'''
+        top = os.path.join(os.path.abspath(topdir), '')
+        seen = set(os.path.abspath(p) for p in seen)
+        stale = [path for (path,) in self.db.execute(
+            'SELECT path FROM metadata WHERE substr(path,1,?)=?',
+            (len(top), top))
+                 if path not in seen and not os.path.exists(path)]
+        self.db.executemany('DELETE FROM metadata WHERE path=?',
+                            [(p,) for p in stale])
+        self.commit()
+        return len(stale)
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def _fromdate(date):
+    return None if date is None else date.strftime(DATE_FORMAT)
+
+def _todate(text):
+    return None if text is None else dt.datetime.strptime(text, DATE_FORMAT)
@@ -0,0 +1,244 @@
+'''Read the JPEG header fields digframe needs without decoding the image.
+
+Only the marker segments in front of the compressed scan data are
+visited: SOFn for the size, APP1 (Exif) for the dates and APP13
+(Photoshop/IPTC) for the caption. Everything else is skipped with a
+seek, so typically only the first few tens of KB of a file are read.
+'''
+
+import struct
+import datetime as dt
+from collections import namedtuple
+
+Metadata = namedtuple('Metadata', ['width', 'height', 'caption',
+                                   'date_digitized', 'date_original'])
+
+EXIF_DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+# Start Of Frame markers (C4=DHT, C8=JPG, CC=DAC are not frames)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+# Markers that stand alone (no length field)
+STANDALONE_MARKERS = set([0x01, 0xD8]) | set(range(0xD0, 0xD8))
+
+TAG_EXIF_IFD = 0x8769
+TAG_DATE_ORIGINAL = 0x9003
+TAG_DATE_DIGITIZED = 0x9004
+
+IPTC_RESOURCE_ID = 0x0404
+IPTC_CAPTION = (2, 120)
+IPTC_CHARSET = (1, 90)
+IPTC_UTF8 = b'\x1b%G'
+
+
+def read_metadata(filename):
+    '''RETURNS: Metadata for the JPEG FILENAME.
+Raises ValueError if it is not a JPEG or has no frame header.'''
+    with open(filename, 'rb') as f:
+        return parse_jpeg_header(f)
+
+def parse_jpeg_header(f):
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError('Not a JPEG file')
+    width = height = None
+    caption = ''
+    dates = dict()
+    while True:
+        marker = _next_marker(f)
+        if marker is None or marker in (0xDA, 0xD9): # SOS or EOI
+            break
+        if marker in STANDALONE_MARKERS:
+            continue
+        hdr = f.read(2)
+        if len(hdr) < 2:
+            break
+        seglen = struct.unpack('>H', hdr)[0] - 2
+        if seglen < 0:
+            raise ValueError('Bad JPEG segment length')
+        if marker in SOF_MARKERS:
+            sof = f.read(5)
+            if len(sof) < 5 or seglen < 5:
+                raise ValueError('Truncated JPEG header')
+            (height, width) = struct.unpack('>xHH', sof)
+            f.seek(seglen-5, 1)
+        elif marker == 0xE1:
+            data = f.read(seglen)
+            if data.startswith(b'Exif\x00\x00'):
+                dates.update(parse_exif_dates(data[6:]))
+        elif marker == 0xED:
+            data = f.read(seglen)
+            if data.startswith(b'Photoshop 3.0\x00'):
+                caption = caption or parse_photoshop_caption(data[14:])
+        else:
+            f.seek(seglen, 1)
+    if width is None:
+        raise ValueError('No frame header (SOF) before image data')
+    return Metadata(width, height, caption,
+                    dates.get(TAG_DATE_DIGITIZED),
+                    dates.get(TAG_DATE_ORIGINAL))
+
+def scan_offset(f):
+    '''RETURNS: offset in F of the first SOS (start of scan) marker, where
+the compressed image data begins, or 0 if there is none.'''
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        return 0
+    while True:
+        marker = _next_marker(f)
+        if marker is None or marker == 0xD9:
+            return 0
+        if marker == 0xDA:
+            return f.tell() - 2
+        if marker in STANDALONE_MARKERS:
+            continue
+        hdr = f.read(2)
+        seglen = struct.unpack('>H', hdr)[0] - 2 if len(hdr) == 2 else -1
+        if seglen < 0:
+            return 0
+        f.seek(seglen, 1)
+
+def _next_marker(f):
+    byte = f.read(1)
+    while byte and byte != b'\xff':
+        byte = f.read(1)
+    while byte == b'\xff':  # fill bytes
+        byte = f.read(1)
+    return ord(byte) if byte else None
+
+def parse_exif_date(value):
+    try:
+        return dt.datetime.strptime(value.strip(), EXIF_DATE_FORMAT)
+    except ValueError:
+        return None
+
+def parse_exif_dates(tiff):
+    '''RETURNS: dict[tag] => datetime for the Exif date tags in TIFF.'''
+    dates = dict()
+    try:
+        order = {b'II': '<', b'MM': '>'}[tiff[:2]]
+        ifd0 = struct.unpack(order+'L', tiff[4:8])[0]
+        exif_ifd = _ifd_entries(tiff, order, ifd0).get(TAG_EXIF_IFD)
+        if exif_ifd is None:
+            return dates
+        entries = _ifd_entries(tiff, order, exif_ifd[2])
+        for tag in (TAG_DATE_DIGITIZED, TAG_DATE_ORIGINAL):
+            if tag not in entries:
+                continue
+            (typ, count, value, raw) = entries[tag]
+            if typ != 2: # ASCII
+                continue
+            data = raw if count <= 4 else tiff[value:value+count]
+            date = parse_exif_date(data.split(b'\x00')[0].decode('ascii','replace'))
+            if date is not None:
+                dates[tag] = date
+    except (KeyError, IndexError, struct.error):
+        pass
+    return dates
+
+def _ifd_entries(tiff, order, offset):
+    '''RETURNS: dict[tag] => (type, count, value, raw_value_bytes)'''
+    entries = dict()
+    count = struct.unpack(order+'H', tiff[offset:offset+2])[0]
+    for i in range(count):
+        pos = offset + 2 + 12*i
+        (tag, typ, cnt) = struct.unpack(order+'HHL', tiff[pos:pos+8])
+        raw = tiff[pos+8:pos+12]
+        entries[tag] = (typ, cnt, struct.unpack(order+'L', raw)[0], raw)
+    return entries
+
+def parse_photoshop_caption(data):
+    '''RETURNS: IPTC 2:120 caption found in Photoshop image resources.'''
+    pos = 0
+    try:
+        while data[pos:pos+4] == b'8BIM':
+            resid = struct.unpack('>H', data[pos+4:pos+6])[0]
+            namelen = data[pos+6]
+            pos += 6 + namelen + 1 + ((namelen + 1) % 2) # even padded
+            size = struct.unpack('>L', data[pos:pos+4])[0]
+            pos += 4
+            if resid == IPTC_RESOURCE_ID:
+                return parse_iptc_caption(data[pos:pos+size])
+            pos += size + (size % 2)
+    except (IndexError, struct.error):
+        pass
+    return ''
+
+def parse_iptc_caption(iim):
+    datasets = dict()
+    pos = 0
+    while pos + 5 <= len(iim) and iim[pos] == 0x1C:
+        (record, dataset, size) = struct.unpack('>BBH', iim[pos+1:pos+5])
+        pos += 5
+        if size & 0x8000: # extended dataset; size is in the next N bytes
+            nbytes = size & 0x7FFF
+            size = int.from_bytes(iim[pos:pos+nbytes], 'big')
+            pos += nbytes
+        datasets.setdefault((record, dataset), iim[pos:pos+size])
+        pos += size
+    raw = datasets.get(IPTC_CAPTION)
+    if raw is None:
+        return ''
+    if datasets.get(IPTC_CHARSET) == IPTC_UTF8:
+        return raw.decode('utf-8', 'replace')
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+def caption_text(digitizedDate, caption='', maxCapLen=148):
+    '''RETURNS: the text burned into a frame: CAPTION, prefixed by the
+DIGITIZEDDATE (unless None or 1900), at most MAXCAPLEN characters
+(None: any length; the frame layout fits it, see layout.py).'''
+    if digitizedDate and digitizedDate.year != 1900:
+        if (caption == '' ):
+            # use digitized date/time for caption
+            caption = digitizedDate.strftime('%a %m/%d/%Y %M:%H:%S')
+        else:
+            # prepend digitized year to caption
+            caption = '{}: {}'.format(digitizedDate.strftime('%m/%d/%y'), caption)
+    if maxCapLen is None or len(caption) <= maxCapLen:
+        return caption
+    return caption[:maxCapLen-3]+'...'
+
+##############################################################################
+# Writing: the same fields as header segments for an output JPEG.
+
+IPTC_CAPTION_MAX = 2000 # bytes, per the IIM spec for 2:120
+
+def exif_dates_payload(date_digitized=None, date_original=None):
+    '''RETURNS: APP1 payload (b"Exif\\0\\0" + TIFF) holding the Exif date
+tags, or b"" when there are none.'''
+    dates = [(tag, date) for (tag, date) in ((TAG_DATE_ORIGINAL, date_original),
+                                             (TAG_DATE_DIGITIZED, date_digitized))
+             if date is not None]
+    if not dates:
+        return b''
+    exif_ifd = 8 + 2 + 12 + 4 # after the header and IFD0 (one entry)
+    data = exif_ifd + 2 + 12*len(dates) + 4
+    tiff = b'MM\x00\x2a' + struct.pack('>L', 8)
+    tiff += struct.pack('>HHHLLL', 1, TAG_EXIF_IFD, 4, 1, exif_ifd, 0)
+    tiff += struct.pack('>H', len(dates))
+    values = b''
+    for (tag, date) in dates:
+        text = date.strftime(EXIF_DATE_FORMAT).encode('ascii') + b'\x00'
+        tiff += struct.pack('>HHLL', tag, 2, len(text), data + len(values))
+        values += text
+    return b'Exif\x00\x00' + tiff + struct.pack('>L', 0) + values
+
+def iptc_segment(caption):
+    '''RETURNS: APP13 segment (marker included) with CAPTION as a UTF-8
+IPTC 2:120, or b"" for an empty caption.'''
+    if not caption:
+        return b''
+    text = caption.encode('utf-8')[:IPTC_CAPTION_MAX]
+    iim = (b'\x1c\x01\x5a' + struct.pack('>H', len(IPTC_UTF8)) + IPTC_UTF8
+           + b'\x1c\x02\x78' + struct.pack('>H', len(text)) + text)
+    res = (b'8BIM' + struct.pack('>H', IPTC_RESOURCE_ID) + b'\x00\x00'
+           + struct.pack('>L', len(iim)) + iim + b'\x00'*(len(iim) % 2))
+    data = b'Photoshop 3.0\x00' + res
+    return b'\xff\xed' + struct.pack('>H', len(data)+2) + data
+
+def header_segments(caption='', date_digitized=None, date_original=None):
+    '''RETURNS: dict(exif=..., extra=...) for PIL's JPEG save(), carrying
+CAPTION and the Exif dates into the output in the same write.'''
+    return dict(exif=exif_dates_payload(date_digitized, date_original),
+                extra=iptc_segment(caption))
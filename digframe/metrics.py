@@ -0,0 +1,146 @@
+'''Per-file, per-stage timing and byte counts, with a run summary.
+
+A FileMetrics travels with one image through the stages (it is small
+and picklable, so it can cross process boundaries). RunMetrics collects
+them and prints a summary or exports JSON.
+'''
+
+import sys
+import json
+import time
+import cProfile
+import contextlib
+
+
+class FileMetrics():
+    def __init__(self, path):
+        self.path = path
+        self.stages = dict() # d[stage] => seconds
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def total(self):
+        return sum(self.stages.values())
+
+    def asdict(self):
+        return dict(path=self.path, stages=self.stages, total=self.total(),
+                    bytes_read=self.bytes_read,
+                    bytes_written=self.bytes_written)
+
+def stage(metrics, name):
+    '''Time NAME on METRICS, which may be None (no instrumentation).'''
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values)-1, int(round(q*(len(sorted_values)-1))))
+    return sorted_values[idx]
+
+class RunMetrics():
+    def __init__(self):
+        self.files = dict() # d[path] => FileMetrics (insertion ordered)
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def file(self, path):
+        '''RETURNS: FileMetrics for PATH, creating it if needed.'''
+        if path not in self.files:
+            self.files[path] = FileMetrics(path)
+        return self.files[path]
+
+    def add(self, fm):
+        '''Merge FM (e.g. returned from a worker process) into the run.'''
+        mine = self.file(fm.path)
+        for name, secs in fm.stages.items():
+            mine.add(name, secs)
+        mine.bytes_read += fm.bytes_read
+        mine.bytes_written += fm.bytes_written
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def stage_names(self):
+        names = list()
+        for fm in self.files.values():
+            names.extend(n for n in fm.stages if n not in names)
+        return names
+
+    def stage_stats(self):
+        '''RETURNS: d[stage] => dict(count, total, p50, p95, max) (seconds)'''
+        stats = dict()
+        for name in self.stage_names():
+            vals = sorted(fm.stages[name] for fm in self.files.values()
+                          if name in fm.stages)
+            stats[name] = dict(count=len(vals), total=sum(vals),
+                               p50=percentile(vals, 0.50),
+                               p95=percentile(vals, 0.95),
+                               max=vals[-1])
+        return stats
+
+    def slowest(self, n=5):
+        return sorted(self.files.values(), key=lambda fm: -fm.total())[:n]
+
+    def summary(self, file=sys.stdout, slowest=5):
+        if self.elapsed is None:
+            self.finish()
+        stats = self.stage_stats()
+        print('\nTiming summary for {} files in {:.1f} sec'
+              .format(len(self.files), self.elapsed), file=file)
+        print('  {:<10} {:>7} {:>10} {:>9} {:>9} {:>9}'
+              .format('Stage', 'Count', 'Total(s)', 'p50(ms)', 'p95(ms)',
+                      'max(ms)'), file=file)
+        for name, st in stats.items():
+            print('  {:<10} {:>7} {:>10.2f} {:>9.1f} {:>9.1f} {:>9.1f}'
+                  .format(name, st['count'], st['total'], 1000*st['p50'],
+                          1000*st['p95'], 1000*st['max']), file=file)
+        print('  Bytes read: {}  written: {}'
+              .format(sum(fm.bytes_read for fm in self.files.values()),
+                      sum(fm.bytes_written for fm in self.files.values())),
+              file=file)
+        if slowest > 0 and self.files:
+            print('  Slowest files:', file=file)
+            for fm in self.slowest(slowest):
+                print('    {:8.1f} ms  {}'.format(1000*fm.total(), fm.path),
+                      file=file)
+
+    def asdict(self):
+        if self.elapsed is None:
+            self.finish()
+        return dict(elapsed=self.elapsed,
+                    files=len(self.files),
+                    stages=self.stage_stats(),
+                    per_file=[fm.asdict() for fm in self.files.values()])
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.asdict(), f, indent=1)
+
+@contextlib.contextmanager
+def profiled(filename):
+    '''cProfile the body and dump stats to FILENAME (no-op if None).
+Only the calling process is profiled; use a single job to profile
+image work.'''
+    if filename is None:
+        yield None
+        return
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield prof
+    finally:
+        prof.disable()
+        prof.dump_stats(filename)
@@ -0,0 +1,53 @@
+'''Name outputs in playback order, once for the whole set.
+
+By default an output name starts with the digitized date
+(see gen_for_df.frame_basename), which puts photos in order only when
+the frame sorts its directory listing, and not at all when they have
+no date (all 19000101T000000). With sequence names the set is sorted
+once here, by:
+  1. Exif DateTimeDigitized
+  2. if none, Exif DateTimeOriginal
+  3. if none either, the file's modification time
+  4. then the path
+and the outputs are numbered in that order:
+  00001-name.jpg, 00002-name.jpg, ...
+optionally in subdirectories of PER_DIR files each (0001/00001-...),
+which keeps directories small for frames with slow FAT listings.
+Numbers are as wide as the largest one (at least 5 digits, 4 for
+subdirectories). When photos are added the later ones move up; the
+build manifest renames their outputs instead of building them again.
+'''
+
+import datetime as dt
+
+NO_DATE_YEAR = 1900 # jobs.get_metadata stands this in for no date
+
+NUMBER_DIGITS = 5
+DIR_DIGITS = 4
+
+
+def play_date(md, mtime_ns):
+    '''RETURNS: datetime a source with metadata MD and modification time
+MTIME_NS is shown at (see module doc).'''
+    if md['date'].year != NO_DATE_YEAR:
+        return md['date']
+    if md['date_original'] is not None:
+        return md['date_original']
+    return dt.datetime.fromtimestamp(mtime_ns/1e9)
+
+def sort_key(md, mtime_ns, path):
+    return (play_date(md, mtime_ns), path)
+
+def sequence_names(basenames, per_dir=None):
+    '''RETURNS: output name of each of BASENAMES (already in play order):
+the sequence number and the basename, under a numbered subdirectory
+of PER_DIR names when given.'''
+    digits = max(NUMBER_DIGITS, len(str(len(basenames))))
+    dir_digits = max(DIR_DIGITS, len(str(len(basenames)//(per_dir or 1) + 1)))
+    names = list()
+    for i, basename in enumerate(basenames):
+        name = '{:0{}d}-{}'.format(i + 1, digits, basename)
+        if per_dir:
+            name = '{:0{}d}/{}'.format(i//per_dir + 1, dir_digits, name)
+        names.append(name)
+    return names
@@ -0,0 +1,191 @@
+'''Staged pipeline that overlaps disk I/O with CPU work.
+
+  read-ahead  -> bounded queue -> transform -> bounded queue -> write-behind
+  (threads)      (PREFETCH)      (JOBS)        (2*WRITERS)     (WRITERS threads)
+
+Reads and writes run in a thread pool, so a slow (network) disk keeps
+working while images are being decoded/encoded. Transforms run in a
+process pool when JOBS > 1, else in a single thread. The stages are
+driven by asyncio on a background thread; Pipeline.map() is an ordinary
+generator yielding results in the order of its input, like
+Executor.map().
+
+A job is any (picklable) object with three methods:
+  read(task)               -> data        (I/O)
+  transform(task, data)    -> result      (CPU)
+  write(task, result)      -> value       (I/O)
+and, when running with a memory budget (MAX_BYTES), a fourth:
+  memory(task)             -> estimated peak bytes of the task
+
+A task is only read once its estimate fits in what is left of the
+budget; its share is returned after it is written. A task estimated
+above MAX_BYTES runs alone.
+'''
+
+import asyncio
+import threading
+import queue
+import collections
+import concurrent.futures
+
+_DONE = object()
+
+
+class Pipeline():
+    def __init__(self, prefetch=4, writers=2, jobs=1, max_bytes=None):
+        self.prefetch = max(1, prefetch)
+        self.writers = max(1, writers)
+        self.jobs = max(1, jobs)
+        self.max_bytes = max_bytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, job, tasks):
+        '''Run every task through JOB's stages.
+RETURNS: generator of write() values, in the order of TASKS.'''
+        tasks = list(tasks)
+        out = queue.Queue()
+        thread = threading.Thread(target=self._thread_main,
+                                  args=(job, tasks, out), daemon=True)
+        thread.start()
+        done = dict() # d[index] => value; completions arrive out of order
+        for i in range(len(tasks)):
+            while i not in done:
+                (idx, value) = out.get()
+                if idx is None:
+                    raise value
+                done[idx] = value
+            yield done.pop(i)
+        thread.join()
+
+    def _thread_main(self, job, tasks, out):
+        try:
+            asyncio.run(self._run(job, tasks, out))
+        except BaseException as ex:
+            out.put((None, ex))
+
+    async def _run(self, job, tasks, out):
+        loop = asyncio.get_running_loop()
+        budget = _Budget(self.max_bytes)
+        weights = [job.memory(task) if self.max_bytes else 0 for task in tasks]
+        read_q = asyncio.Queue(maxsize=self.prefetch)
+        write_q = asyncio.Queue(maxsize=2*self.writers)
+        io_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.prefetch + self.writers)
+        if self.jobs > 1:
+            cpu_pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
+        else:
+            cpu_pool = concurrent.futures.ThreadPoolExecutor(1)
+
+        async def reader():
+            pending = set()
+            for idx, task in enumerate(tasks):
+                # Keep up to PREFETCH reads in flight plus PREFETCH buffered.
+                if len(pending) >= self.prefetch:
+                    await _drain_one(pending)
+                await budget.acquire(weights[idx])
+                fut = loop.run_in_executor(io_pool, job.read, task)
+                pending.add(asyncio.ensure_future(
+                    _enqueue(read_q, idx, task, fut)))
+            while pending:
+                await _drain_one(pending)
+            for _ in range(self.jobs):
+                await read_q.put(_DONE)
+
+        async def transformer():
+            while True:
+                item = await read_q.get()
+                if item is _DONE:
+                    return
+                (idx, task, data) = item
+                result = await loop.run_in_executor(cpu_pool, job.transform,
+                                                    task, data)
+                await write_q.put((idx, task, result))
+
+        async def writer():
+            while True:
+                item = await write_q.get()
+                if item is _DONE:
+                    return
+                (idx, task, result) = item
+                value = await loop.run_in_executor(io_pool, job.write,
+                                                   task, result)
+                await budget.release(weights[idx])
+                out.put((idx, value))
+
+        async def transformers():
+            await asyncio.gather(*[transformer() for _ in range(self.jobs)])
+            for _ in range(self.writers):
+                await write_q.put(_DONE)
+
+        try:
+            await asyncio.gather(reader(), transformers(),
+                                 *[writer() for _ in range(self.writers)])
+        finally:
+            io_pool.shutdown(wait=False)
+            cpu_pool.shutdown(wait=False)
+
+class MemoryBoundedExecutor():
+    '''Executor.map() over EXECUTOR that keeps the estimated memory of
+the tasks in flight (JOB.memory(task)) within MAX_BYTES. Results come
+back in task order, so the budget is returned oldest first.'''
+    def __init__(self, executor, max_bytes):
+        self.executor = executor
+        self.max_bytes = max_bytes
+
+    def __enter__(self):
+        self.executor.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.executor.__exit__(*exc)
+
+    def map(self, job, tasks):
+        pending = collections.deque() # (future, weight)
+        used = 0
+        for task in tasks:
+            weight = job.memory(task)
+            while pending and used + weight > self.max_bytes:
+                (fut, done_weight) = pending.popleft()
+                yield fut.result()
+                used -= done_weight
+            pending.append((self.executor.submit(job, task), weight))
+            used += weight
+        while pending:
+            yield pending.popleft()[0].result()
+
+class _Budget():
+    '''Bytes in flight in a Pipeline; unlimited when LIMIT is None.'''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, n):
+        if self.limit is None:
+            return
+        async with self.cond:
+            await self.cond.wait_for(
+                lambda: self.used == 0 or self.used + n <= self.limit)
+            self.used += n
+
+    async def release(self, n):
+        if self.limit is None:
+            return
+        async with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+async def _enqueue(q, idx, task, fut):
+    await q.put((idx, task, await fut))
+
+async def _drain_one(pending):
+    (done, _) = await asyncio.wait(pending,
+                                   return_when=asyncio.FIRST_COMPLETED)
+    for fut in done:
+        pending.discard(fut)
+        fut.result() # re-raise read errors
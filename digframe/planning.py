@@ -0,0 +1,149 @@
+'''Decide how every source is framed, for the whole batch at once.
+
+From the header sizes alone (no pixels), NumPy arrays give for each
+(source, target) pair: the aspect deviation, whether it is a bad
+aspect, whether to pad (letterbox) or crop, and the output geometry.
+The decisions can be written to a plan file (JSON lines), reviewed or
+edited, and handed back so the pixel stages run without re-deciding:
+
+  {"path": ..., "width": W, "height": H, "aspect": A,
+   "targets": [{"width": TW, "height": TH, "deviation": D,
+                "bad_aspect": true, "mode": "pad" | "crop",
+                "content": [CW, CH], "offset": [X, Y],
+                "box": [LEFT, TOP, RIGHT, BOTTOM] or null}, ...]}
+
+"pad" fits the whole source into CONTENT at OFFSET (what the frames
+have always been); "crop" cuts BOX (source pixels, centered by
+default) to the target aspect and fills the frame.
+'''
+
+import json
+import logging
+
+PAD = 'pad'
+CROP = 'crop'
+MODES = [PAD, CROP]
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('Batch planning needs the "numpy" package')
+    return numpy
+
+def analyze(widths, heights, sizes, tolerance=0.01, max_crop=0.0):
+    '''Plan N sources of WIDTHS x HEIGHTS for T target (width, height) SIZES.
+A bad aspect source is cropped instead of padded when that loses at
+most MAX_CROP of its area (0: always pad).
+RETURNS: dict of arrays; "aspect" is (N,), the rest (N, T):
+deviation, bad, crop, content_w, content_h, x, y, and box (N, T, 4).
+Padded geometry is the same as imaging.fit_geometry.'''
+    np = _numpy()
+    w = np.asarray(widths, dtype=float).reshape(-1, 1)
+    h = np.asarray(heights, dtype=float).reshape(-1, 1)
+    tw = np.asarray([s[0] for s in sizes], dtype=float).reshape(1, -1)
+    th = np.asarray([s[1] for s in sizes], dtype=float).reshape(1, -1)
+    aspect = w/h
+    goal = tw/th
+    deviation = np.abs(aspect - goal)
+    bad = deviation > tolerance
+
+    # Pad: scale the whole source into the frame.
+    scale = np.minimum(tw/w, th/h)
+    cw = np.minimum(tw, np.maximum(1, np.round(w*scale)))
+    ch = np.minimum(th, np.maximum(1, np.round(h*scale)))
+
+    # Crop: the centered box of the goal aspect; KEPT is its share of area.
+    wide = aspect > goal
+    box_w = np.where(wide, np.minimum(w, np.round(h*goal)), w)
+    box_h = np.where(wide, h, np.minimum(h, np.round(w/goal)))
+    kept = (box_w*box_h)/(w*h)
+    crop = bad & (1.0 - kept <= max_crop) if max_crop > 0 else np.zeros_like(bad)
+    left = (w - box_w)//2
+    top = (h - box_h)//2
+    box = np.stack([left, top, left + box_w, top + box_h], axis=-1)
+
+    cw = np.where(crop, tw, cw)
+    ch = np.where(crop, th, ch)
+    return dict(aspect=aspect[:, 0], deviation=deviation, bad=bad, crop=crop,
+                content_w=cw.astype(int), content_h=ch.astype(int),
+                x=((tw - cw)//2).astype(int), y=((th - ch)//2).astype(int),
+                box=box.astype(int))
+
+def plan_records(paths, widths, heights, sizes, tolerance=0.01, max_crop=0.0):
+    '''RETURNS: list of plan records (see module doc), one per path.'''
+    a = analyze(widths, heights, sizes, tolerance=tolerance, max_crop=max_crop)
+    records = list()
+    for i, path in enumerate(paths):
+        targets = list()
+        for t, (tw, th) in enumerate(sizes):
+            crop = bool(a['crop'][i, t])
+            targets.append(dict(width=tw, height=th,
+                                deviation=float(a['deviation'][i, t]),
+                                bad_aspect=bool(a['bad'][i, t]),
+                                mode=CROP if crop else PAD,
+                                content=[int(a['content_w'][i, t]),
+                                         int(a['content_h'][i, t])],
+                                offset=[int(a['x'][i, t]), int(a['y'][i, t])],
+                                box=[int(v) for v in a['box'][i, t]] if crop else None))
+        records.append(dict(path=path, width=int(widths[i]),
+                            height=int(heights[i]),
+                            aspect=float(a['aspect'][i]), targets=targets))
+    return records
+
+def crop_box(record, target_index):
+    '''RETURNS: source box to crop for target TARGET_INDEX of RECORD, or
+None to pad. A "crop" target without a box gets the centered one.'''
+    target = record['targets'][target_index]
+    if target.get('mode', PAD) != CROP:
+        return None
+    if target.get('box'):
+        return tuple(target['box'])
+    a = analyze([record['width']], [record['height']],
+                [(target['width'], target['height'])], max_crop=1.0)
+    return tuple(int(v) for v in a['box'][0, 0])
+
+def apply_plan(records, plan):
+    '''RETURNS: RECORDS with the decisions (mode, geometry, box) of PLAN
+(from read_plan) for the paths it lists. A planned path whose source or
+target sizes no longer match is re-decided, with a warning.'''
+    applied = list()
+    for record in records:
+        planned = plan.get(record['path'])
+        if planned is None:
+            applied.append(record)
+            continue
+        if ((planned['width'], planned['height'])
+            != (record['width'], record['height'])
+            or [(t['width'], t['height']) for t in planned['targets']]
+            != [(t['width'], t['height']) for t in record['targets']]):
+            logging.warning('Plan for %s does not match its sizes; re-deciding',
+                            record['path'])
+            applied.append(record)
+            continue
+        targets = [dict(p, deviation=t['deviation'], bad_aspect=t['bad_aspect'])
+                   for (p, t) in zip(planned['targets'], record['targets'])]
+        applied.append(dict(record, targets=targets))
+    return applied
+
+def write_plan(filename, records):
+    with open(filename, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def read_plan(filename):
+    '''RETURNS: dict[path] => plan record.'''
+    plan = dict()
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get('targets'):
+                    for target in record['targets']:
+                        if target.get('mode', PAD) not in MODES:
+                            raise ValueError('Unknown mode "{}" for {} in {}'
+                                             .format(target['mode'],
+                                                     record['path'], filename))
+                plan[record['path']] = record
+    return plan
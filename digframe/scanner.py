@@ -0,0 +1,128 @@
+'''Find image files under a directory tree, quickly.
+
+Directories are listed with os.scandir in a thread pool, several
+listings ahead of the consumer, which matters on network mounts. Only
+files that pass the extension (and optional glob and magic-byte)
+filters are stat'ed. Entries stream out in a deterministic order:
+top-down like os.walk, files of a directory (sorted by name) before
+its subdirectories (sorted by name). Work can therefore start on the
+first files while the rest of the tree is still being listed.
+'''
+
+import os
+import os.path
+import logging
+import fnmatch
+import concurrent.futures
+from collections import namedtuple
+
+ScanEntry = namedtuple('ScanEntry', ['path', 'root', 'name', 'size', 'mtime_ns'])
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+
+def scan(topdir, extensions=JPEG_EXTENSIONS, magic=None,
+         include=None, exclude=None, threads=8, errors=None):
+    '''Generate ScanEntry for every matching file under TOPDIR.
+EXTENSIONS: lowercase suffixes to accept (None accepts any).
+MAGIC: if given, file must start with these bytes (costs one read).
+INCLUDE: if given, globs one of which the path (relative to TOPDIR)
+  must match. EXCLUDE: globs for paths to skip; a matching directory
+  is not descended into.
+ERRORS: if given, a list to which the paths that could not be read
+  are added (the listing is then incomplete; TOPDIR itself counts).'''
+    lister = _Lister(topdir, extensions, magic, include or [], exclude or [],
+                     errors)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        stack = [pool.submit(lister.list, topdir)]
+        while stack:
+            (entries, subdirs) = stack.pop().result()
+            # Queue children right away so their listings run ahead.
+            futures = [pool.submit(lister.list, d) for d in subdirs]
+            stack.extend(reversed(futures))
+            for entry in entries:
+                yield entry
+
+def entry(topdir, path, extensions=JPEG_EXTENSIONS, magic=None,
+          include=None, exclude=None, threads=None, errors=None):
+    '''RETURNS: ScanEntry for PATH (under TOPDIR) if scan() with the same
+options would produce it, else None (filtered out, excluded directory,
+or no longer there). THREADS and ERRORS are ignored; they are accepted so the options
+of scan() can be passed as they are.'''
+    lister = _Lister(topdir, extensions, magic, include or [], exclude or [])
+    parent = os.path.dirname(path)
+    while os.path.relpath(parent, topdir) not in ('.', ''):
+        if parent == os.path.dirname(parent) or lister.excluded(parent):
+            return None
+        parent = os.path.dirname(parent)
+    try:
+        if not os.path.isfile(path) or not lister.wanted(path):
+            return None
+        st = os.stat(path)
+    except OSError:
+        return None
+    return ScanEntry(path, os.path.dirname(path), os.path.basename(path),
+                     st.st_size, st.st_mtime_ns)
+
+class _Lister():
+    def __init__(self, topdir, extensions, magic, include, exclude,
+                 errors=None):
+        self.topdir = topdir
+        self.errors = errors
+        self.extensions = extensions
+        self.magic = magic
+        self.include = include
+        self.exclude = exclude
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.topdir)
+
+    def excluded(self, path):
+        rel = self.relpath(path)
+        return any(fnmatch.fnmatch(rel, pat) for pat in self.exclude)
+
+    def wanted(self, path):
+        if (self.extensions is not None
+            and not os.path.basename(path).lower().endswith(self.extensions)):
+            return False
+        rel = self.relpath(path)
+        if self.include and not any(fnmatch.fnmatch(rel, pat)
+                                    for pat in self.include):
+            return False
+        if self.excluded(path):
+            return False
+        if self.magic is not None:
+            with open(path, 'rb') as f:
+                if f.read(len(self.magic)) != self.magic:
+                    return False
+        return True
+
+    def list(self, dirpath):
+        '''RETURNS: ([ScanEntry, ...], [subdir, ...]) both sorted by name.'''
+        entries = list()
+        subdirs = list()
+        try:
+            with os.scandir(dirpath) as it:
+                dirents = sorted(it, key=lambda d: d.name)
+        except OSError as ex:
+            logging.warning('Cannot list directory %s: %s', dirpath, ex)
+            self.failed(dirpath)
+            return entries, subdirs
+        for dirent in dirents:
+            try:
+                if dirent.is_dir(follow_symlinks=False):
+                    if not self.excluded(dirent.path):
+                        subdirs.append(dirent.path)
+                elif dirent.is_file() and self.wanted(dirent.path):
+                    st = dirent.stat()
+                    entries.append(ScanEntry(dirent.path, dirpath, dirent.name,
+                                             st.st_size, st.st_mtime_ns))
+            except OSError as ex:
+                logging.warning('Cannot read %s: %s', dirent.path, ex)
+                self.failed(dirent.path)
+        return entries, subdirs
+
+    def failed(self, path):
+        if self.errors is not None:
+            self.errors.append(path)
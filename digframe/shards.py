@@ -0,0 +1,179 @@
+'''Split one run over several machines (or containers) sharing storage.
+
+Two ways to divide the input:
+  Static shards   --shard I/N: a file belongs to shard hash(path
+                  relative to INDIR) % N, so every host computes the
+                  same split without talking to the others.
+  Lease queue     A SQLite file on the shared storage holds one row per
+                  input file. Workers lease chunks of rows, and mark them
+                  done when finished. A lease that is not finished in time
+                  (worker died) is given to another worker.
+
+Each worker writes its own catalog, report and manifest into the
+(shared) output directory; merge() combines the catalogs and reports.
+
+NOTE: SQLite relies on file locks. These work on local disks and on
+most NFSv4/SMB setups but not on every network filesystem.
+'''
+
+import os
+import os.path
+import glob
+import json
+import time
+import hashlib
+import socket
+import sqlite3
+
+from digframe import catalog
+
+CATALOG_STEM = 'digitalframe-catalog'
+REPORT_STEM = 'digitalframe-report'
+
+
+def parse_shard(text):
+    '''RETURNS: (index, count) from "I/N" where 0 <= I < N.'''
+    try:
+        (index, count) = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise ValueError('Shard must look like I/N, e.g. 0/4 (got "{}")'
+                         .format(text))
+    if not 0 <= index < count:
+        raise ValueError('Shard index must be in 0..N-1 (got "{}")'.format(text))
+    return (index, count)
+
+def shard_of(relpath, count):
+    digest = hashlib.blake2b(relpath.replace(os.sep, '/').encode('utf-8'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+def in_shard(relpath, shard):
+    '''True iff RELPATH (relative to INDIR) belongs to SHARD (index, count).'''
+    return shard_of(relpath, shard[1]) == shard[0]
+
+def shard_name(shard):
+    return 'shard-{}-of-{}'.format(*shard)
+
+def worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+def catalog_path(outdir, worker, format):
+    return os.path.join(outdir, '{}.{}.{}'.format(CATALOG_STEM, worker, format))
+
+def report_path(outdir, worker):
+    return os.path.join(outdir, '{}.{}.json'.format(REPORT_STEM, worker))
+
+
+class LeaseQueue():
+    '''Work queue of relative paths in the SQLite file DBFILE.
+Leases expire after LEASE seconds.'''
+    def __init__(self, dbfile, owner=None, lease=600):
+        self.dbfile = dbfile
+        self.owner = owner or worker_name()
+        self.lease = lease
+        self.db = sqlite3.connect(dbfile, timeout=60, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                        ' path TEXT PRIMARY KEY,'
+                        " state TEXT NOT NULL DEFAULT 'todo',"
+                        ' owner TEXT,'
+                        ' expires REAL)')
+
+    def add(self, paths):
+        '''Queue PATHS; ones already queued (by any worker) are kept as is.'''
+        rows = [(p,) for p in paths]
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.executemany('INSERT OR IGNORE INTO tasks (path) VALUES (?)',
+                            rows)
+        self.db.execute('COMMIT')
+
+    def take(self, count):
+        '''Lease up to COUNT paths that are not done and not leased (or
+whose lease expired). RETURNS: list of paths, empty when none are left.'''
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            paths = [p for (p,) in self.db.execute(
+                "SELECT path FROM tasks WHERE state='todo'"
+                " OR (state='leased' AND expires < ?)"
+                ' ORDER BY path LIMIT ?', (now, count))]
+            self.db.executemany(
+                "UPDATE tasks SET state='leased', owner=?, expires=? WHERE path=?",
+                [(self.owner, now + self.lease, p) for p in paths])
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return paths
+
+    def done(self, paths):
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.executemany("UPDATE tasks SET state='done' WHERE path=?"
+                            ' AND owner=?', [(p, self.owner) for p in paths])
+        self.db.execute('COMMIT')
+
+    def counts(self):
+        '''RETURNS: dict[state] => number of paths.'''
+        return dict(self.db.execute(
+            'SELECT state, count(*) FROM tasks GROUP BY state'))
+
+    def close(self):
+        self.db.close()
+
+
+def row_order(row):
+    '''Sort key of a catalog row: directory components, then file name.'''
+    return (row['FullPath'].replace(os.sep, '/').split('/'), row['File'])
+
+def merge(outdir, format='csv'):
+    '''Combine the per-worker catalogs and reports in OUTDIR into one
+catalog (rows ordered by row_order) and one report.
+RETURNS: (catalog filename, report dict).'''
+    rows = list()
+    for filename in sorted(glob.glob(catalog_path(glob.escape(outdir), '*', format))):
+        rows.extend(catalog.read_catalog(filename, format))
+    rows.sort(key=row_order)
+    merged = os.path.join(outdir, '{}.{}'.format(CATALOG_STEM, format))
+    with catalog.CatalogWriter(merged, format=format) as writer:
+        for row in rows:
+            writer.write(dict(date=row['Date'], caption=row['Caption']),
+                         row['File'], row['FullPath'],
+                         output=row.get('Output'))
+
+    reports = list()
+    for filename in sorted(glob.glob(report_path(glob.escape(outdir), '*'))):
+        with open(filename) as f:
+            reports.append(json.load(f))
+    report = merge_reports(reports)
+    with open(os.path.join(outdir, REPORT_STEM + '.json'), 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    return merged, report
+
+def merge_reports(reports):
+    '''RETURNS: one report (see gen_for_df.burn_dir) from REPORTS.'''
+    merged = dict(targets=list(), bad_metadata=list(), duplicates=0,
+                  left_out=list(), truncated_captions=dict(),
+                  failed=dict(), quarantined=list())
+    for report in reports:
+        for target in report['targets']:
+            key = (target['width'], target['height'])
+            same = [t for t in merged['targets']
+                    if (t['width'], t['height']) == key]
+            if same:
+                same[0]['bad_aspect'].update(target['bad_aspect'])
+            else:
+                merged['targets'].append(dict(target,
+                                              bad_aspect=dict(target['bad_aspect'])))
+        merged['bad_metadata'].extend(report['bad_metadata'])
+        merged['duplicates'] += report.get('duplicates', 0)
+        merged['left_out'].extend(report.get('left_out', []))
+        merged['truncated_captions'].update(report.get('truncated_captions', {}))
+        merged['failed'].update(report.get('failed', {}))
+        merged['quarantined'].extend(report.get('quarantined', []))
+    for target in merged['targets']:
+        target['bad_aspect'] = dict(sorted(target['bad_aspect'].items()))
+    merged['bad_metadata'].sort()
+    merged['left_out'].sort()
+    merged['truncated_captions'] = dict(sorted(merged['truncated_captions'].items()))
+    merged['failed'] = dict(sorted(merged['failed'].items()))
+    merged['quarantined'].sort()
+    return merged
@@ -0,0 +1,256 @@
+'''Run jobs so that one bad file cannot stop or stall a run.
+
+Every task yields either the job's result or a Failure in its place;
+the other tasks go on. Isolated(job) does that by catching exceptions,
+for any executor. SupervisedExecutor also runs each task in a watched
+worker process of its own:
+  TIMEOUT   a task running longer (wall clock) has its worker killed
+            and replaced
+  MEMORY    limit of the address space of each worker (RLIMIT_AS,
+            Unix only); an image needing more fails with MemoryError
+            instead of pushing the machine into swap
+  crash     a worker that dies (e.g. in the JPEG decoder) is replaced
+Files that failed go into a RetryList: later runs skip them (unless
+changed) and a retry run processes just them, e.g. with more time.
+The list is JSON lines:
+  {"path": ..., "size": S, "mtime_ns": M, "reason": "timeout",
+   "detail": ..., "attempts": N}
+'''
+
+import os
+import json
+import time
+import logging
+import multiprocessing
+import multiprocessing.connection
+from collections import namedtuple
+
+ERROR = 'error'
+MEMORY = 'memory'
+TIMEOUT = 'timeout'
+CRASH = 'crash'
+
+Failure = namedtuple('Failure', ['reason', 'detail'])
+
+
+def _guard(fn, *args):
+    '''RETURNS: FN(*ARGS), or a Failure if it raises.'''
+    try:
+        return fn(*args)
+    except MemoryError as ex:
+        return Failure(MEMORY, str(ex) or 'out of memory')
+    except Exception as ex:
+        return Failure(ERROR, '{}: {}'.format(type(ex).__name__, ex))
+
+class Isolated():
+    '''JOB (see pipeline.py) with every exception turned into a Failure
+result. A Failure from one stage is passed on by the next.'''
+    def __init__(self, job):
+        self.job = job
+
+    def __call__(self, task):
+        return _guard(self.job, task)
+
+    def memory(self, task):
+        return self.job.memory(task)
+
+    def read(self, task):
+        return _guard(self.job.read, task)
+
+    def transform(self, task, data):
+        if isinstance(data, Failure):
+            return data
+        return _guard(self.job.transform, task, data)
+
+    def write(self, task, result):
+        if isinstance(result, Failure):
+            return result
+        return _guard(self.job.write, task, result)
+
+
+def _limit_memory(nbytes):
+    try:
+        import resource
+    except ImportError:
+        logging.warning('Cannot limit worker memory on this platform')
+        return
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        nbytes = min(nbytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (nbytes, hard))
+
+def _worker_main(conn, job, memory):
+    if memory:
+        _limit_memory(memory)
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        (idx, task) = item
+        conn.send((idx, _guard(job, task)))
+
+class _Worker():
+    def __init__(self, job, memory):
+        (self.conn, child) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(child, job, memory),
+                                               daemon=True)
+        self.process.start()
+        child.close()
+        self.idx = None # Task being run
+        self.deadline = None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class SupervisedExecutor():
+    '''Executor.map() over JOBS watched worker processes (see module
+doc). With MAX_BYTES, the tasks in flight are kept within that many
+bytes by JOB.memory(task) estimates, as pipeline.MemoryBoundedExecutor.'''
+    def __init__(self, jobs=1, timeout=None, memory=None, max_bytes=None):
+        self.jobs = max(1, jobs)
+        self.timeout = timeout
+        self.memory = memory
+        self.max_bytes = max_bytes
+        self.workers = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker.idx is None:
+                try:
+                    worker.conn.send(None)
+                except OSError:
+                    pass
+                worker.process.join(1)
+            if worker.process.is_alive():
+                worker.kill()
+        self.workers = list()
+
+    def map(self, job, tasks):
+        '''RETURNS: generator of JOB(task) (or Failure) in task order.'''
+        tasks = list(tasks)
+        weights = [job.memory(task) if self.max_bytes else 0 for task in tasks]
+        done = dict() # d[index] => value; completions arrive out of order
+        (started, used) = (0, 0)
+        for i in range(len(tasks)):
+            while i not in done:
+                while started < len(tasks) and self._fits(used, weights[started]):
+                    self._start(job, started, tasks[started])
+                    used += weights[started]
+                    started += 1
+                for (idx, value) in self._collect():
+                    done[idx] = value
+                    used -= weights[idx]
+            yield done.pop(i)
+
+    def _fits(self, used, weight):
+        busy = sum(1 for w in self.workers if w.idx is not None)
+        if busy >= self.jobs:
+            return False
+        return self.max_bytes is None or busy == 0 or used + weight <= self.max_bytes
+
+    def _start(self, job, idx, task):
+        idle = [w for w in self.workers if w.idx is None]
+        if idle:
+            worker = idle[0]
+        else:
+            worker = _Worker(job, self.memory)
+            self.workers.append(worker)
+        worker.conn.send((idx, task))
+        worker.idx = idx
+        if self.timeout:
+            worker.deadline = time.monotonic() + self.timeout
+
+    def _collect(self):
+        '''Wait for a task to finish (or run out of time).
+RETURNS: list of (index, value).'''
+        busy = [w for w in self.workers if w.idx is not None]
+        wait = None
+        if self.timeout:
+            wait = max(0, min(w.deadline for w in busy) - time.monotonic())
+        ready = multiprocessing.connection.wait([w.conn for w in busy], wait)
+        finished = list()
+        for worker in busy:
+            if worker.conn in ready:
+                try:
+                    (idx, value) = worker.conn.recv()
+                except (EOFError, OSError):
+                    worker.process.join()
+                    (idx, value) = (worker.idx, Failure(
+                        CRASH, 'worker exited with code {}'
+                        .format(worker.process.exitcode)))
+                    self._drop(worker)
+                finished.append((idx, value))
+                worker.idx = None
+            elif self.timeout and time.monotonic() >= worker.deadline:
+                finished.append((worker.idx, Failure(
+                    TIMEOUT, 'still running after {} seconds'.format(self.timeout))))
+                worker.kill()
+                self._drop(worker)
+        return finished
+
+    def _drop(self, worker):
+        self.workers.remove(worker)
+        worker.conn.close()
+
+
+class RetryList():
+    '''Files that failed, kept in FILENAME (see module doc). RETRYING
+marks a run over just these files; they are then not skipped.'''
+    def __init__(self, filename, retrying=False):
+        self.filename = filename
+        self.retrying = retrying
+        self.records = dict() # d[path] => record
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.records[record['path']] = record
+
+    def __len__(self):
+        return len(self.records)
+
+    def paths(self):
+        return sorted(self.records)
+
+    def holds(self, path, size, mtime_ns):
+        '''True iff PATH is to be skipped: it failed before and has not
+changed since (and this is not a retry run).'''
+        record = self.records.get(path)
+        return (not self.retrying and record is not None
+                and (record['size'], record['mtime_ns']) == (size, mtime_ns))
+
+    def failed(self, path, failure):
+        '''Record that PATH failed with FAILURE.'''
+        try:
+            st = os.stat(path)
+            (size, mtime_ns) = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            (size, mtime_ns) = (None, None)
+        attempts = self.records.get(path, dict(attempts=0))['attempts'] + 1
+        self.records[path] = dict(path=path, size=size, mtime_ns=mtime_ns,
+                                  reason=failure.reason, detail=failure.detail,
+                                  attempts=attempts)
+
+    def discard(self, path):
+        self.records.pop(path, None)
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for path in self.paths():
+                f.write(json.dumps(self.records[path], ensure_ascii=False) + '\n')
+        os.replace(tmp, self.filename)
@@ -0,0 +1,232 @@
+'''Thumbnail index of an output directory, for browsing and checking a
+frame set without opening the frames.
+
+Thumbnails are raw RGB of one fixed size (the frame aspect, WIDTH
+pixels wide), packed into one file that readers memory-map:
+  .digframe-thumbs.bin    16 byte header (magic, width, height), then
+                          one width*height*3 byte slot per thumbnail
+  .digframe-thumbs.json   {"width": W, "height": H,
+                           "offsets": {output basename: byte offset},
+                           "free": [byte offset, ...]}
+Reading a thumbnail is then a slice of the map: no file open, no
+decode. Slots of removed outputs are reused.
+
+burn_dir fills the index from the frames it has just made (see
+imaging.render_frames_bytes), so nothing is decoded again. Like the
+manifest, each worker sharing an output directory has its own index
+(see index_name); readers use all of them.
+'''
+
+import os
+import os.path
+import glob
+import json
+import mmap
+import struct
+
+from PIL import Image, ImageDraw, ImageFont
+
+THUMBS_NAME = '.digframe-thumbs'
+MAGIC = b'DFTHUMB1'
+HEADER = struct.Struct('<8sHHI') # magic, width, height, reserved
+
+
+def index_name(worker=None):
+    '''RETURNS: index file name stem for WORKER (None: the only worker).'''
+    if worker is None:
+        return THUMBS_NAME
+    return '{}.{}'.format(THUMBS_NAME, worker)
+
+def thumb_size(frame_width, frame_height, width=96):
+    '''RETURNS: (width, height) of thumbnails of FRAME_WIDTH x FRAME_HEIGHT frames.'''
+    return (width, max(1, int(round(float(width)*frame_height/frame_width))))
+
+def thumbnail(im, size):
+    '''RETURNS: IM resized to SIZE, as raw RGB bytes.'''
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    return im.resize(size, Image.BILINEAR, reducing_gap=2.0).tobytes()
+
+def thumbnail_of_file(filename, size):
+    '''RETURNS: thumbnail (see thumbnail) of the JPEG FILENAME, decoded
+at the smallest DCT scale that still covers SIZE.'''
+    im = Image.open(filename)
+    if im.format == 'JPEG':
+        im.draft('RGB', size)
+    return thumbnail(im, size)
+
+
+class ThumbIndex():
+    '''Writable index NAME (see index_name) in OUTDIR, of thumbnails of
+SIZE. An existing index of another size is started over.'''
+    def __init__(self, outdir, size, name=THUMBS_NAME):
+        self.outdir = outdir
+        self.size = tuple(size)
+        self.slot_bytes = self.size[0]*self.size[1]*3
+        self.binfile = os.path.join(outdir, name + '.bin')
+        self.tablefile = os.path.join(outdir, name + '.json')
+        self.offsets = dict() # d[output basename] => byte offset
+        self.free = list()
+        self.file = None
+        if os.path.exists(self.tablefile) and os.path.exists(self.binfile):
+            with open(self.tablefile) as f:
+                table = json.load(f)
+            if (table['width'], table['height']) == self.size:
+                self.offsets = table['offsets']
+                self.free = table['free']
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def _open(self):
+        if self.file is None:
+            if self.offsets or self.free:
+                self.file = open(self.binfile, 'r+b')
+            else:
+                self.file = open(self.binfile, 'w+b')
+                self.file.write(HEADER.pack(MAGIC, self.size[0], self.size[1], 0))
+        return self.file
+
+    def put(self, name, rgb):
+        '''Store thumbnail RGB (raw bytes of SIZE) of output NAME.'''
+        if len(rgb) != self.slot_bytes:
+            raise ValueError('Thumbnail of {} is {} bytes, expected {}'
+                             .format(name, len(rgb), self.slot_bytes))
+        f = self._open()
+        offset = self.offsets.get(name)
+        if offset is None:
+            if self.free:
+                offset = self.free.pop()
+            else:
+                slots = len(self.offsets) + len(self.free)
+                offset = HEADER.size + slots*self.slot_bytes
+        f.seek(offset)
+        f.write(rgb)
+        self.offsets[name] = offset
+
+    def discard(self, name):
+        offset = self.offsets.pop(name, None)
+        if offset is not None:
+            self.free.append(offset)
+
+    def rename(self, old, new):
+        '''The output OLD is now called NEW.'''
+        offset = self.offsets.pop(old, None)
+        if offset is not None:
+            self.discard(new)
+            self.offsets[new] = offset
+
+    def entry_bytes(self, name):
+        '''RETURNS: bytes (index file and table) the thumbnail of NAME takes.'''
+        return self.slot_bytes + len(json.dumps(name)) + 14 # ": offset, "
+
+    def fixed_bytes(self):
+        '''RETURNS: bytes the index takes with no thumbnails.'''
+        return HEADER.size + len(json.dumps(dict(width=self.size[0],
+                                                 height=self.size[1],
+                                                 offsets=dict(), free=list()),
+                                            sort_keys=True))
+
+    def prune(self, names):
+        '''Discard the thumbnails of outputs not in NAMES.'''
+        for name in set(self.offsets) - set(names):
+            self.discard(name)
+
+    def compact(self):
+        '''Move the thumbnails past the used slots into free ones, and cut
+the index file to the used slots.'''
+        if not self.free:
+            return
+        end = HEADER.size + len(self.offsets)*self.slot_bytes
+        holes = sorted(offset for offset in self.free if offset < end)
+        f = self._open()
+        for name in sorted(n for (n, o) in self.offsets.items() if o >= end):
+            f.seek(self.offsets[name])
+            rgb = f.read(self.slot_bytes)
+            offset = holes.pop()
+            f.seek(offset)
+            f.write(rgb)
+            self.offsets[name] = offset
+        f.truncate(end)
+        self.free = list()
+
+    def save(self):
+        self.compact()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        tmp = self.tablefile + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(width=self.size[0], height=self.size[1],
+                           offsets=self.offsets, free=sorted(self.free)),
+                      f, sort_keys=True)
+        os.replace(tmp, self.tablefile)
+
+
+class ThumbReader():
+    '''Read-only, memory-mapped view of the index TABLEFILE.'''
+    def __init__(self, tablefile):
+        with open(tablefile) as f:
+            table = json.load(f)
+        self.size = (table['width'], table['height'])
+        self.slot_bytes = self.size[0]*self.size[1]*3
+        self.offsets = table['offsets']
+        self.map = None
+        if not self.offsets:
+            return
+        with open(tablefile[:-len('.json')] + '.bin', 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, width, height, reserved) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or (width, height) != self.size:
+            raise ValueError('{} does not match its index file'.format(tablefile))
+
+    def names(self):
+        return sorted(self.offsets)
+
+    def image(self, name):
+        '''RETURNS: thumbnail of output NAME as a PIL image.'''
+        offset = self.offsets[name]
+        return Image.frombuffer('RGB', self.size,
+                                self.map[offset:offset+self.slot_bytes],
+                                'raw', 'RGB', 0, 1)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+def readers(outdir):
+    '''RETURNS: ThumbReader for every (per-worker) index in OUTDIR.'''
+    return [ThumbReader(f) for f in sorted(glob.glob(os.path.join(
+        glob.escape(outdir), THUMBS_NAME + '*.json')))]
+
+def contact_sheets(outdir, columns=10, rows=10, labels=True):
+    '''Generate contact sheet images (COLUMNS x ROWS thumbnails each) of
+the outputs in OUTDIR, in name (that is, date) order. LABELS puts the
+output name under each thumbnail.'''
+    index = list()
+    sources = readers(outdir)
+    for reader in sources:
+        index.extend((name, reader) for name in reader.names())
+    index.sort(key=lambda item: item[0])
+    if not index:
+        return
+    font = ImageFont.load_default()
+    (tw, th) = max(reader.size for (name, reader) in index)
+    label_height = 12 if labels else 0
+    (cell_w, cell_h) = (tw + 4, th + 4 + label_height)
+    per_sheet = columns*rows
+    try:
+        for start in range(0, len(index), per_sheet):
+            page = index[start:start+per_sheet]
+            used_rows = (len(page) + columns - 1)//columns
+            sheet = Image.new('RGB', (columns*cell_w, used_rows*cell_h), 'white')
+            draw = ImageDraw.Draw(sheet)
+            for i, (name, reader) in enumerate(page):
+                (x, y) = ((i % columns)*cell_w + 2, (i // columns)*cell_h + 2)
+                sheet.paste(reader.image(name), (x, y))
+                if labels:
+                    draw.text((x, y + th + 1), name[-(tw//6):], font=font, fill='black')
+            yield sheet
+    finally:
+        for reader in sources:
+            reader.close()
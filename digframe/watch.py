@@ -0,0 +1,231 @@
+'''Watch a directory tree for new, changed and deleted JPEGs.
+
+On Linux, inotify (through ctypes; no extra package) reports changes as
+they happen. Elsewhere, or when inotify is out of watches, the tree is
+re-scanned every POLL seconds instead.
+
+A file is only reported once it has settled: no events and the same
+size and mtime for SETTLE seconds, and (for a while) ending with the
+JPEG end-of-image marker. Files still being copied in are thus not
+picked up half written.
+'''
+
+import os
+import os.path
+import time
+import struct
+import select
+import logging
+import ctypes
+import ctypes.util
+
+from digframe import scanner
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT = struct.Struct('iIII') # wd, mask, cookie, len (then name)
+
+JPEG_EOI = b'\xff\xd9'
+
+
+class InotifyWatcher():
+    '''Changes under TOPDIR from inotify. Raises OSError when inotify
+is not available or a watch cannot be added.'''
+    def __init__(self, topdir):
+        self.topdir = topdir
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            _raise_errno('inotify_init1')
+        self.dirs = dict() # d[wd] => directory
+        self.add_tree(topdir)
+
+    def add_tree(self, topdir):
+        '''Watch TOPDIR and every directory below it.
+RETURNS: files found (they may predate the watch).'''
+        files = list()
+        for root, dirs, names in os.walk(topdir):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root),
+                                             WATCH_MASK)
+            if wd < 0:
+                _raise_errno('inotify_add_watch({})'.format(root))
+            self.dirs[wd] = root
+            files.extend(os.path.join(root, n) for n in names)
+        return files
+
+    def poll(self, timeout):
+        '''Wait up to TIMEOUT seconds for events.
+RETURNS: (touched, removed) lists of paths, or None when events were
+lost (queue overflow) and the caller must rescan.'''
+        (readable, w, x) = select.select([self.fd], [], [], timeout)
+        touched = list()
+        removed = list()
+        if not readable:
+            return (touched, removed)
+        buf = os.read(self.fd, 64*1024)
+        pos = 0
+        while pos < len(buf):
+            (wd, mask, cookie, size) = EVENT.unpack_from(buf, pos)
+            name = buf[pos+EVENT.size:pos+EVENT.size+size].rstrip(b'\0')
+            pos += EVENT.size + size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs or not name:
+                continue
+            path = os.path.join(self.dirs[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    touched.extend(self.add_tree(path))
+                continue
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                removed.append(path)
+            else:
+                touched.append(path)
+        return (touched, removed)
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher():
+    '''Changes under TOPDIR found by re-scanning it every INTERVAL seconds.'''
+    def __init__(self, topdir, interval=10.0, scan_options=None):
+        self.topdir = topdir
+        self.interval = interval
+        self.scan_options = scan_options or {}
+        self.known = self.listing() or dict()
+        self.last = time.time()
+
+    def listing(self):
+        '''RETURNS: dict[path] => (size, mtime_ns), or None when part of
+TOPDIR could not be listed (its files would look removed).'''
+        errors = list()
+        listing = dict((e.path, (e.size, e.mtime_ns))
+                       for e in scanner.scan(self.topdir, errors=errors,
+                                             **self.scan_options))
+        return None if errors else listing
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        if time.time() - self.last < self.interval:
+            return ([], [])
+        self.last = time.time()
+        now = self.listing()
+        if now is None:
+            return ([], [])
+        touched = [p for (p, st) in now.items() if self.known.get(p) != st]
+        removed = [p for p in self.known if p not in now]
+        self.known = now
+        return (touched, removed)
+
+    def close(self):
+        pass
+
+class Debouncer():
+    '''Hold paths until they have settled for SETTLE seconds. A file
+that does not end in a JPEG EOI marker is held for up to
+MAX_WAIT seconds (it may still be being written).'''
+    def __init__(self, settle=2.0, max_wait=60.0):
+        self.settle = settle
+        self.max_wait = max_wait
+        self.pending = dict() # d[path] => (stat, last change, first seen)
+
+    def touch(self, path, now):
+        first = self.pending.get(path, (None, None, now))[2]
+        self.pending[path] = (_stat(path), now, first)
+
+    def discard(self, path):
+        self.pending.pop(path, None)
+
+    def ready(self, now):
+        '''RETURNS: paths that have settled (and forgets them).'''
+        done = list()
+        for path, (st, changed, first) in list(self.pending.items()):
+            if now - changed < self.settle:
+                continue
+            current = _stat(path)
+            if current is None:
+                del self.pending[path]
+            elif current != st:
+                self.pending[path] = (current, now, first)
+            elif _complete(path) or now - first >= self.max_wait:
+                del self.pending[path]
+                done.append(path)
+        return sorted(done)
+
+def changes(topdir, settle=2.0, poll=None, scan_options=None):
+    '''Generate (entries, removed) batches for TOPDIR forever.
+ENTRIES are scanner.ScanEntry of settled new or changed files that
+scan() with SCAN_OPTIONS would use; REMOVED are deleted file paths.
+The first batch is (None, []): the watch is in place, so the caller
+can now process the whole tree without missing later changes.
+POLL (seconds) forces the polling watcher; else inotify is used when
+possible, falling back to polling every 10 seconds.'''
+    scan_options = scan_options or {}
+    watcher = None
+    if poll is None:
+        try:
+            watcher = InotifyWatcher(topdir)
+        except (OSError, AttributeError, TypeError) as ex:
+            logging.warning('inotify not usable (%s); polling instead', ex)
+            poll = 10.0
+    if watcher is None:
+        watcher = PollingWatcher(topdir, interval=poll,
+                                 scan_options=scan_options)
+    debouncer = Debouncer(settle=settle)
+    try:
+        yield (None, [])
+        while True:
+            events = watcher.poll(settle/2.0)
+            now = time.time()
+            if events is None:
+                logging.warning('inotify queue overflowed; rescanning %s', topdir)
+                events = ([e.path for e in scanner.scan(topdir, **scan_options)], [])
+            (touched, removed) = events
+            for path in touched:
+                debouncer.touch(path, now)
+            for path in removed:
+                debouncer.discard(path)
+            entries = list()
+            for path in debouncer.ready(now):
+                entry = scanner.entry(topdir, path, **scan_options)
+                if entry is not None:
+                    entries.append(entry)
+            gone = [p for p in removed if not os.path.exists(p)]
+            if entries or gone:
+                yield (entries, gone)
+    finally:
+        watcher.close()
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+def _complete(path):
+    '''True iff PATH ends with the JPEG end-of-image marker.'''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-len(JPEG_EOI), 2)
+            return f.read() == JPEG_EOI
+    except OSError:
+        return False
+
+def _raise_errno(what):
+    err = ctypes.get_errno()
+    raise OSError(err, '{}: {}'.format(what, os.strerror(err)))